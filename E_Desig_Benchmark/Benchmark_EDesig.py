@@ -0,0 +1,239 @@
+'''
+Benchmark harness for the E-Designation generation and distribution engines.
+
+Synthetic inputs are generated at a named scale (see edesig_synthetic.SCALES) or at an explicit size, then each stage
+of the in-process pipeline is timed separately: validation, ingest, BBL index build, join, WKB decode, centroids,
+point index build and lookup, field projection, spatial QA, CSV, shapefile and additional format exports, release
+diff, metadata rendering, distribution copies and the bulk transfer. ArcPy stages (SDE pulls, feature class writes)
+are not timed, since they need a licensed ArcGIS installation; everything between reading the export and handing the
+point array to ArcPy is.
+
+Results are written as JSON so stage throughput can be compared across changes and data sizes. Each stage records the
+best and median wall time over the repeats, the number of rows it processed and its throughput in rows per second.
+
+Usage: python Benchmark_EDesig.py [--scale small|realistic|stress] [--rows N] [--lots N] [--repeat N] [--output PATH]
+'''
+
+import argparse, datetime, json, os, platform, shutil, sys, tempfile, time
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_diff, edesig_distribute, edesig_geometry, edesig_ingest, edesig_join, edesig_metadata, edesig_pointindex
+import edesig_qa, edesig_schema, edesig_shapefile, edesig_staging, edesig_synthetic, edesig_validate, edesig_writers
+
+# Number of distribution target directories the export and metadata are copied to, and the shapefile is written to
+
+DISTRIBUTION_TARGETS = 5
+
+METADATA_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<metadata><idinfo><citation><citeinfo><title>nyedes</title><pubdate>20190228</pubdate></citeinfo></citation>
+<descript><abstract>Synthetic E-Designation metadata</abstract></descript><native>Local drive C:</native></idinfo>
+<Esri><DataProperties><lineage>{}</lineage><itemProps><itemLocation>C:\\tempEDesig</itemLocation></itemProps>
+</DataProperties></Esri></metadata>
+'''.format(''.join('<Process ToolSource="tool{0}">step {0}</Process>'.format(step) for step in range(200)))
+
+parser = argparse.ArgumentParser(description="Benchmark the E-Designation pipeline on synthetic data")
+parser.add_argument('--scale', choices=list(edesig_synthetic.SCALES), default='small')
+parser.add_argument('--rows', type=int, help="E-Designation rows (overrides the scale)")
+parser.add_argument('--lots', type=int, help="MapPLUTO lots (overrides the scale)")
+parser.add_argument('--repeat', type=int, default=3, help="times each stage is run")
+parser.add_argument('--output', help="JSON results path (default results/benchmark_{scale}_{timestamp}.json)")
+args = parser.parse_args()
+
+edesig_rows = args.rows or edesig_synthetic.SCALES[args.scale]['edesig_rows']
+lots = args.lots or edesig_synthetic.SCALES[args.scale]['lots']
+started = datetime.datetime.now().replace(microsecond=0)
+output_path = args.output or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'results',
+    'benchmark_{0}_{1}.json'.format(args.scale, started.strftime('%Y%m%d_%H%M%S')))
+work_path = tempfile.mkdtemp(prefix='edesig_benchmark_')
+stages = []
+
+
+def time_stage(name, func, rows):
+    # Run func args.repeat times and record the best and median wall time. Returns the result of the last run.
+
+    timings = []
+    for repeat in range(args.repeat):
+        stage_start = time.time()
+        result = func()
+        timings.append(time.time() - stage_start)
+    best = min(timings)
+    stages.append({'stage': name, 'rows': int(rows), 'best_seconds': round(best, 6),
+                   'median_seconds': round(float(np.median(timings)), 6),
+                   'rows_per_second': round(rows / best, 1) if best > 0 else None})
+    print("{0:<22} {1:>10} rows  {2:>9.3f} s  {3:>12.0f} rows/s".format(name, int(rows), best,
+                                                                       rows / best if best > 0 else 0))
+    return result
+
+
+try:
+    # Generate the synthetic inputs (not timed)
+
+    print("Generating {0} MapPLUTO lots and {1} E-Designation rows".format(lots, edesig_rows))
+    layers = edesig_synthetic.synthetic_layers(lots)
+    export_path = os.path.join(work_path, 'EDES__{}.txt'.format(started.strftime('%Y%m%d')))
+    export_counts = edesig_synthetic.write_edesig_export(export_path, edesig_rows, layers)
+    layer_wkb = {edesig_join.SOURCE_MAPPLUTO: edesig_geometry.to_wkb(layers.mappluto),
+                 edesig_join.SOURCE_TAXLOT: edesig_geometry.to_wkb(layers.taxlot)}
+    layer_bbl = {edesig_join.SOURCE_MAPPLUTO: layers.mappluto_bbl, edesig_join.SOURCE_TAXLOT: layers.taxlot_bbl}
+
+    # Generation stages
+
+    time_stage('validate', lambda: edesig_validate.validate_export(export_path), edesig_rows)
+
+    chunks = time_stage('ingest', lambda: list(edesig_ingest.read_edesig_chunks(export_path)), edesig_rows)
+
+    join_tiers = time_stage('bbl_index', lambda: [(source_code, edesig_join.BBLIndex(layer_bbl[source_code]))
+                                                  for source_code in sorted(layer_bbl)],
+                            len(layers.mappluto_bbl) + len(layers.taxlot_bbl))
+
+    edesig_matched, edesig_unmatched = time_stage('join', lambda: edesig_join.join_chunks(chunks, join_tiers),
+                                                  sum(len(chunk) for chunk in chunks))
+
+    tier_rows = {}
+    for source_code in sorted(layer_bbl):
+        tier_mask = (edesig_matched['SOURCE'] == source_code).values
+        tier_rows[source_code] = (tier_mask, np.unique(edesig_matched['BASE_ROW'].values[tier_mask]))
+    matched_lots = sum(len(tier_oids) for tier_mask, tier_oids in tier_rows.values())
+
+    tier_lots = time_stage('wkb_decode', lambda: dict(
+        (source_code, edesig_geometry.from_wkb([layer_wkb[source_code][oid] for oid in tier_oids]))
+        for source_code, (tier_mask, tier_oids) in tier_rows.items()), matched_lots)
+
+    def compute_points():
+        point_x = np.full(len(edesig_matched), np.nan)
+        point_y = np.full(len(edesig_matched), np.nan)
+        for source_code, (tier_mask, tier_oids) in tier_rows.items():
+            lot_x, lot_y = edesig_geometry.centroids(tier_lots[source_code])
+            lot_positions = np.searchsorted(tier_oids, edesig_matched['BASE_ROW'].values[tier_mask])
+            point_x[tier_mask] = lot_x[lot_positions]
+            point_y[tier_mask] = lot_y[lot_positions]
+        return point_x, point_y
+
+    point_x, point_y = time_stage('centroids', compute_points, matched_lots)
+
+    # The synthetic concave, multipart and holed lots have centroids outside them, so this times moving them inside
+
+    time_stage('centroids_inside', lambda: [edesig_geometry.centroids(polygons, inside=True)
+                                            for polygons in tier_lots.values()], matched_lots)
+
+    # Point index stages: the per base-layer version build (decode and centroid every lot, then write the index) and
+    # the per release lookup against the memory-mapped index
+
+    index_path = os.path.join(work_path, 'point_index')
+
+    def build_point_index():
+        tiers = []
+        for source_code in sorted(layer_bbl):
+            lot_x, lot_y = edesig_geometry.centroids(edesig_geometry.from_wkb(layer_wkb[source_code]))
+            tiers.append((source_code, layer_bbl[source_code], lot_x, lot_y))
+        edesig_pointindex.PointIndex.build(tiers).save(index_path)
+
+    time_stage('point_index_build', build_point_index, len(layers.mappluto_bbl) + len(layers.taxlot_bbl))
+    time_stage('point_index_lookup', lambda: edesig_pointindex.locate_chunks(
+        chunks, edesig_pointindex.PointIndex.load(index_path), columns=edesig_schema.source_columns()),
+        sum(len(chunk) for chunk in chunks))
+
+    point_array = time_stage('field_projection', lambda: edesig_schema.project_points(
+        edesig_matched, point_x, point_y, extra_fields=[("SOURCE", np.int16)]), len(edesig_matched))
+
+    time_stage('qa_points', lambda: edesig_qa.check_points(
+        point_array['POINT_X'], point_array['POINT_Y'], point_array['BBL'],
+        [edesig_qa.LotLayer(edesig_join.SOURCE_NAMES[source_code], layer_bbl[source_code], polygons)
+         for source_code, polygons in ((edesig_join.SOURCE_MAPPLUTO, layers.mappluto),
+                                       (edesig_join.SOURCE_TAXLOT, layers.taxlot))]), len(point_array))
+
+    points_csv = os.path.join(work_path, 'nyedes_points.csv')
+    time_stage('export_csv', lambda: pd.DataFrame(point_array).to_csv(points_csv, index=False), len(point_array))
+
+    time_stage('export_shapefile', lambda: edesig_shapefile.write_points(
+        [os.path.join(work_path, 'shp_{}'.format(target), 'nyedes') for target in range(DISTRIBUTION_TARGETS)],
+        point_array['POINT_X'], point_array['POINT_Y'], point_array, edesig_schema.dbf_fields()),
+        len(point_array) * DISTRIBUTION_TARGETS)
+
+    # Every additional output format whose dependencies are installed, written from the same point array
+
+    for name in edesig_writers.available_formats():
+        time_stage('format_{}'.format(name), lambda name=name: edesig_writers.write_outputs(
+            [name], os.path.join(work_path, 'nyedes_formats'), point_array,
+            edesig_writers.SpatialReference('', 2263)), len(point_array))
+
+    # Compare the release with a copy in which some records were removed, added, edited and moved
+
+    changed_array = point_array[len(point_array) // 100:].copy()
+    changed_array['CEQR_NUM'][::50] = 'CHANGED'
+    changed_array['POINT_X'][::70] += 25.0
+    changed_array = np.concatenate([changed_array, point_array[:len(point_array) // 200]])
+    changed_array['ENUMBER'][-(len(point_array) // 200):] = 'E-ADDED'
+    time_stage('release_diff', lambda: edesig_diff.compare(pd.DataFrame(point_array), pd.DataFrame(changed_array)),
+               len(point_array) + len(changed_array))
+
+    # Distribution stages
+
+    template_path = os.path.join(work_path, 'nyedes_meta.xml')
+    with open(template_path, 'w') as template_file:
+        template_file.write(METADATA_TEMPLATE)
+
+    def render_metadata():
+        cache_path = os.path.join(work_path, 'meta_cache')
+        if os.path.exists(cache_path):
+            shutil.rmtree(cache_path)
+        return edesig_metadata.MetadataCache(cache_path).render(template_path, '20201031')
+
+    rendered_metadata = time_stage('metadata', render_metadata, 1)
+
+    target_paths = [os.path.join(work_path, 'target_{}'.format(target)) for target in range(DISTRIBUTION_TARGETS)]
+    for target_path in target_paths:
+        os.makedirs(target_path)
+
+    def distribute():
+        distribution = edesig_distribute.DistributionExecutor(max_workers=4, retries=0)
+        for target_path in target_paths:
+            distribution.add(target_path + ' points', lambda target_path=target_path: edesig_metadata.write_copy(
+                points_csv, os.path.join(target_path, 'nyedes_points.csv')))
+            distribution.add(target_path + ' metadata', lambda target_path=target_path: edesig_metadata.write_copy(
+                rendered_metadata.xml_path, os.path.join(target_path, 'nyedes_meta_Final.xml')))
+        distribution.run()
+        distribution.check()
+
+    time_stage('distribution_copies', distribute, len(point_array) * DISTRIBUTION_TARGETS)
+
+    # The same copies as one chunked, checksummed bulk transfer, into fresh directories so that no file is skipped
+
+    transfer_path = os.path.join(work_path, 'transfer')
+
+    def bulk_transfer():
+        shutil.rmtree(transfer_path, ignore_errors=True)
+        edesig_staging.transfer([(source, os.path.join(transfer_path, 'target_{}'.format(target),
+                                                       os.path.basename(source)))
+                                 for target in range(DISTRIBUTION_TARGETS)
+                                 for source in (points_csv, rendered_metadata.xml_path)], retries=0).check()
+
+    time_stage('bulk_transfer', bulk_transfer, len(point_array) * DISTRIBUTION_TARGETS)
+
+    # Write results
+
+    results = {
+        'started': str(started),
+        'scale': args.scale,
+        'edesig_rows': edesig_rows,
+        'mappluto_lots': len(layers.mappluto_bbl),
+        'taxlot_lots': len(layers.taxlot_bbl),
+        'export_rows': export_counts,
+        'matched_rows': len(edesig_matched),
+        'unmatched_rows': len(edesig_unmatched),
+        'repeat': args.repeat,
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor()},
+        'stages': stages,
+    }
+    if not os.path.isdir(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path))
+    with open(output_path, 'w') as results_file:
+        json.dump(results, results_file, indent=1)
+    print("Benchmark results written to {}".format(output_path))
+
+finally:
+    shutil.rmtree(work_path, ignore_errors=True)
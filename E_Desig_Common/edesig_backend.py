@@ -0,0 +1,472 @@
+'''
+Geoprocessing backends of the generation and backfill scripts.
+
+Everything generation needs from a GIS package goes through a backend, chosen by the Backend key of the ini file:
+
+arcpy  Reads MapPLUTO and TAXLOT_POLYGON from SDE into file geodatabases in the base-layer cache and writes each
+       release as a feature class in EDES_GDB.gdb in the temporary directory, as before. Requires ArcGIS Pro.
+open   Reads MapPLUTO and TAXLOT_POLYGON from GeoPackage files (MapPLUTO_GeoPackage and TaxLot_GeoPackage) into NumPy
+       arrays in the base-layer cache and writes each release as a GeoPackage in EDES_GPKG in the temporary
+       directory. Needs only NumPy and the standard library sqlite3 module, so it runs on Linux workers.
+
+A backend provides base_layer_sources, source_fingerprint, pull_base_layer and cached_base_layer (the base-layer
+cache), spatial_reference and read_lots (the lots of a layer as BBLs and flat polygons), create_workspace,
+dataset_path, write_points and read_points (the release dataset), exists and remove (stage outputs, see edesig_stages)
+and messages (the geoprocessing messages of a failed run). thread_safe is False for a backend whose calls must not be
+made from two threads at once, which limits the generation pipeline to one stage at a time. Joining by BBL, centroids,
+merging the two layers and the shapefile and additional output formats are done the same way whatever the backend, by
+the point index (see edesig_pointindex) and the NumPy writers, which is what makes the two backends interchangeable.
+
+Spatial references are passed around as edesig_writers.SpatialReference. The arcpy backend keeps the whole string of
+exportToString in its wkt, coordinate grid settings included; esri_wkt() returns the WKT alone.
+
+To check that two backends produce the same release, generate it with both from the same export and compare the
+points and attributes (see parity()). From the command line:
+
+    python edesig_backend.py EXPORT --backend arcpy MAPPLUTO TAXLOT --backend open MAPPLUTO.gpkg TAXLOT.gpkg
+                             [--workspace PATH] [--tolerance FEET] [--centroid-inside]
+'''
+
+import os, sys, json, shutil, sqlite3, struct, argparse, tempfile, collections
+import numpy as np
+import pandas as pd
+
+import edesig_bbl, edesig_cache, edesig_diff, edesig_geometry, edesig_ingest, edesig_join, edesig_manifest
+import edesig_pointindex, edesig_schema, edesig_telemetry, edesig_writers
+
+DEFAULT_BACKEND = 'arcpy'
+
+# Points of the same release generated by two backends may differ by this much (feet) and still match
+
+PARITY_TOLERANCE = 0.01
+
+# Size of the envelope that follows the header of a GeoPackage geometry blob, by envelope indicator
+
+GEOPACKAGE_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+LOT_BATCH_SIZE = 100000
+
+
+def esri_wkt(spatial_reference):
+    '''Return the WKT of spatial_reference, without the coordinate grid settings arcpy appends after a semicolon.'''
+
+    return spatial_reference.wkt.split(';')[0]
+
+
+class ArcpyBackend(object):
+    '''SDE base layers and file geodatabase releases through arcpy (see edesig_baselayers).'''
+
+    name = 'arcpy'
+    label = 'ArcPy'
+
+    # arcpy is not thread-safe, so stages using this backend must not run concurrently
+
+    thread_safe = False
+
+    def __init__(self):
+        import arcpy
+        import edesig_baselayers
+        self.arcpy = arcpy
+        self.baselayers = edesig_baselayers
+
+    def base_layer_sources(self, config, section='GENERATION_PATHS'):
+        return self.baselayers.base_layer_sources(config, section)
+
+    def source_fingerprint(self, source):
+        return self.baselayers.source_fingerprint(source)
+
+    def cached_base_layer(self, base_layer_cache, out_name, layer_fingerprint):
+        return self.baselayers.cached_base_layer(base_layer_cache, out_name, layer_fingerprint)
+
+    def pull_base_layer(self, base_layer_cache, source_code, source, out_name, layer_fingerprint, record=None):
+        return self.baselayers.pull_base_layer(base_layer_cache, source_code, source, out_name, layer_fingerprint,
+                                               record)
+
+    def spatial_reference(self, layer):
+        spatial_reference = self.arcpy.Describe(layer).spatialReference
+        return edesig_writers.SpatialReference(spatial_reference.exportToString(), spatial_reference.factoryCode)
+
+    def _arcpy_spatial_reference(self, spatial_reference):
+        arcpy_spatial_reference = self.arcpy.SpatialReference()
+        arcpy_spatial_reference.loadFromString(spatial_reference.wkt)
+        return arcpy_spatial_reference
+
+    def read_lots(self, source_code, layer, spatial_reference):
+        return self.baselayers.read_lots(source_code, layer, self._arcpy_spatial_reference(spatial_reference))
+
+    def create_workspace(self, path, name='EDES_GDB'):
+        '''Create the file geodatabase name.gdb in path if it does not exist, and make it the arcpy workspace.'''
+
+        gdb_path = os.path.join(path, name + '.gdb')
+        print("Checking Temp FGDB")
+        if self.arcpy.Exists(gdb_path):
+            print("Temp FGDB already exists")
+        else:
+            self.arcpy.CreateFileGDB_management(path, name, "CURRENT")
+        self.arcpy.env.workspace = gdb_path
+        return gdb_path
+
+    def dataset_path(self, workspace, name):
+        return os.path.join(workspace, name)
+
+    def write_points(self, path, point_array, spatial_reference):
+        self.arcpy.da.NumPyArrayToFeatureClass(edesig_schema.release_array(point_array), path,
+                                               edesig_schema.POINT_FIELDS,
+                                               self._arcpy_spatial_reference(spatial_reference))
+
+    def read_points(self, path):
+        fields = edesig_schema.field_names() + ['SHAPE@X', 'SHAPE@Y']
+        feature_array = self.arcpy.da.FeatureClassToNumPyArray(path, fields)
+        point_array = np.empty(len(feature_array), dtype=edesig_schema.numpy_dtype())
+        for name, field in zip(point_array.dtype.names, fields):
+            point_array[name] = feature_array[field]
+        return point_array
+
+    def exists(self, path):
+        return self.arcpy.Exists(path)
+
+    def remove(self, path):
+        self.arcpy.Delete_management(path)
+
+    def messages(self):
+        return self.arcpy.GetMessages()
+
+
+def _feature_table(connection, path):
+    # The first feature table of a GeoPackage, with its geometry column and spatial reference
+
+    row = connection.execute(
+        "SELECT c.table_name, g.column_name, s.organization, s.organization_coordsys_id, s.srs_id, s.definition "
+        "FROM gpkg_contents c JOIN gpkg_geometry_columns g ON g.table_name = c.table_name "
+        "LEFT JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id "
+        "WHERE c.data_type = 'features' ORDER BY c.table_name").fetchone()
+    if row is None:
+        raise ValueError("{} holds no feature table".format(path))
+    table_name, geometry_column, organization, organization_id, srs_id, definition = row
+    epsg = organization_id if (organization or '').upper() == 'EPSG' else srs_id
+    return table_name, geometry_column, edesig_writers.SpatialReference(definition or '', epsg)
+
+
+def _geopackage_wkb(blob):
+    # Strip the "GP" header and optional envelope of a GeoPackage geometry blob, returning None for empty geometries
+
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    if blob[:2] != b'GP':
+        raise ValueError("Not a GeoPackage geometry blob")
+    flags = bytearray(blob[3:4])[0]
+    if flags & 0x10:
+        return None
+    return blob[8 + GEOPACKAGE_ENVELOPE_SIZES[(flags >> 1) & 0x07]:]
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class OpenBackend(object):
+    '''GeoPackage base layers, cached as NumPy arrays, and GeoPackage releases, with no GIS package installed.'''
+
+    name = 'open'
+    label = 'Geoprocessing'
+    thread_safe = True
+
+    def base_layer_sources(self, config, section='GENERATION_PATHS'):
+        '''Return (stage name, source code, cached layer name, GeoPackage path) for each base layer, in join order.'''
+
+        return [("pull_mappluto", edesig_join.SOURCE_MAPPLUTO, "MapPLUTO_UNCLIPPED",
+                 config.get(section, 'MapPLUTO_GeoPackage')),
+                ("pull_taxlot", edesig_join.SOURCE_TAXLOT, "TAXLOT_POLYGON",
+                 config.get(section, 'TaxLot_GeoPackage'))]
+
+    def source_fingerprint(self, source):
+        '''
+        Return a fingerprint of the row count, last change, extent and schema of the feature table of the GeoPackage
+        source. The file's modification time is part of the last change, since not every tool updates gpkg_contents.
+        '''
+
+        connection = sqlite3.connect(source)
+        try:
+            table_name, geometry_column, spatial_reference = _feature_table(connection, source)
+            last_change, min_x, min_y, max_x, max_y = connection.execute(
+                "SELECT last_change, min_x, min_y, max_x, max_y FROM gpkg_contents WHERE table_name = ?",
+                (table_name,)).fetchone()
+            row_count = connection.execute("SELECT COUNT(*) FROM {}".format(_quote(table_name))).fetchone()[0]
+            fields = [(column[1], column[2], None) for column in
+                      connection.execute("PRAGMA table_info({})".format(_quote(table_name)))]
+        finally:
+            connection.close()
+        return edesig_cache.fingerprint(row_count, '{0} {1}'.format(last_change, os.path.getmtime(source)),
+                                        (min_x, min_y, max_x, max_y), fields)
+
+    def cached_base_layer(self, base_layer_cache, out_name, layer_fingerprint):
+        return os.path.join(base_layer_cache.entry_path(out_name, layer_fingerprint), out_name)
+
+    def pull_base_layer(self, base_layer_cache, source_code, source, out_name, layer_fingerprint, record=None):
+        '''
+        Return the path of the cached copy of the GeoPackage source: a directory holding the BBL and flat polygon
+        arrays of its lots and its spatial reference. record, an edesig_telemetry.StageRecord, receives whether the
+        cache was hit and the bytes pulled.
+        '''
+
+        pulled = []
+
+        def build(staging_path):
+            pulled.append(staging_path)
+            layer_path = os.path.join(staging_path, out_name)
+            os.makedirs(layer_path)
+            lot_bbl, lot_polygons = self._read_geopackage_lots(source_code, source)
+            np.save(os.path.join(layer_path, 'bbl.npy'), edesig_bbl.parse_bbl(lot_bbl, errors='coerce'))
+            edesig_geometry.save_polygons(lot_polygons, os.path.join(layer_path, 'lots'))
+            with open(os.path.join(layer_path, 'spatial_reference.json'), 'w') as spatial_reference_file:
+                json.dump(self._geopackage_spatial_reference(source)._asdict(), spatial_reference_file)
+
+        print("Checking base-layer cache for {}".format(out_name))
+        entry_path = base_layer_cache.fetch(out_name, layer_fingerprint, build, check=lambda entry_path: os.path.exists(
+            os.path.join(entry_path, out_name, 'spatial_reference.json')))
+        if record is not None:
+            record.cached = not pulled
+            record.bytes_written = edesig_telemetry.file_size(entry_path) if pulled else 0
+        return self.cached_base_layer(base_layer_cache, out_name, layer_fingerprint)
+
+    def _geopackage_spatial_reference(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            return _feature_table(connection, path)[2]
+        finally:
+            connection.close()
+
+    def _read_geopackage_lots(self, source_code, path, batch_size=LOT_BATCH_SIZE):
+        # The BBL and polygon of every lot in the feature table of a GeoPackage, decoding its WKB in batches
+
+        connection = sqlite3.connect(path)
+        try:
+            table_name, geometry_column, spatial_reference = _feature_table(connection, path)
+            cursor = connection.execute("SELECT {0}, {1} FROM {2} ORDER BY rowid".format(
+                _quote(edesig_schema.BASE_LAYER_BBL_COLUMNS[source_code]), _quote(geometry_column),
+                _quote(table_name)))
+            lot_bbl = []
+            lot_batches = []
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                lot_bbl += [row[0] for row in rows]
+                lot_batches.append(edesig_geometry.from_wkb([_geopackage_wkb(row[1]) for row in rows]))
+        finally:
+            connection.close()
+        return np.array(lot_bbl, dtype=object), edesig_geometry.concatenate(lot_batches)
+
+    def spatial_reference(self, layer):
+        '''Return the spatial reference of a cached layer or of the feature table of a GeoPackage.'''
+
+        if os.path.isdir(layer):
+            with open(os.path.join(layer, 'spatial_reference.json'), 'r') as spatial_reference_file:
+                return edesig_writers.SpatialReference(**json.load(spatial_reference_file))
+        return self._geopackage_spatial_reference(layer)
+
+    def read_lots(self, source_code, layer, spatial_reference):
+        '''
+        Return the BBL and polygon of every lot of a cached layer or GeoPackage. There is no projection engine, so the
+        layer must already be in spatial_reference.
+        '''
+
+        # A GeoPackage whose srs_id has no gpkg_spatial_ref_sys row has no EPSG code, and cannot be checked either
+
+        layer_spatial_reference = self.spatial_reference(layer)
+        if layer_spatial_reference.epsg is None or spatial_reference.epsg is None or \
+                int(layer_spatial_reference.epsg) != int(spatial_reference.epsg):
+            raise ValueError("{0} is in EPSG:{1}, not EPSG:{2}, and the open backend cannot project it".format(
+                layer, layer_spatial_reference.epsg, spatial_reference.epsg))
+        if os.path.isdir(layer):
+            return (np.load(os.path.join(layer, 'bbl.npy'), mmap_mode='r'),
+                    edesig_geometry.load_polygons(os.path.join(layer, 'lots')))
+        return self._read_geopackage_lots(source_code, layer)
+
+    def create_workspace(self, path, name='EDES_GPKG'):
+        '''Create the directory name in path, which the release GeoPackages are written to, if it does not exist.'''
+
+        workspace_path = os.path.join(path, name)
+        print("Checking Temp GeoPackage directory")
+        if os.path.isdir(workspace_path):
+            print("Temp GeoPackage directory already exists")
+        else:
+            os.makedirs(workspace_path)
+        return workspace_path
+
+    def dataset_path(self, workspace, name):
+        return os.path.join(workspace, name + '.gpkg')
+
+    def write_points(self, path, point_array, spatial_reference):
+        temp_path = path + '.tmp'
+        edesig_writers.write_geopackage(temp_path, os.path.splitext(os.path.basename(path))[0],
+                                        edesig_schema.release_array(point_array),
+                                        edesig_writers.SpatialReference(esri_wkt(spatial_reference),
+                                                                        spatial_reference.epsg))
+        edesig_manifest.replace_file(temp_path, path)
+
+    def read_points(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            table_name, geometry_column, spatial_reference = _feature_table(connection, path)
+            fields = edesig_schema.field_names()
+            rows = connection.execute("SELECT {0}, {1} FROM {2} ORDER BY rowid".format(
+                _quote(geometry_column), ', '.join(_quote(field) for field in fields), _quote(table_name))).fetchall()
+        finally:
+            connection.close()
+
+        point_array = np.empty(len(rows), dtype=edesig_schema.numpy_dtype())
+        columns = list(zip(*rows)) if rows else [[]] * (len(fields) + 1)
+        for field, values in zip(fields, columns[1:]):
+            point_array[field] = values
+        coordinates = []
+        for blob in columns[0]:
+            wkb = _geopackage_wkb(blob)
+            if wkb is None:
+                coordinates.append((np.nan, np.nan))
+            else:
+                coordinates.append(struct.unpack_from('<dd' if bytearray(wkb[:1])[0] == 1 else '>dd', wkb, 5))
+        coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        point_array[edesig_schema.POINT_FIELDS[0]] = coordinates[:, 0]
+        point_array[edesig_schema.POINT_FIELDS[1]] = coordinates[:, 1]
+        return point_array
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def messages(self):
+        return ''
+
+
+BACKENDS = collections.OrderedDict([(ArcpyBackend.name, ArcpyBackend), (OpenBackend.name, OpenBackend)])
+
+
+def get_backend(name=DEFAULT_BACKEND):
+    '''Return a new backend by name (arcpy or open).'''
+
+    name = (name or DEFAULT_BACKEND).strip().lower()
+    if name not in BACKENDS:
+        raise ValueError("Unknown geoprocessing backend {0}; expected one of {1}".format(name, ", ".join(BACKENDS)))
+    return BACKENDS[name]()
+
+
+def lot_tiers(backend, base_layers, centroid_inside=False):
+    '''
+    Read the lots of base_layers, a list of (source code, layer path) in join order, in the spatial reference of the
+    first layer and compute their centroids. Returns the PointIndex.build tiers, the (source code, bbl, polygons) lots
+    and the spatial reference.
+    '''
+
+    spatial_reference = backend.spatial_reference(base_layers[0][1])
+    tiers = []
+    lots = []
+    for source_code, base_layer in base_layers:
+        print("Computing centroids of every {} lot".format(edesig_join.SOURCE_NAMES[source_code]))
+        lot_bbl, lot_polygons = backend.read_lots(source_code, base_layer, spatial_reference)
+        lot_x, lot_y = edesig_geometry.centroids(lot_polygons, inside=centroid_inside)
+        tiers.append((source_code, lot_bbl, lot_x, lot_y))
+        lots.append((source_code, lot_bbl, lot_polygons))
+    return tiers, lots, spatial_reference
+
+
+def point_index(backend, base_layer_cache, base_layers, index_fingerprint, centroid_inside=False, record=None):
+    '''
+    Return the path of the point index for base_layers, a list of (source code, cached layer path) in join order,
+    building it into the base-layer cache on a miss. Coordinates are in the spatial reference of the first layer.
+    '''
+
+    built = []
+
+    def build(staging_path):
+        tiers, lots, spatial_reference = lot_tiers(backend, base_layers, centroid_inside)
+        index = edesig_pointindex.PointIndex.build(tiers)
+        print("{0} BBLs indexed ({1} duplicate BBLs ignored)".format(len(index), index.info['duplicates']))
+        index.save(staging_path, lots)
+        built.append(index)
+
+    print("Checking base-layer cache for the point index")
+    index_path = base_layer_cache.fetch(edesig_pointindex.CACHE_LAYER, index_fingerprint, build,
+                                        check=edesig_pointindex.PointIndex.exists)
+    if record is not None:
+        record.cached = not built
+        record.rows_out = len(edesig_pointindex.PointIndex.load(index_path))
+    return index_path
+
+
+def generate_release(backend, export_path, base_layers, workspace, name, centroid_inside=False):
+    '''
+    Generate the release of the export at export_path against base_layers, a list of (source code, layer path) in
+    join order, with backend and write it as name in workspace. Returns the points read back from the written
+    dataset, so that the backend's reader and writer are covered as well as its lots.
+    '''
+
+    tiers, lots, spatial_reference = lot_tiers(backend, base_layers, centroid_inside)
+    index = edesig_pointindex.PointIndex.build(tiers)
+    edesig_matched, edesig_unmatched = edesig_pointindex.locate_chunks(
+        edesig_ingest.read_edesig_chunks(export_path, edesig_ingest.IngestReport()), index,
+        columns=edesig_schema.source_columns())
+    point_x = edesig_matched["POINT_X"].values
+    point_y = edesig_matched["POINT_Y"].values
+    has_point = np.isfinite(point_x) & np.isfinite(point_y)
+    point_array = edesig_schema.project_points(edesig_matched[has_point], point_x[has_point], point_y[has_point])
+
+    path = backend.dataset_path(workspace, name)
+    if backend.exists(path):
+        backend.remove(path)
+    backend.write_points(path, point_array, spatial_reference)
+    return backend.read_points(path)
+
+
+def parity(export_path, runs, workspace, centroid_inside=False, tolerance=PARITY_TOLERANCE):
+    '''
+    Generate the release of one export with each of runs, (backend, base layers) pairs, and compare every release
+    with the first one: the same records with the same attributes, and points within tolerance of each other.
+    Returns an edesig_diff.ReleaseDiff per run after the first; they are at parity when every diff is unchanged.
+    '''
+
+    columns = [name for name in edesig_schema.field_names() if name not in edesig_diff.KEY_COLUMNS]
+    releases = []
+    for position, (backend, base_layers) in enumerate(runs):
+        print("Generating {0} with the {1} backend".format(os.path.basename(export_path), backend.name))
+        run_workspace = backend.create_workspace(workspace, '{0}_{1}'.format(backend.name, position))
+        releases.append((backend.name, generate_release(backend, export_path, base_layers, run_workspace,
+                                                        'nyedes_parity', centroid_inside)))
+
+    reference_name, reference = releases[0]
+    return [edesig_diff.compare(pd.DataFrame(reference), pd.DataFrame(release), columns,
+                                tolerance, '{} backend'.format(reference_name), '{} backend'.format(name))
+            for name, release in releases[1:]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that geoprocessing backends generate the same release")
+    parser.add_argument('export', help="E-Designation export (.txt) to generate the release from")
+    parser.add_argument('--backend', nargs=3, action='append', required=True,
+                        metavar=('NAME', 'MAPPLUTO', 'TAXLOT'),
+                        help="backend (arcpy or open) with its MapPLUTO and TaxLot layers; the first is the reference")
+    parser.add_argument('--workspace', help="directory the releases are written to (default a temporary directory)")
+    parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE,
+                        help="distance in feet two points may differ by and still match")
+    parser.add_argument('--centroid-inside', action='store_true',
+                        help="move centroids outside their lot inside it, as Centroid_Inside does")
+    args = parser.parse_args()
+    if len(args.backend) < 2:
+        parser.error("at least two --backend runs are needed")
+
+    workspace = args.workspace or tempfile.mkdtemp(prefix='edesig_parity_')
+    diffs = parity(args.export, [(get_backend(name), [(edesig_join.SOURCE_MAPPLUTO, mappluto),
+                                                      (edesig_join.SOURCE_TAXLOT, taxlot)])
+                                 for name, mappluto, taxlot in args.backend],
+                   workspace, args.centroid_inside, args.tolerance)
+    for diff in diffs:
+        print(diff.summary())
+    at_parity = all(diff.unchanged and len(diff.old) == len(diff.new) for diff in diffs)
+    print("Backends are {}at parity. Releases written to {}".format('' if at_parity else 'NOT ', workspace))
+    sys.exit(0 if at_parity else 1)
@@ -0,0 +1,196 @@
+'''
+Parallel regeneration of archived E-Designation releases.
+
+A backfill resolves many releases against one point index (see edesig_pointindex). The index and the lots stored
+with it are memory-mapped, so every worker process shares the same pages instead of reading the base layers again.
+Each release is handed to a process pool as a ReleaseTask and generated independently: the export is streamed into
+the point index lookup, projected into the release schema, written as a shapefile and a point array named by the
+release's own date, and checked by the spatial QA.
+
+A release that fails is reported in the summary with its error rather than stopping the others.
+'''
+
+import os, io, time, traceback, collections, multiprocessing
+import numpy as np
+
+import edesig_ingest, edesig_join, edesig_manifest, edesig_pointindex, edesig_qa, edesig_schema, edesig_shapefile
+
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+
+SUMMARY_FILENAME = 'backfill_summary_{}.csv'
+
+ReleaseTask = collections.namedtuple('ReleaseTask', ['filename', 'path', 'release_date', 'index_path',
+                                                     'output_path', 'prj', 'qa'])
+
+ReleaseResult = collections.namedtuple('ReleaseResult', ['filename', 'release_date', 'status', 'rows_read',
+                                                         'rows_dropped', 'mappluto', 'taxlot', 'unmatched',
+                                                         'no_geometry', 'points', 'qa_issues', 'seconds', 'error'])
+
+SUMMARY_COLUMNS = [('RELEASE', 'filename'), ('DATE', 'release_date'), ('STATUS', 'status'), ('READ', 'rows_read'),
+                   ('DROPPED', 'rows_dropped'), ('MAPPLUTO', 'mappluto'), ('TAXLOT', 'taxlot'),
+                   ('UNMATCHED', 'unmatched'), ('NO_GEOMETRY', 'no_geometry'), ('POINTS', 'points'),
+                   ('QA_ISSUES', 'qa_issues'), ('SECONDS', 'seconds'), ('ERROR', 'error')]
+
+# Point index and QA lot layers opened by this process, by index path. Workers keep them across the releases they
+# are handed, so the STR trees are only built once per worker.
+
+_opened = {}
+
+
+def release_output_path(output_path, release_date):
+    '''Return the directory the outputs of the release dated release_date (YYYYMMDD) are written to.'''
+
+    return os.path.join(output_path, 'nyedes_{}'.format(release_date))
+
+
+def release_tasks(entries, archive_manifest, index_path, output_path, prj=None, qa=True, input_paths=None):
+    '''
+    Return a ReleaseTask for each ManifestEntry in entries. input_paths, if given, are the paths each export is read
+    from (such as local staged copies) instead of the archive. Raises ValueError if two entries share a release date,
+    since their outputs would have the same name.
+    '''
+
+    dates = collections.Counter(entry.release_date for entry in entries)
+    duplicates = sorted(release_date for release_date, count in dates.items() if count > 1)
+    if duplicates:
+        raise ValueError("More than one archived export for release date(s) {}. Pass the files to backfill "
+                         "explicitly.".format(", ".join(duplicates)))
+    if input_paths is None:
+        input_paths = [archive_manifest.path(entry) for entry in entries]
+    return [ReleaseTask(entry.filename, input_path, entry.release_date, index_path,
+                        release_output_path(output_path, entry.release_date), prj, qa)
+            for entry, input_path in zip(entries, input_paths)]
+
+
+def _open_index(index_path, qa):
+    if index_path not in _opened:
+        index = edesig_pointindex.PointIndex.load(index_path)
+        _opened[index_path] = (index, None)
+    index, lot_layers = _opened[index_path]
+    if qa and lot_layers is None:
+        lot_layers = [edesig_qa.LotLayer(edesig_join.SOURCE_NAMES[source_code], lot_bbl, lot_polygons)
+                      for source_code, lot_bbl, lot_polygons in index.load_lots()]
+        _opened[index_path] = (index, lot_layers)
+    return index, lot_layers
+
+
+def _save_array(path, array):
+    # Write a .npy file under a temporary name and rename it into place once complete.
+
+    with open(path + '.tmp', 'wb') as array_file:
+        np.save(array_file, array)
+    edesig_manifest.replace_file(path + '.tmp', path)
+
+
+def generate_release(task):
+    '''Generate the release described by a ReleaseTask. Returns a ReleaseResult; errors are caught and reported.'''
+
+    started = time.time()
+    report = edesig_ingest.IngestReport()
+    counts = dict((name, 0) for name in ReleaseResult._fields
+                  if name not in ('filename', 'release_date', 'status', 'seconds', 'error'))
+    try:
+        index, lot_layers = _open_index(task.index_path, task.qa)
+        if not os.path.isdir(task.output_path):
+            os.makedirs(task.output_path)
+        base_name = 'nyedes_{}'.format(task.release_date)
+
+        matched, unmatched = edesig_pointindex.locate_chunks(edesig_ingest.read_edesig_chunks(task.path, report),
+                                                             index, columns=edesig_schema.source_columns())
+        counts['rows_read'] = report.rows_read
+        counts['rows_dropped'] = report.rows_dropped
+        counts['unmatched'] = len(unmatched)
+        if report.issues:
+            report.write(os.path.join(task.output_path, '{}_ingest_issues.csv'.format(
+                os.path.splitext(task.filename)[0])))
+        if len(unmatched):
+            unmatched.to_csv(os.path.join(task.output_path, 'EDES_NoMatchBBL.csv'))
+        if not len(matched):
+            raise ValueError("No E-Designation record matched a lot")
+
+        counts['mappluto'] = int((matched['SOURCE'] == edesig_join.SOURCE_MAPPLUTO).sum())
+        counts['taxlot'] = int((matched['SOURCE'] == edesig_join.SOURCE_TAXLOT).sum())
+        point_x = matched['POINT_X'].values
+        point_y = matched['POINT_Y'].values
+        has_point = np.isfinite(point_x) & np.isfinite(point_y)
+        counts['no_geometry'] = int((~has_point).sum())
+
+        point_array = edesig_schema.project_points(matched[has_point], point_x[has_point], point_y[has_point],
+                                                   extra_fields=[('SOURCE', np.int16)])
+        _save_array(os.path.join(task.output_path, base_name + '.npy'), point_array)
+        counts['points'] = edesig_shapefile.write_points([os.path.join(task.output_path, base_name)],
+                                                         point_array['POINT_X'], point_array['POINT_Y'],
+                                                         point_array, edesig_schema.dbf_fields(), prj=task.prj)
+
+        if task.qa:
+            qa_report = edesig_qa.check_points(point_array['POINT_X'], point_array['POINT_Y'], point_array['BBL'],
+                                               lot_layers)
+            counts['qa_issues'] = len(qa_report.issues)
+            if not qa_report.passed:
+                qa_report.write(os.path.join(task.output_path, base_name + '_qa_issues.csv'))
+        return ReleaseResult(task.filename, task.release_date, STATUS_SUCCEEDED, seconds=time.time() - started,
+                             error=None, **counts)
+    except Exception as error:
+        print("Backfill of {0} failed: {1}".format(task.filename, error))
+        print(traceback.format_exc())
+        return ReleaseResult(task.filename, task.release_date, STATUS_FAILED, seconds=time.time() - started,
+                             error="{0}: {1}".format(type(error).__name__, error), **counts)
+
+
+def run_backfill(tasks, workers=None):
+    '''
+    Generate every task across a pool of workers processes (default: one per CPU) and return the results ordered
+    by release date. With a single worker, or a single task, releases are generated in this process.
+    '''
+
+    workers = min(len(tasks), int(workers or multiprocessing.cpu_count()))
+    results = []
+    if workers <= 1:
+        for task in tasks:
+            results.append(generate_release(task))
+            print("Backfilled {0} ({1})".format(task.filename, results[-1].status))
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(generate_release, tasks):
+                results.append(result)
+                print("Backfilled {0} ({1}), {2} of {3}".format(result.filename, result.status, len(results),
+                                                               len(tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    return sorted(results, key=lambda result: (result.release_date, result.filename))
+
+
+def _summary_value(result, name):
+    value = getattr(result, name)
+    if name == 'seconds':
+        return '{:.1f}'.format(value)
+    return '' if value is None else str(value)
+
+
+def summary_table(results):
+    '''Return a plain-text table with the counts, timing and status of every release.'''
+
+    rows = [[header for header, name in SUMMARY_COLUMNS]]
+    rows += [[_summary_value(result, name) for header, name in SUMMARY_COLUMNS] for result in results]
+    widths = [max(len(row[position]) for row in rows) for position in range(len(SUMMARY_COLUMNS) - 1)]
+    lines = ['  '.join([value.ljust(width) if position < 3 else value.rjust(width)
+                        for position, (value, width) in enumerate(zip(row, widths))] + [row[-1]]).rstrip()
+             for row in rows]
+    succeeded = len([result for result in results if result.status == STATUS_SUCCEEDED])
+    lines.append("{0} of {1} releases succeeded in {2:.1f} s of release time".format(
+        succeeded, len(results), sum(result.seconds for result in results)))
+    return '\n'.join(lines)
+
+
+def write_summary(path, results):
+    '''Write the summary of every release to a comma-delimited file.'''
+
+    with io.open(path, 'w', encoding='utf-8', newline='') as summary_file:
+        summary_file.write(u','.join(header for header, name in SUMMARY_COLUMNS) + u'\n')
+        for result in results:
+            summary_file.write(u','.join(u'"{}"'.format(_summary_value(result, name).replace('"', '""'))
+                                         if name == 'error' and result.error else _summary_value(result, name)
+                                         for header, name in SUMMARY_COLUMNS) + u'\n')
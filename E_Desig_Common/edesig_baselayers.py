@@ -0,0 +1,120 @@
+'''
+ArcPy side of the MapPLUTO and Tax Lot Polygon base layers, shared by the generation and backfill scripts.
+
+Each SDE source is fingerprinted (row count, latest edit, extent and schema) and pulled through the base-layer cache
+(see edesig_cache) only when its fingerprint changes. The latest edit date is only available with editor tracking.
+Without it, an edit that moves a lot or changes its BBL keeps the row count, extent and schema, so the fingerprint then
+also covers a digest of the object id, BBL and geometry of every row. That reads the whole layer on every run, and a
+warning says so. These functions make up the arcpy backend (see edesig_backend),
+which builds the BBL to centroid point index from the cached layers.
+
+Must be run using the Python version associated with ArcGIS Pro, since arcpy is required.
+'''
+
+import os, hashlib
+import arcpy
+import numpy as np
+
+import edesig_cache, edesig_geometry, edesig_join, edesig_schema, edesig_telemetry
+
+
+def base_layer_sources(config, section='GENERATION_PATHS'):
+    '''Return (stage name, source code, cached layer name, SDE feature class) for each base layer, in join order.'''
+
+    return [("pull_mappluto", edesig_join.SOURCE_MAPPLUTO, "MapPLUTO_UNCLIPPED",
+             os.path.join(config.get(section, 'PROD_Path'), 'GISPROD.SDE.MapPLUTO_UNCLIPPED')),
+            ("pull_taxlot", edesig_join.SOURCE_TAXLOT, "TAXLOT_POLYGON",
+             os.path.join(config.get(section, 'Cadastral_Path'), 'GISPROD.SDE.Tax_Lot_Polygon'))]
+
+
+def content_digest(source_fc, description):
+    '''Return the SHA-256 of the object id, BBL and WKB geometry of every row of source_fc, in object id order.'''
+
+    bbl_columns = set(edesig_schema.BASE_LAYER_BBL_COLUMNS.values())
+    fields = ["OID@"] + [field.name for field in description.fields if field.name in bbl_columns] + ["SHAPE@WKB"]
+    digest = hashlib.sha256()
+    order_sql = (None, 'ORDER BY {}'.format(description.OIDFieldName))
+    with arcpy.da.SearchCursor(source_fc, fields, sql_clause=order_sql) as cursor:
+        for row in cursor:
+            digest.update(repr(row[:-1]).encode('utf-8'))
+            digest.update(bytes(row[-1] or b''))
+    return digest.hexdigest()
+
+
+def source_fingerprint(source_fc):
+    '''
+    Return a fingerprint of the row count, latest edit (with editor tracking), extent and schema of source_fc. Without
+    editor tracking, a digest of the contents of every row (see content_digest) takes the place of the latest edit.
+    '''
+
+    description = arcpy.Describe(source_fc)
+    row_count = int(arcpy.GetCount_management(source_fc)[0])
+    max_edit_date = None
+    content = None
+    if getattr(description, 'editorTrackingEnabled', False) and description.editedAtFieldName:
+        edit_sql = (None, 'ORDER BY {} DESC'.format(description.editedAtFieldName))
+        with arcpy.da.SearchCursor(source_fc, [description.editedAtFieldName], sql_clause=edit_sql) as cursor:
+            for row in cursor:
+                max_edit_date = row[0]
+                break
+    else:
+        print("Warning: {} has no editor tracking. Reading every row to detect in-place edits, which is slower than "
+              "fingerprinting a layer with editor tracking enabled".format(source_fc))
+        content = content_digest(source_fc, description)
+    extent = (description.extent.XMin, description.extent.YMin, description.extent.XMax, description.extent.YMax)
+    fields = [(field.name, field.type, field.length) for field in description.fields]
+    return edesig_cache.fingerprint(row_count, max_edit_date, extent, fields, content)
+
+
+def cached_base_layer(base_layer_cache, out_name, layer_fingerprint):
+    return os.path.join(base_layer_cache.entry_path(out_name, layer_fingerprint), 'BASE.gdb', out_name)
+
+
+def pull_base_layer(base_layer_cache, source_code, source_fc, out_name, layer_fingerprint, record=None):
+    '''
+    Return the path of the cached copy of source_fc, pulling only its BBL column (see edesig_schema) into a new entry
+    on a miss. record, an edesig_telemetry.StageRecord, receives whether the cache was hit and the bytes pulled.
+    '''
+
+    pulled = []
+
+    def build(staging_path):
+        pulled.append(staging_path)
+        arcpy.CreateFileGDB_management(staging_path, 'BASE', "CURRENT")
+        fms = arcpy.FieldMappings()
+
+        fm = arcpy.FieldMap()
+        fm.addInputField(source_fc, edesig_schema.BASE_LAYER_BBL_COLUMNS[source_code])
+        fms.addFieldMap(fm)
+
+        arcpy.FeatureClassToFeatureClass_conversion(source_fc, os.path.join(staging_path, 'BASE.gdb'), out_name, "",
+                                                    fms)
+        arcpy.ClearWorkspaceCache_management()
+
+    print("Checking base-layer cache for {}".format(out_name))
+    entry_path = base_layer_cache.fetch(out_name, layer_fingerprint, build, check=lambda entry_path: arcpy.Exists(
+        os.path.join(entry_path, 'BASE.gdb', out_name)))
+    if record is not None:
+        record.cached = not pulled
+        record.bytes_written = edesig_telemetry.file_size(entry_path) if pulled else 0
+    return cached_base_layer(base_layer_cache, out_name, layer_fingerprint)
+
+
+def read_lots(source_code, base_layer, output_sr, batch_size=100000):
+    '''Return the BBL and polygon of every lot in base_layer, decoding its WKB geometry in batches.'''
+
+    lot_bbl = []
+    lot_batches = []
+    batch_wkb = []
+    with arcpy.da.SearchCursor(base_layer, [edesig_schema.BASE_LAYER_BBL_COLUMNS[source_code], "SHAPE@WKB"],
+                               spatial_reference=output_sr) as base_cursor:
+        for bbl, wkb in base_cursor:
+            lot_bbl.append(bbl)
+            batch_wkb.append(wkb)
+            if len(batch_wkb) == batch_size:
+                lot_batches.append(edesig_geometry.from_wkb(batch_wkb))
+                batch_wkb = []
+    if batch_wkb:
+        lot_batches.append(edesig_geometry.from_wkb(batch_wkb))
+    return np.array(lot_bbl, dtype=object), edesig_geometry.concatenate(lot_batches)
+
@@ -0,0 +1,109 @@
+'''
+Vectorized BBL (Borough, Block, Lot) codec shared by the E-Designation scripts.
+
+Every function works on whole NumPy arrays or pandas Series and returns int64 arrays, so BBLs never pass through a
+per-row Python object and never turn into floats when a column holds NaNs. A BBL is encoded as
+BOROCODE * 1000000000 + TAXBLOCK * 10000 + TAXLOT.
+
+Values that cannot form a valid BBL either raise a ValueError (errors='raise') or are replaced with INVALID_BBL
+(errors='coerce'). INVALID_BBL is 0, which can never match a real tax lot.
+'''
+
+import numpy as np
+import pandas as pd
+
+BBL_DTYPE = np.int64
+INVALID_BBL = 0
+
+BORO_MIN = 1
+BORO_MAX = 5
+BLOCK_MIN = 1
+BLOCK_MAX = 99999
+LOT_MIN = 1
+LOT_MAX = 9999
+
+BORO_FACTOR = 1000000000
+BLOCK_FACTOR = 10000
+
+
+def _coerce_int64(values):
+    # Convert any numeric, float-with-NaN or string column to int64 along with a mask of usable values.
+
+    values = np.asarray(values).ravel()
+    if values.dtype.kind in 'iu':
+        return values.astype(BBL_DTYPE), np.ones(len(values), dtype=bool)
+    if values.dtype.kind == 'b':
+        return values.astype(BBL_DTYPE), np.zeros(len(values), dtype=bool)
+
+    series = pd.Series(values)
+    if values.dtype.kind in 'OSU':
+        series = series.astype(str).str.strip()
+    numeric = np.asarray(pd.to_numeric(series, errors='coerce'), dtype=np.float64)
+
+    usable = np.isfinite(numeric)
+    usable[usable] = numeric[usable] == np.floor(numeric[usable])
+    return np.where(usable, numeric, 0).astype(BBL_DTYPE), usable
+
+
+def _handle_invalid(result, valid, errors, label):
+    if errors not in ('raise', 'coerce'):
+        raise ValueError("errors must be 'raise' or 'coerce', not {}".format(errors))
+    if valid.all():
+        return result
+    if errors == 'raise':
+        bad_rows = np.flatnonzero(~valid)
+        raise ValueError("{0} invalid {1} value(s) at row(s) {2}".format(len(bad_rows), label,
+                                                                        bad_rows[:10].tolist()))
+    result[~valid] = INVALID_BBL
+    return result
+
+
+def valid_parts(boro, block, lot):
+    '''Return a boolean mask of rows whose borough, block and lot are whole numbers within range.'''
+
+    boro, boro_ok = _coerce_int64(boro)
+    block, block_ok = _coerce_int64(block)
+    lot, lot_ok = _coerce_int64(lot)
+
+    return (boro_ok & block_ok & lot_ok &
+            (boro >= BORO_MIN) & (boro <= BORO_MAX) &
+            (block >= BLOCK_MIN) & (block <= BLOCK_MAX) &
+            (lot >= LOT_MIN) & (lot <= LOT_MAX))
+
+
+def encode_bbl(boro, block, lot, errors='raise'):
+    '''Build int64 BBLs from borough, block and lot columns.'''
+
+    valid = valid_parts(boro, block, lot)
+    boro = _coerce_int64(boro)[0]
+    block = _coerce_int64(block)[0]
+    lot = _coerce_int64(lot)[0]
+
+    result = boro * BORO_FACTOR + block * BLOCK_FACTOR + lot
+    return _handle_invalid(result, valid, errors, 'borough/block/lot')
+
+
+def decode_bbl(bbl):
+    '''Split int64 BBLs back into (borough, block, lot) int64 arrays.'''
+
+    bbl = np.asarray(bbl, dtype=BBL_DTYPE)
+    boro, remainder = np.divmod(bbl, BORO_FACTOR)
+    block, lot = np.divmod(remainder, BLOCK_FACTOR)
+    return boro, block, lot
+
+
+def valid_bbl(bbl):
+    '''Return a boolean mask of int64 BBLs whose decoded parts fall within range.'''
+
+    return valid_parts(*decode_bbl(bbl))
+
+
+def parse_bbl(values, errors='raise'):
+    '''
+    Normalize an already-encoded BBL column (text, double or integer, as found on MapPLUTO and Tax Lot Polygon) to
+    validated int64 BBLs.
+    '''
+
+    result, usable = _coerce_int64(values)
+    valid = usable & valid_bbl(result)
+    return _handle_invalid(result, valid, errors, 'BBL')
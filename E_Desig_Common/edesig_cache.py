@@ -0,0 +1,185 @@
+'''
+Content-addressed cache of the MapPLUTO and Tax Lot Polygon base-layer pulls.
+
+Each cached pull is stored under {cache_path}/{layer}/{fingerprint}, where the fingerprint summarizes the version of
+the source layer (row count, latest edit date, extent and schema). The cache lives outside the disposable temporary
+directory, so an unchanged base layer is re-used across releases, while a changed source produces a new fingerprint
+and is always pulled again. Stale geometry is therefore never re-used silently.
+
+Entries are built in a staging directory and renamed into place only once complete, so a crashed pull never leaves
+a half-written entry behind. Entries are evicted least-recently-used first whenever the cache grows beyond its size
+cap.
+'''
+
+import os, json, time, shutil, hashlib, datetime, threading
+
+import edesig_manifest
+
+CACHE_INDEX_FILENAME = 'cache_index.json'
+COMPLETE_MARKER = 'COMPLETE'
+
+
+def fingerprint(row_count, max_edit_date=None, extent=None, fields=None, content=None):
+    '''
+    Return a short hex fingerprint of a source layer's version. content is a digest of the layer's rows, for sources
+    whose edits are not otherwise visible.
+    '''
+
+    if isinstance(max_edit_date, (datetime.date, datetime.datetime)):
+        max_edit_date = max_edit_date.isoformat()
+    version = {
+        'row_count': row_count,
+        'max_edit_date': max_edit_date,
+        'extent': list(extent) if extent is not None else None,
+        'fields': [list(field) for field in fields or []],
+    }
+    if content is not None:
+        version['content'] = content
+    contents = json.dumps(version, sort_keys=True)
+    return hashlib.sha1(contents.encode('utf-8')).hexdigest()[:16]
+
+
+def directory_size(path):
+    '''Return the total size in bytes of every file below path.'''
+
+    total = 0
+    for directory, subdirectories, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(directory, filename))
+    return total
+
+
+class BaseLayerCache(object):
+    '''LRU, size-capped cache of base-layer pulls keyed by (layer, fingerprint).'''
+
+    def __init__(self, cache_path, max_bytes):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_path, CACHE_INDEX_FILENAME)
+
+        # Layers may be pulled from concurrent pipeline stages, so every read-modify-write of entries, and every index
+        # write, holds this lock. It is reentrant so that those methods can save the index while holding it.
+
+        self._lock = threading.RLock()
+        self._in_use = set()
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        self.entries = self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as index_file:
+                return json.load(index_file)
+        except ValueError:
+            print("Base-layer cache index is unreadable. Starting a new index")
+            return {}
+
+    def _save_index(self):
+        with self._lock:
+            temp_index_path = self.index_path + '.tmp'
+            with open(temp_index_path, 'w') as index_file:
+                json.dump(dict(self.entries), index_file, indent=1, sort_keys=True)
+            edesig_manifest.replace_file(temp_index_path, self.index_path)
+
+    @staticmethod
+    def _key(layer, layer_fingerprint):
+        return '{0}/{1}'.format(layer, layer_fingerprint)
+
+    def entry_path(self, layer, layer_fingerprint):
+        return os.path.join(self.cache_path, layer, layer_fingerprint)
+
+    def get(self, layer, layer_fingerprint):
+        '''Return the path of a complete cached entry and mark it as used, or None on a miss.'''
+
+        key = self._key(layer, layer_fingerprint)
+        path = self.entry_path(layer, layer_fingerprint)
+        with self._lock:
+            if key not in self.entries or not os.path.exists(os.path.join(path, COMPLETE_MARKER)):
+                if key in self.entries:
+                    del self.entries[key]
+                    self._save_index()
+                return None
+
+            self.entries[key]['last_used'] = time.time()
+            self._in_use.add(key)
+            self._save_index()
+        return path
+
+    def put(self, layer, layer_fingerprint, build):
+        '''
+        Build a new entry by calling build(staging_path), which must write the pulled layer into staging_path, then
+        move it into place, record it and evict older entries if the cache is over its size cap.
+        '''
+
+        path = self.entry_path(layer, layer_fingerprint)
+        staging_path = '{0}.staging.{1}'.format(path, os.getpid())
+        if os.path.exists(staging_path):
+            shutil.rmtree(staging_path)
+        os.makedirs(staging_path)
+
+        build(staging_path)
+        with open(os.path.join(staging_path, COMPLETE_MARKER), 'w') as marker:
+            marker.write(layer_fingerprint)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(staging_path, path)
+
+        size = directory_size(path)
+        with self._lock:
+            self.entries[self._key(layer, layer_fingerprint)] = {
+                'layer': layer,
+                'fingerprint': layer_fingerprint,
+                'size': size,
+                'created': time.time(),
+                'last_used': time.time(),
+            }
+            self._in_use.add(self._key(layer, layer_fingerprint))
+            self._save_index()
+            self.evict()
+        return path
+
+    def fetch(self, layer, layer_fingerprint, build, check=None):
+        '''
+        Return the cached entry for (layer, fingerprint), building it with build(staging_path) on a miss. If given,
+        check(path) must return True for a cached entry to be used; an entry that fails it is built again.
+        '''
+
+        path = self.get(layer, layer_fingerprint)
+        if path is not None and check is not None and not check(path):
+            print("Cached {0} for fingerprint {1} is incomplete".format(layer, layer_fingerprint))
+            path = None
+        if path is not None:
+            print("{0} is cached for fingerprint {1}. Skipping pull".format(layer, layer_fingerprint))
+            return path
+        print("{0} is not cached for fingerprint {1}. Pulling from source".format(layer, layer_fingerprint))
+        return self.put(layer, layer_fingerprint, build)
+
+    def total_size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def evict(self, keep=()):
+        '''
+        Remove least-recently-used entries until the cache fits within max_bytes. Entries in keep and entries already
+        handed out by this cache object are never removed.
+        '''
+
+        with self._lock:
+            candidates = sorted((entry['last_used'], key) for key, entry in self.entries.items()
+                                if key not in keep and key not in self._in_use)
+            evicted = []
+            for last_used, key in candidates:
+                if self.total_size() <= self.max_bytes:
+                    break
+                entry = self.entries.pop(key)
+                path = self.entry_path(entry['layer'], entry['fingerprint'])
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                print("Evicted {} from base-layer cache".format(key))
+                evicted.append(key)
+            if evicted:
+                self._save_index()
+        return evicted
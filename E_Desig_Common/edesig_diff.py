@@ -0,0 +1,294 @@
+'''
+Release-to-release comparison of E-Designation exports and generated releases.
+
+Both sides are keyed by (ENUMBER, BBL). The key columns of every record are hashed into one 64-bit value and the
+sorted key hashes of the two releases are intersected, so records are classified without a row-by-row merge: keys only
+in the new release were added, keys only in the old release were removed, and keys in both are compared through a
+second hash over their remaining attributes. Only the records whose attribute hashes differ are compared column by
+column. When both sides carry point coordinates (generated releases), records whose point moved further than a
+tolerance are reported as moved.
+
+An E-Designation export is compared as read by edesig_ingest. A generated release is compared from its point array
+(the .npy saved by the generation and backfill scripts). To compare two files from the command line, run:
+
+    python edesig_diff.py OLD NEW [--output PATH] [--tolerance FEET]
+'''
+
+import io, os, sys, argparse, collections
+import numpy as np
+import pandas as pd
+
+import edesig_bbl, edesig_ingest, edesig_schema
+
+KEY_COLUMNS = ['ENUMBER', 'BBL']
+
+# Columns encoded in BBL, which would only repeat a BBL change (already a change of key)
+
+DERIVED_COLUMNS = ['BOROCODE', 'TAXBLOCK', 'TAXLOT']
+
+CHANGE_ADDED = 'added'
+CHANGE_REMOVED = 'removed'
+CHANGE_ATTRIBUTES = 'attributes'
+CHANGE_MOVED = 'moved'
+CHANGE_TYPES = (CHANGE_ADDED, CHANGE_REMOVED, CHANGE_ATTRIBUTES, CHANGE_MOVED)
+
+# Points closer than this (feet, in the State Plane coordinates of the release) are not reported as moved
+
+DEFAULT_MOVE_TOLERANCE = 0.5
+
+CHANGESET_COLUMNS = ['CHANGE', 'ENUMBER', 'BBL', 'FIELDS', 'OLD_X', 'OLD_Y', 'NEW_X', 'NEW_Y', 'DISTANCE']
+CHANGESET_FILENAME = 'nyedes_changes_{0}_{1}.csv'
+REPORT_FILENAME = 'nyedes_changes_{0}_{1}.txt'
+
+# ENUMBERs listed per change type in the summary
+
+SUMMARY_SAMPLE = 10
+
+
+def read_release(path):
+    '''Read an E-Designation export (.txt) or a generated release point array (.npy) into a DataFrame.'''
+
+    if os.path.splitext(path)[1].lower() == '.npy':
+        return pd.DataFrame(np.load(path))
+    return edesig_ingest.read_edesig(path)
+
+
+def _key_frame(frame):
+    return pd.DataFrame({'ENUMBER': frame['ENUMBER'].values.astype(object),
+                         'BBL': edesig_bbl.parse_bbl(frame['BBL'].values, errors='coerce')}, columns=KEY_COLUMNS)
+
+
+def _unique_keys(keys):
+    # Sorted unique key hashes with the first row carrying each, and the number of rows repeating a key
+
+    unique, first = np.unique(keys, return_index=True)
+    return unique, first, len(keys) - len(unique)
+
+
+def _hash_rows(frame, columns):
+    if not columns:
+        return np.zeros(len(frame), dtype=np.uint64)
+    return pd.util.hash_pandas_object(frame[columns], index=False, categorize=False).values
+
+
+def _differs(old_values, new_values):
+    # Element-wise inequality in which two missing values (NaN, NaT or None) compare equal
+
+    equal = np.asarray(old_values == new_values, dtype=bool)
+    return ~(equal | (pd.isnull(old_values) & pd.isnull(new_values)))
+
+
+class ReleaseDiff(object):
+    '''Outcome of a comparison: row positions of every added, removed, changed and moved record.'''
+
+    def __init__(self, old, new, old_label, new_label, columns, added, removed, changed, changed_fields, moved,
+                 duplicates):
+        self.old = old
+        self.new = new
+        self.old_label = old_label
+        self.new_label = new_label
+        self.columns = columns
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.changed_fields = changed_fields
+        self.moved = moved
+        self.duplicates = duplicates
+
+    @property
+    def unchanged(self):
+        return not any(self.counts().values())
+
+    def counts(self):
+        '''Return the number of records of each change type, in CHANGE_TYPES order.'''
+
+        return collections.OrderedDict(zip(CHANGE_TYPES, (len(self.added), len(self.removed), len(self.changed[0]),
+                                                          len(self.moved[0]))))
+
+    def field_counts(self):
+        '''Return the number of changed records per attribute column, most changed first.'''
+
+        counts = [(column, int(changed.sum())) for column, changed in self.changed_fields.items()]
+        return collections.OrderedDict(sorted([count for count in counts if count[1]], key=lambda count: -count[1]))
+
+    def summary(self):
+        '''Return a short plain-text summary of the changes, suitable for a notification email.'''
+
+        counts = self.counts()
+        lines = ["Changes from {0} ({1} records) to {2} ({3} records):".format(
+            self.old_label, len(self.old), self.new_label, len(self.new))]
+        if self.unchanged:
+            lines.append("  No E-Designation records were added, removed or changed")
+        else:
+            lines.append("  " + ", ".join("{0} {1}".format(count, change) for change, count in counts.items()))
+        if self.field_counts():
+            lines.append("  Attribute changes by field: " + ", ".join(
+                "{0} {1}".format(column, count) for column, count in self.field_counts().items()))
+        for change, frame, rows in ((CHANGE_ADDED, self.new, self.added), (CHANGE_REMOVED, self.old, self.removed)):
+            if len(rows):
+                enumbers = pd.unique(frame['ENUMBER'].values[rows])
+                lines.append("  {0} E-Designations: {1}{2}".format(
+                    change.capitalize(), ", ".join(str(enumber) for enumber in enumbers[:SUMMARY_SAMPLE]),
+                    " and {} more".format(len(enumbers) - SUMMARY_SAMPLE) if len(enumbers) > SUMMARY_SAMPLE else ""))
+        for label, count in ((self.old_label, self.duplicates[0]), (self.new_label, self.duplicates[1])):
+            if count:
+                lines.append("  {0} repeated (ENUMBER, BBL) keys in {1} were compared once".format(count, label))
+        return '\n'.join(lines)
+
+    def changeset(self):
+        '''Return one row per change: the change type, key, changed fields and, for moved records, the points.'''
+
+        parts = []
+        has_points = all(name in frame for frame in (self.old, self.new) for name in edesig_schema.POINT_FIELDS)
+
+        def part(change, frame, rows, fields=None, old_rows=None, new_rows=None):
+            keys = _key_frame(frame.iloc[rows])
+            part_frame = pd.DataFrame({'CHANGE': change, 'ENUMBER': keys['ENUMBER'].values,
+                                       'BBL': keys['BBL'].values, 'FIELDS': fields if fields is not None else ''},
+                                      columns=CHANGESET_COLUMNS)
+            if has_points:
+                for prefix, side, side_rows in (('OLD', self.old, old_rows), ('NEW', self.new, new_rows)):
+                    if side_rows is not None:
+                        part_frame[prefix + '_X'] = side['POINT_X'].values[side_rows]
+                        part_frame[prefix + '_Y'] = side['POINT_Y'].values[side_rows]
+            parts.append(part_frame)
+
+        changed_old_rows, changed_new_rows = self.changed
+        fields = [[] for row in changed_new_rows]
+        for column, changed in self.changed_fields.items():
+            for position in np.flatnonzero(changed):
+                fields[position].append(column)
+        moved_old_rows, moved_new_rows = self.moved
+
+        # The frame the key is read from, its rows, the changed fields and the old and new rows of each change type
+
+        change_parts = {
+            CHANGE_ADDED: (self.new, self.added, None, None, self.added),
+            CHANGE_REMOVED: (self.old, self.removed, None, self.removed, None),
+            CHANGE_ATTRIBUTES: (self.new, changed_new_rows, [';'.join(names) for names in fields], changed_old_rows,
+                                changed_new_rows),
+            CHANGE_MOVED: (self.new, moved_new_rows, None, moved_old_rows, moved_new_rows),
+        }
+        for change in CHANGE_TYPES:
+            part(change, *change_parts[change])
+
+        changeset = pd.concat(parts, ignore_index=True)
+        if has_points:
+            for column in ('OLD_X', 'OLD_Y', 'NEW_X', 'NEW_Y'):
+                changeset[column] = changeset[column].astype(np.float64)
+            changeset['DISTANCE'] = np.hypot(changeset['NEW_X'] - changeset['OLD_X'],
+                                             changeset['NEW_Y'] - changeset['OLD_Y'])
+            return changeset
+        return changeset[[column for column in CHANGESET_COLUMNS if column not in
+                          ('OLD_X', 'OLD_Y', 'NEW_X', 'NEW_Y', 'DISTANCE')]]
+
+    def write_changeset(self, path):
+        self.changeset().to_csv(path, index=False)
+
+    def write_report(self, path):
+        with io.open(path, 'w', encoding='utf-8') as report_file:
+            report_file.write(u'{}\n'.format(self.summary()))
+
+
+def compare(old, new, columns=None, tolerance=DEFAULT_MOVE_TOLERANCE, old_label='old release',
+            new_label='new release'):
+    '''
+    Compare two releases, DataFrames as returned by read_release, keyed by (ENUMBER, BBL). columns are the attributes
+    compared for records in both; by default every column the two share other than the key, the columns encoded in
+    BBL and the point coordinates. Returns a ReleaseDiff.
+    '''
+
+    old = old.reset_index(drop=True)
+    new = new.reset_index(drop=True)
+    if columns is None:
+        excluded = KEY_COLUMNS + DERIVED_COLUMNS + list(edesig_schema.POINT_FIELDS)
+        columns = [column for column in new.columns if column in old.columns and column not in excluded]
+
+    old_keys = _key_frame(old)
+    new_keys = _key_frame(new)
+    old_unique, old_first, old_duplicates = _unique_keys(_hash_rows(old_keys, KEY_COLUMNS))
+    new_unique, new_first, new_duplicates = _unique_keys(_hash_rows(new_keys, KEY_COLUMNS))
+
+    # Set operations over the sorted key hashes. A hash collision between different keys is caught by comparing the
+    # keys of every matched pair, and treated as a removal and an addition.
+
+    common, old_position, new_position = np.intersect1d(old_unique, new_unique, assume_unique=True,
+                                                        return_indices=True)
+    old_rows = old_first[old_position]
+    new_rows = new_first[new_position]
+    same_key = ((old_keys['ENUMBER'].values[old_rows] == new_keys['ENUMBER'].values[new_rows]) &
+                (old_keys['BBL'].values[old_rows] == new_keys['BBL'].values[new_rows]))
+    old_only = np.ones(len(old_unique), dtype=bool)
+    old_only[old_position[same_key]] = False
+    new_only = np.ones(len(new_unique), dtype=bool)
+    new_only[new_position[same_key]] = False
+    old_rows = old_rows[same_key]
+    new_rows = new_rows[same_key]
+
+    # Attribute hashes decide which matched records changed; only those are compared column by column
+
+    changed = np.flatnonzero(_hash_rows(old, columns)[old_rows] != _hash_rows(new, columns)[new_rows])
+    changed_fields = collections.OrderedDict(
+        (column, _differs(old[column].values[old_rows[changed]], new[column].values[new_rows[changed]]))
+        for column in columns)
+
+    # Hashes also differ when a column's dtype does, so keep only records with a changed value
+
+    differs = np.zeros(len(changed), dtype=bool)
+    for column_differs in changed_fields.values():
+        differs |= column_differs
+    changed = changed[differs]
+    for column in columns:
+        changed_fields[column] = changed_fields[column][differs]
+    changed_old = old_rows[changed]
+    changed_new = new_rows[changed]
+
+    moved_old = moved_new = np.empty(0, dtype=np.int64)
+    if all(name in frame for frame in (old, new) for name in edesig_schema.POINT_FIELDS):
+        distance = np.hypot(new['POINT_X'].values[new_rows] - old['POINT_X'].values[old_rows],
+                            new['POINT_Y'].values[new_rows] - old['POINT_Y'].values[old_rows])
+        one_missing = np.isnan(new['POINT_X'].values[new_rows]) != np.isnan(old['POINT_X'].values[old_rows])
+        moved = np.flatnonzero((distance > tolerance) | one_missing)
+        moved_old = old_rows[moved]
+        moved_new = new_rows[moved]
+
+    return ReleaseDiff(old, new, old_label, new_label, columns, np.sort(new_first[new_only]),
+                       np.sort(old_first[old_only]), (changed_old, changed_new), changed_fields,
+                       (moved_old, moved_new), (old_duplicates, new_duplicates))
+
+
+def compare_files(old_path, new_path, columns=None, tolerance=DEFAULT_MOVE_TOLERANCE):
+    '''Compare two exports or two generated releases by path, labelling each side with its filename.'''
+
+    return compare(read_release(old_path), read_release(new_path), columns, tolerance,
+                   os.path.basename(old_path), os.path.basename(new_path))
+
+
+def write_diff(diff, output_path, old_name, new_name):
+    '''Write the change report and changeset of diff into output_path. Returns (report path, changeset path).'''
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    report_path = os.path.join(output_path, REPORT_FILENAME.format(old_name, new_name))
+    changeset_path = os.path.join(output_path, CHANGESET_FILENAME.format(old_name, new_name))
+    diff.write_report(report_path)
+    diff.write_changeset(changeset_path)
+    return report_path, changeset_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare two E-Designation exports or generated releases")
+    parser.add_argument('old', help="earlier export (.txt) or release point array (.npy)")
+    parser.add_argument('new', help="later export (.txt) or release point array (.npy)")
+    parser.add_argument('--output', help="directory to write the change report and changeset to")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_MOVE_TOLERANCE,
+                        help="distance in feet a point must move to be reported as moved")
+    args = parser.parse_args()
+
+    release_diff = compare_files(args.old, args.new, tolerance=args.tolerance)
+    print(release_diff.summary())
+    if args.output:
+        for path in write_diff(release_diff, args.output, os.path.splitext(os.path.basename(args.old))[0],
+                               os.path.splitext(os.path.basename(args.new))[0]):
+            print("Written {}".format(path))
+    sys.exit(0 if release_diff.unchanged else 1)
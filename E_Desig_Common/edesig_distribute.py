@@ -0,0 +1,133 @@
+'''
+Concurrent fan-out of independent distribution targets.
+
+Every distribution target (the raw text copy, the Bytes shapefile, the SDE load, the layer metadata exports, ...) reads
+the same finished nyedes_{date} dataset and writes somewhere else, often a slow network share. The executor runs the
+targets in a bounded pool of threads, retries each failed target on its own with an increasing delay, and reports
+the outcome of every target. A slow or failed target therefore neither blocks nor aborts the others.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import time, traceback, collections
+from multiprocessing.pool import ThreadPool
+
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+
+TargetResult = collections.namedtuple('TargetResult', ['name', 'status', 'attempts', 'duration', 'error'])
+
+
+class DistributionFailed(Exception):
+    '''Raised by DistributionExecutor.check when one or more targets failed after all of their attempts.'''
+
+    def __init__(self, results):
+        Exception.__init__(self, "Distribution target(s) failed: {}".format(
+            "; ".join("{0} ({1})".format(result.name, result.error) for result in results)))
+        self.results = results
+
+
+class Target(object):
+    '''
+    A named distribution target. func() publishes the target. cleanup(), if given, is called before each retry to
+    remove anything a failed attempt left behind.
+    '''
+
+    def __init__(self, name, func, cleanup=None, retries=None):
+        self.name = name
+        self.func = func
+        self.cleanup = cleanup
+        self.retries = retries
+
+
+class DistributionExecutor(object):
+    '''
+    Runs distribution targets concurrently, with per-target retry and a per-target status report. If an
+    edesig_telemetry.Telemetry is given, every target is recorded in it.
+    '''
+
+    def __init__(self, max_workers=4, retries=2, retry_delay=30, telemetry=None):
+        self.max_workers = max(1, int(max_workers))
+        self.telemetry = telemetry
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.targets = []
+        self.results = []
+
+    def add(self, name, func, cleanup=None, retries=None):
+        '''Add a target. retries overrides the executor's default number of retries for this target.'''
+
+        if name in [target.name for target in self.targets]:
+            raise ValueError("Target {} is already defined".format(name))
+        target = Target(name, func, cleanup, retries)
+        self.targets.append(target)
+        return target
+
+    def _publish(self, target):
+        if self.telemetry is None:
+            return self._attempt(target)
+        with self.telemetry.stage(target.name) as record:
+            result = self._attempt(target)
+            record.extra['attempts'] = result.attempts
+            if result.status != STATUS_SUCCEEDED:
+                record.status = 'failed'
+                record.error = result.error
+        return result
+
+    def _attempt(self, target):
+        retries = self.retries if target.retries is None else target.retries
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                print("Publishing {0} (attempt {1})".format(target.name, attempt))
+                target.func()
+                print("Published {}".format(target.name))
+                return TargetResult(target.name, STATUS_SUCCEEDED, attempt, time.time() - started, None)
+            except Exception as error:
+                print("{0} failed on attempt {1}: {2}".format(target.name, attempt, error))
+                print(traceback.format_exc())
+                if attempt > retries:
+                    return TargetResult(target.name, STATUS_FAILED, attempt, time.time() - started,
+                                        "{0}: {1}".format(type(error).__name__, error))
+            time.sleep(self.retry_delay * attempt)
+            if target.cleanup is not None:
+                try:
+                    target.cleanup()
+                except Exception as error:
+                    print("Clean-up of {0} failed: {1}".format(target.name, error))
+
+    def run(self):
+        '''Publish every target and return their results in the order the targets were added.'''
+
+        pool = ThreadPool(min(self.max_workers, max(1, len(self.targets))))
+        try:
+            self.results = pool.map(self._publish, self.targets, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return self.results
+
+    @property
+    def failed(self):
+        return [result for result in self.results if result.status != STATUS_SUCCEEDED]
+
+    def report(self):
+        '''Return a plain-text table with the status, attempts and duration of every target.'''
+
+        width = max([len('Target')] + [len(result.name) for result in self.results])
+        lines = ['{0}  {1:<9}  {2:>8}  {3:>9}'.format('Target'.ljust(width), 'Status', 'Attempts', 'Seconds')]
+        for result in self.results:
+            line = '{0}  {1:<9}  {2:>8}  {3:>9.1f}'.format(result.name.ljust(width), result.status, result.attempts,
+                                                           result.duration)
+            if result.error:
+                line += '  ' + result.error
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def check(self):
+        '''Raise DistributionFailed if any target failed.'''
+
+        if self.failed:
+            raise DistributionFailed(self.failed)
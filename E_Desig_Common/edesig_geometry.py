@@ -0,0 +1,452 @@
+'''
+Flat-array polygon geometry and vectorized centroid engine.
+
+Polygons are held as flat NumPy arrays in the layout used by GeoArrow: one (N, 2) float64 coordinate array plus three
+offset arrays. ring_offsets indexes coords, part_offsets indexes rings and geom_offsets indexes parts, so that
+geometry g consists of parts geom_offsets[g]:geom_offsets[g + 1], and so on. The first ring of every part is its
+exterior ring and any further rings are holes. Ring orientation and closure do not matter.
+
+centroids() computes area-weighted centroids for every polygon (multipart and holes included) in a few batched passes
+over all vertices at once. With inside=True it guarantees that each point falls within its polygon, like
+FeatureToPoint with the INSIDE option, moving every centroid that falls outside in the same kind of batched passes.
+'''
+
+import struct
+import numpy as np
+
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+
+POLYGON_ARRAYS = ('coords', 'ring_offsets', 'part_offsets', 'geom_offsets')
+
+
+class FlatPolygons(object):
+    '''A batch of polygons stored as a coordinate array and ring/part/geometry offset arrays.'''
+
+    def __init__(self, coords, ring_offsets, part_offsets, geom_offsets):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self.part_offsets = np.asarray(part_offsets, dtype=np.int64)
+        self.geom_offsets = np.asarray(geom_offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.geom_offsets) - 1
+
+    @property
+    def ring_count(self):
+        return len(self.ring_offsets) - 1
+
+    def ring_geometry(self):
+        '''Return the geometry index of every ring.'''
+
+        part_geometry = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.geom_offsets))
+        return np.repeat(part_geometry, np.diff(self.part_offsets))
+
+    def ring_is_exterior(self):
+        '''Return True for every ring that is the first ring of its part.'''
+
+        exterior = np.zeros(self.ring_count, dtype=bool)
+        exterior[self.part_offsets[:-1][np.diff(self.part_offsets) > 0]] = True
+        return exterior
+
+    def vertex_ranges(self):
+        '''Return the first vertex and vertex count of every geometry.'''
+
+        start = self.ring_offsets[self.part_offsets[self.geom_offsets]]
+        return start[:-1], np.diff(start)
+
+    def next_vertex(self):
+        '''Return, for every vertex, the index of the following vertex in its ring, wrapping to the ring start.'''
+
+        following = np.arange(1, len(self.coords) + 1, dtype=np.int64)
+        lengths = np.diff(self.ring_offsets)
+        non_empty = lengths > 0
+        following[self.ring_offsets[1:][non_empty] - 1] = self.ring_offsets[:-1][non_empty]
+        return following
+
+    def bounds(self):
+        '''Return (xmin, ymin, xmax, ymax) arrays for every geometry. Empty geometries get NaN bounds.'''
+
+        start, count = self.vertex_ranges()
+        result = np.full((4, len(self)), np.nan)
+        has_vertices = count > 0
+        if len(self.coords):
+            for column, axis, reduce in ((0, 0, np.minimum), (1, 1, np.minimum), (2, 0, np.maximum),
+                                         (3, 1, np.maximum)):
+                result[column][has_vertices] = reduce.reduceat(self.coords[:, axis], start[has_vertices])
+        return result[0], result[1], result[2], result[3]
+
+    def take(self, indices):
+        '''Return a new FlatPolygons holding only the geometries at indices, in that order.'''
+
+        indices = np.asarray(indices, dtype=np.int64)
+        part_counts = np.diff(self.geom_offsets)[indices]
+        parts = concatenate_ranges(self.geom_offsets[indices], part_counts)
+        ring_counts = np.diff(self.part_offsets)[parts]
+        rings = concatenate_ranges(self.part_offsets[parts], ring_counts)
+        vertex_counts = np.diff(self.ring_offsets)[rings]
+        vertices = concatenate_ranges(self.ring_offsets[rings], vertex_counts)
+        return FlatPolygons(self.coords[vertices], np.concatenate([[0], np.cumsum(vertex_counts)]),
+                            np.concatenate([[0], np.cumsum(ring_counts)]),
+                            np.concatenate([[0], np.cumsum(part_counts)]))
+
+    def geometry(self, index):
+        '''Return geometry index as a list of parts, each a list of (n, 2) ring coordinate arrays.'''
+
+        parts = []
+        for part in range(self.geom_offsets[index], self.geom_offsets[index + 1]):
+            rings = []
+            for ring in range(self.part_offsets[part], self.part_offsets[part + 1]):
+                rings.append(self.coords[self.ring_offsets[ring]:self.ring_offsets[ring + 1]])
+            parts.append(rings)
+        return parts
+
+
+def concatenate_ranges(starts, counts):
+    '''Return np.concatenate([np.arange(start, start + count) for each start/count]) without a Python loop.'''
+
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(total, dtype=np.int64) - offsets + np.repeat(np.asarray(starts, dtype=np.int64), counts)
+
+
+def from_parts(geometries):
+    '''Build FlatPolygons from a list of geometries, each a list of parts, each a list of ring coordinate arrays.'''
+
+    coords = []
+    ring_offsets = [0]
+    part_offsets = [0]
+    geom_offsets = [0]
+    for parts in geometries:
+        for rings in parts:
+            for ring in rings:
+                ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+                coords.append(ring)
+                ring_offsets.append(ring_offsets[-1] + len(ring))
+            part_offsets.append(part_offsets[-1] + len(rings))
+        geom_offsets.append(geom_offsets[-1] + len(parts))
+    coords = np.concatenate(coords) if coords else np.zeros((0, 2))
+    return FlatPolygons(coords, ring_offsets, part_offsets, geom_offsets)
+
+
+def concatenate(polygons_list):
+    '''Return one FlatPolygons holding the geometries of every FlatPolygons in polygons_list, in order.'''
+
+    coords = []
+    ring_offsets = [np.zeros(1, dtype=np.int64)]
+    part_offsets = [np.zeros(1, dtype=np.int64)]
+    geom_offsets = [np.zeros(1, dtype=np.int64)]
+    for polygons in polygons_list:
+        coords.append(polygons.coords)
+        ring_offsets.append(polygons.ring_offsets[1:] + ring_offsets[-1][-1])
+        part_offsets.append(polygons.part_offsets[1:] + part_offsets[-1][-1])
+        geom_offsets.append(polygons.geom_offsets[1:] + geom_offsets[-1][-1])
+    return FlatPolygons(np.concatenate(coords) if coords else np.zeros((0, 2)), np.concatenate(ring_offsets),
+                        np.concatenate(part_offsets), np.concatenate(geom_offsets))
+
+
+def save_polygons(polygons, path_prefix):
+    '''Write the arrays of polygons to {path_prefix}_{array}.npy files.'''
+
+    for name in POLYGON_ARRAYS:
+        np.save('{0}_{1}.npy'.format(path_prefix, name), np.ascontiguousarray(getattr(polygons, name)))
+
+
+def load_polygons(path_prefix, mmap_mode='r'):
+    '''Open polygons written by save_polygons. By default the arrays are memory-mapped read-only.'''
+
+    return FlatPolygons(*[np.load('{0}_{1}.npy'.format(path_prefix, name), mmap_mode=mmap_mode)
+                          for name in POLYGON_ARRAYS])
+
+
+def _read_polygon_rings(buffer, offset, byte_order, dimensions):
+    # Read the ring count and rings of one WKB polygon body, keeping only X and Y.
+
+    ring_count = struct.unpack_from(byte_order + 'I', buffer, offset)[0]
+    offset += 4
+    rings = []
+    for ring in range(ring_count):
+        point_count = struct.unpack_from(byte_order + 'I', buffer, offset)[0]
+        offset += 4
+        values = np.frombuffer(buffer, dtype=np.dtype(np.float64).newbyteorder(byte_order),
+                               count=point_count * dimensions, offset=offset)
+        rings.append(values.reshape(point_count, dimensions)[:, :2].astype(np.float64))
+        offset += point_count * dimensions * 8
+    return rings, offset
+
+
+def _read_wkb_header(buffer, offset):
+    byte_order = '<' if struct.unpack_from('B', buffer, offset)[0] == 1 else '>'
+    geometry_type = struct.unpack_from(byte_order + 'I', buffer, offset + 1)[0]
+
+    # ISO WKB adds 1000/2000/3000 for Z/M/ZM. EWKB sets the high bits instead.
+    dimensions = 2
+    if geometry_type & 0x80000000:
+        dimensions += 1
+    if geometry_type & 0x40000000:
+        dimensions += 1
+    geometry_type &= 0x0FFFFFFF
+    dimensions += {0: 0, 1: 1, 2: 1, 3: 2}[geometry_type // 1000]
+    return byte_order, geometry_type % 1000, dimensions, offset + 5
+
+
+def from_wkb(wkb_geometries):
+    '''Build FlatPolygons from WKB Polygon or MultiPolygon byte strings. None becomes an empty geometry.'''
+
+    geometries = []
+    for wkb in wkb_geometries:
+        if wkb is None:
+            geometries.append([])
+            continue
+        buffer = bytes(wkb)
+        byte_order, geometry_type, dimensions, offset = _read_wkb_header(buffer, 0)
+        if geometry_type == WKB_POLYGON:
+            rings, offset = _read_polygon_rings(buffer, offset, byte_order, dimensions)
+            geometries.append([rings] if rings else [])
+        elif geometry_type == WKB_MULTIPOLYGON:
+            polygon_count = struct.unpack_from(byte_order + 'I', buffer, offset)[0]
+            offset += 4
+            parts = []
+            for polygon in range(polygon_count):
+                part_byte_order, part_type, part_dimensions, offset = _read_wkb_header(buffer, offset)
+                rings, offset = _read_polygon_rings(buffer, offset, part_byte_order, part_dimensions)
+                if rings:
+                    parts.append(rings)
+            geometries.append(parts)
+        else:
+            raise ValueError("WKB geometry type {} is not a polygon".format(geometry_type))
+    return from_parts(geometries)
+
+
+def _write_polygon(rings):
+    chunks = [struct.pack('<BII', 1, WKB_POLYGON, len(rings))]
+    for ring in rings:
+        if len(ring) and (ring[0] != ring[-1]).any():
+            ring = np.vstack([ring, ring[:1]])
+        chunks.append(struct.pack('<I', len(ring)))
+        chunks.append(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+    return b''.join(chunks)
+
+
+def to_wkb(polygons):
+    '''
+    Return little-endian WKB for every geometry: a Polygon for single-part geometries, a MultiPolygon otherwise, and
+    None for empty geometries. Rings are closed if they are not already.
+    '''
+
+    wkb_geometries = []
+    for index in range(len(polygons)):
+        parts = polygons.geometry(index)
+        if not parts:
+            wkb_geometries.append(None)
+        elif len(parts) == 1:
+            wkb_geometries.append(_write_polygon(parts[0]))
+        else:
+            wkb_geometries.append(struct.pack('<BII', 1, WKB_MULTIPOLYGON, len(parts)) +
+                                  b''.join(_write_polygon(rings) for rings in parts))
+    return wkb_geometries
+
+
+def centroids(polygons, inside=False):
+    '''
+    Return (x, y) arrays of the area-weighted centroid of every polygon. Holes are subtracted whatever their ring
+    orientation. Polygons with no area fall back to the mean of their vertices and empty polygons get NaN. With
+    inside=True, any centroid that falls outside its polygon is replaced by a point guaranteed to lie inside it.
+    '''
+
+    geometry_count = len(polygons)
+    if not geometry_count:
+        return np.zeros(0), np.zeros(0)
+
+    coords = polygons.coords
+    ring_lengths = np.diff(polygons.ring_offsets)
+    ring_of_vertex = np.repeat(np.arange(polygons.ring_count, dtype=np.int64), ring_lengths)
+    following = polygons.next_vertex()
+
+    # Work relative to each ring's first vertex to keep the cross products small for State Plane coordinates.
+
+    ring_origin = np.zeros((polygons.ring_count, 2))
+    non_empty = ring_lengths > 0
+    ring_origin[non_empty] = coords[polygons.ring_offsets[:-1][non_empty]]
+    local = coords - ring_origin[ring_of_vertex]
+    local_next = local[following]
+
+    cross = local[:, 0] * local_next[:, 1] - local_next[:, 0] * local[:, 1]
+    ring_area = np.bincount(ring_of_vertex, cross, polygons.ring_count) / 2.0
+    ring_moment_x = np.bincount(ring_of_vertex, (local[:, 0] + local_next[:, 0]) * cross, polygons.ring_count) / 6.0
+    ring_moment_y = np.bincount(ring_of_vertex, (local[:, 1] + local_next[:, 1]) * cross, polygons.ring_count) / 6.0
+
+    # Exterior rings add area and holes subtract it, regardless of the direction each ring was digitized in.
+
+    orientation = np.sign(ring_area) * np.where(polygons.ring_is_exterior(), 1.0, -1.0)
+    ring_geometry = polygons.ring_geometry()
+    area = np.bincount(ring_geometry, orientation * ring_area, geometry_count)
+    moment_x = np.bincount(ring_geometry, orientation * (ring_moment_x + ring_area * ring_origin[:, 0]), geometry_count)
+    moment_y = np.bincount(ring_geometry, orientation * (ring_moment_y + ring_area * ring_origin[:, 1]), geometry_count)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = moment_x / area
+        y = moment_y / area
+
+        degenerate = ~(np.abs(area) > 0)
+        if degenerate.any():
+            vertex_geometry = ring_geometry[ring_of_vertex]
+            vertex_count = np.bincount(vertex_geometry, minlength=geometry_count)
+            x[degenerate] = (np.bincount(vertex_geometry, coords[:, 0], geometry_count) / vertex_count)[degenerate]
+            y[degenerate] = (np.bincount(vertex_geometry, coords[:, 1], geometry_count) / vertex_count)[degenerate]
+
+    if inside:
+        x, y = _move_inside(polygons, x, y)
+    return x, y
+
+
+def points_in_polygons(polygons, x, y, geometry_index=None):
+    '''
+    Return True for each point (x[i], y[i]) that lies inside polygon geometry_index[i] (default: polygon i), using
+    even-odd ray casting over every edge of that polygon in one batched pass.
+    '''
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if geometry_index is None:
+        geometry_index = np.arange(len(x), dtype=np.int64)
+    geometry_index = np.asarray(geometry_index, dtype=np.int64)
+
+    start, count = polygons.vertex_ranges()
+    pair_count = count[geometry_index]
+    pair = np.repeat(np.arange(len(x), dtype=np.int64), pair_count)
+    vertex = concatenate_ranges(start[geometry_index], pair_count)
+    following = polygons.next_vertex()[vertex]
+
+    xi, yi = polygons.coords[vertex, 0], polygons.coords[vertex, 1]
+    xj, yj = polygons.coords[following, 0], polygons.coords[following, 1]
+    px, py = x[pair], y[pair]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        straddles = (yi > py) != (yj > py)
+        crossing_x = (xj - xi) * (py - yi) / (yj - yi) + xi
+        crosses = straddles & (px < crossing_x)
+
+    crossings = np.bincount(pair, crosses, len(x))
+    return (crossings % 2) == 1
+
+
+def polygon_distances(polygons, x, y, geometry_index=None):
+    '''
+    Return the distance from each point (x[i], y[i]) to polygon geometry_index[i] (default: polygon i): 0 where the
+    point lies inside the polygon, the distance to its nearest edge otherwise, and infinity for empty polygons.
+    '''
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if geometry_index is None:
+        geometry_index = np.arange(len(x), dtype=np.int64)
+    geometry_index = np.asarray(geometry_index, dtype=np.int64)
+
+    start, count = polygons.vertex_ranges()
+    pair_count = count[geometry_index]
+    vertex = concatenate_ranges(start[geometry_index], pair_count)
+    following = polygons.next_vertex()[vertex]
+    pair = np.repeat(np.arange(len(x), dtype=np.int64), pair_count)
+
+    xi, yi = polygons.coords[vertex, 0], polygons.coords[vertex, 1]
+    dx = polygons.coords[following, 0] - xi
+    dy = polygons.coords[following, 1] - yi
+    px, py = x[pair], y[pair]
+    length_squared = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        along = np.where(length_squared > 0, ((px - xi) * dx + (py - yi) * dy) / length_squared, 0.0)
+    along = np.clip(along, 0.0, 1.0)
+    edge_distance = np.hypot(xi + along * dx - px, yi + along * dy - py)
+
+    result = np.full(len(x), np.inf)
+    has_edges = pair_count > 0
+    if has_edges.any():
+        result[has_edges] = np.minimum.reduceat(edge_distance, (np.cumsum(pair_count) - pair_count)[has_edges])
+        inside = points_in_polygons(polygons, x[has_edges], y[has_edges], geometry_index[has_edges])
+        result[np.flatnonzero(has_edges)[inside]] = 0.0
+    return result
+
+
+def _interior_points(polygons, index, near_y):
+    # For each polygon index[i], cast a horizontal line strictly between the two of its vertex heights nearest
+    # near_y[i] and return the middle of the widest span of the line that lies inside the polygon. Every polygon is
+    # handled in the same batched passes: the scanline heights are chosen from the polygons' sorted, deduplicated
+    # vertex heights, every edge is intersected with its polygon's scanline and the crossings are sorted by polygon,
+    # so consecutive crossings pair up into spans and reduceat picks the widest span of each polygon.
+
+    point_count = len(index)
+    x = np.full(point_count, np.nan)
+    y = np.full(point_count, np.nan)
+
+    start, count = polygons.vertex_ranges()
+    pair_count = count[index]
+    vertex = concatenate_ranges(start[index], pair_count)
+    if not len(vertex):
+        return x, y
+    pair = np.repeat(np.arange(point_count, dtype=np.int64), pair_count)
+    following = polygons.next_vertex()[vertex]
+    xi, yi = polygons.coords[vertex, 0], polygons.coords[vertex, 1]
+    xj, yj = polygons.coords[following, 0], polygons.coords[following, 1]
+
+    # Distinct vertex heights of each polygon in ascending order, and the position of near_y among them
+
+    order = np.lexsort((yi, pair))
+    height_pair = pair[order]
+    heights = yi[order]
+    distinct = np.ones(len(heights), dtype=bool)
+    distinct[1:] = (height_pair[1:] != height_pair[:-1]) | (heights[1:] != heights[:-1])
+    height_pair = height_pair[distinct]
+    heights = heights[distinct]
+    height_count = np.bincount(height_pair, minlength=point_count)
+    height_start = np.cumsum(height_count) - height_count
+    position = np.bincount(height_pair, heights < near_y[height_pair], point_count).astype(np.int64)
+
+    has_line = height_count >= 2
+    position = np.clip(position, 1, np.maximum(height_count - 1, 1))
+    line_y = np.full(point_count, np.nan)
+    line_y[has_line] = (heights[(height_start + position - 1)[has_line]] +
+                        heights[(height_start + position)[has_line]]) / 2.0
+
+    # Crossings of every edge with its polygon's scanline, sorted by polygon and then along the line
+
+    edge_line_y = line_y[pair]
+    straddles = (yi > edge_line_y) != (yj > edge_line_y)
+    crossing_pair = pair[straddles]
+    crossing_x = (xj[straddles] - xi[straddles]) * (edge_line_y[straddles] - yi[straddles]) / \
+        (yj[straddles] - yi[straddles]) + xi[straddles]
+    order = np.lexsort((crossing_x, crossing_pair))
+    crossing_pair = crossing_pair[order]
+    crossing_x = crossing_x[order]
+
+    # Crossings 0-1, 2-3, ... of each polygon bound the spans inside it; an unpaired last crossing is ignored
+
+    crossing_count = np.bincount(crossing_pair, minlength=point_count)
+    rank = np.arange(len(crossing_x)) - (np.cumsum(crossing_count) - crossing_count)[crossing_pair]
+    span = np.flatnonzero((rank % 2 == 0) & (rank + 1 < crossing_count[crossing_pair]))
+    if not len(span):
+        return x, y
+    span_pair = crossing_pair[span]
+    span_width = crossing_x[span + 1] - crossing_x[span]
+    span_middle = (crossing_x[span] + crossing_x[span + 1]) / 2.0
+
+    span_start = np.flatnonzero(np.r_[True, span_pair[1:] != span_pair[:-1]])
+    widest_width = np.maximum.reduceat(span_width, span_start)
+    widest = np.flatnonzero(span_width == np.repeat(widest_width, np.diff(np.r_[span_start, len(span)])))
+    first_widest = widest[np.r_[True, span_pair[widest][1:] != span_pair[widest][:-1]]]
+
+    x[span_pair[first_widest]] = span_middle[first_widest]
+    y[span_pair[first_widest]] = line_y[span_pair[first_widest]]
+    return x, y
+
+
+def _move_inside(polygons, x, y):
+    x = x.copy()
+    y = y.copy()
+    outside = np.flatnonzero(~points_in_polygons(polygons, x, y) & np.isfinite(x))
+    if len(outside):
+        x[outside], y[outside] = _interior_points(polygons, outside, y[outside])
+    return x, y
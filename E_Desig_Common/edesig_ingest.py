@@ -0,0 +1,156 @@
+'''
+Chunked, schema-typed streaming reader for the 14-column E-Designation text export.
+
+The export is read once, line by line, and handed out as typed pandas DataFrames of at most chunk_size rows, so
+memory use stays flat no matter how large the citywide file grows. ENUMBER, the HAZMAT/AIR/NOISE flags and the
+CEQR/ULURP numbers are kept as text, the four date columns are parsed once per chunk, borough/block/lot are stored as
+small integers and BBL is rebuilt with the shared BBL codec. Each chunk is indexed by the line number each row came
+from in the export.
+
+Malformed lines (wrong number of fields, non-integer borough/block/lot) are dropped and recorded in an IngestReport
+instead of aborting the run. Dates that cannot be parsed are kept as NaT and recorded in the same report.
+'''
+
+import csv, io, collections
+import numpy as np
+import pandas as pd
+
+import edesig_bbl
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# Column name and column kind of each column of the export, in file order. The fields of the release and the export
+# columns they are taken from are declared in edesig_schema.
+
+EDESIG_SCHEMA = [
+    ('ENUMBER', 'text'),
+    ('E_DATE', 'date'),
+    ('BOROCODE', 'int8'),
+    ('TAXBLOCK', 'int32'),
+    ('TAXLOT', 'int16'),
+    ('HAZMAT', 'text'),
+    ('AIR', 'text'),
+    ('NOISE', 'text'),
+    ('HAZMAT_D', 'date'),
+    ('AIR_DATE', 'date'),
+    ('NOISE_D', 'date'),
+    ('CEQR_NUM', 'text'),
+    ('ULURP_NUM', 'text'),
+    ('BBL', 'int64'),
+]
+
+EDESIG_COLUMNS = [column[0] for column in EDESIG_SCHEMA]
+TEXT_COLUMNS = [column[0] for column in EDESIG_SCHEMA if column[1] == 'text']
+DATE_COLUMNS = [column[0] for column in EDESIG_SCHEMA if column[1] == 'date']
+CODE_COLUMNS = ['BOROCODE', 'TAXBLOCK', 'TAXLOT']
+CODE_DTYPES = dict((column[0], np.dtype(column[1])) for column in EDESIG_SCHEMA if column[0] in CODE_COLUMNS)
+
+IngestIssue = collections.namedtuple('IngestIssue', ['line_number', 'column', 'reason', 'text', 'dropped'])
+
+
+class IngestReport(object):
+    '''Running tally of rows read and kept, plus every malformed line or value seen while streaming.'''
+
+    def __init__(self):
+        self.rows_read = 0
+        self.rows_kept = 0
+        self.issues = []
+
+    def add(self, line_number, column, reason, text, dropped):
+        self.issues.append(IngestIssue(line_number, column, reason, text, dropped))
+
+    @property
+    def rows_dropped(self):
+        return self.rows_read - self.rows_kept
+
+    def summary(self):
+        return "{0} rows read, {1} kept, {2} dropped, {3} issues reported".format(
+            self.rows_read, self.rows_kept, self.rows_dropped, len(self.issues))
+
+    def write(self, path):
+        '''Write every issue to a comma-delimited file for review.'''
+
+        with io.open(path, 'w', encoding='utf-8', newline='') as report_file:
+            report_file.write(u'LINE,COLUMN,REASON,DROPPED,TEXT\n')
+            for issue in sorted(self.issues, key=lambda issue: issue.line_number):
+                report_file.write(u'{0},{1},"{2}",{3},"{4}"\n'.format(
+                    issue.line_number, issue.column or '', issue.reason.replace('"', '""'),
+                    int(issue.dropped), issue.text.replace('"', '""')))
+
+
+def _type_chunk(rows, line_numbers, report, date_format):
+    # Convert one batch of raw string rows into a typed DataFrame, dropping rows whose codes are not integers.
+
+    raw = pd.DataFrame(rows, columns=EDESIG_COLUMNS, index=pd.Index(line_numbers, dtype=np.int64, name='LINE'))
+    for column in EDESIG_COLUMNS:
+        raw[column] = raw[column].str.strip()
+
+    keep = np.ones(len(raw), dtype=bool)
+    codes = {}
+    for column in CODE_COLUMNS:
+        values = np.asarray(pd.to_numeric(raw[column], errors='coerce'), dtype=np.float64)
+        info = np.iinfo(CODE_DTYPES[column])
+        ok = np.isfinite(values)
+        ok[ok] = (values[ok] == np.floor(values[ok])) & (values[ok] >= info.min) & (values[ok] <= info.max)
+        for position in np.flatnonzero(~ok & keep):
+            report.add(int(raw.index[position]), column, 'not a whole number', raw[column].iat[position], True)
+        keep &= ok
+        codes[column] = values
+
+    typed = pd.DataFrame(index=raw.index[keep])
+    for column in EDESIG_COLUMNS:
+        if column in TEXT_COLUMNS:
+            typed[column] = raw[column].values[keep]
+        elif column in DATE_COLUMNS:
+            text = raw[column].values[keep]
+            parsed = pd.to_datetime(pd.Series(text, index=typed.index), format=date_format, errors='coerce')
+            unparsed = parsed.isnull().values & (text != '')
+            for position in np.flatnonzero(unparsed):
+                report.add(int(typed.index[position]), column, 'unparseable date', text[position], False)
+            typed[column] = parsed.values.astype('datetime64[ns]')
+        elif column in CODE_COLUMNS:
+            typed[column] = codes[column][keep].astype(CODE_DTYPES[column])
+
+    typed['BBL'] = edesig_bbl.encode_bbl(typed['BOROCODE'], typed['TAXBLOCK'], typed['TAXLOT'], errors='coerce')
+    report.rows_kept += len(typed)
+    return typed
+
+
+def read_edesig_chunks(path, report=None, chunk_size=DEFAULT_CHUNK_SIZE, date_format=None, encoding='utf-8'):
+    '''
+    Stream the export at path as typed DataFrames of at most chunk_size rows. Pass an IngestReport to collect counts
+    and malformed lines. date_format is handed to pandas.to_datetime; None lets pandas infer it.
+    '''
+
+    if report is None:
+        report = IngestReport()
+
+    with io.open(path, 'r', encoding=encoding, errors='replace', newline='') as export:
+        reader = csv.reader(export)
+        rows = []
+        line_numbers = []
+        for fields in reader:
+            if not fields or (len(fields) == 1 and not fields[0].strip()):
+                continue
+            report.rows_read += 1
+            if len(fields) != len(EDESIG_COLUMNS):
+                report.add(reader.line_num, None, 'expected {0} fields, found {1}'.format(
+                    len(EDESIG_COLUMNS), len(fields)), ','.join(fields), True)
+                continue
+            rows.append(fields)
+            line_numbers.append(reader.line_num)
+            if len(rows) >= chunk_size:
+                yield _type_chunk(rows, line_numbers, report, date_format)
+                rows = []
+                line_numbers = []
+        if rows:
+            yield _type_chunk(rows, line_numbers, report, date_format)
+
+
+def read_edesig(path, report=None, date_format=None, encoding='utf-8'):
+    '''Read the whole export into one typed DataFrame. Intended for small files and for comparing releases.'''
+
+    chunks = list(read_edesig_chunks(path, report, date_format=date_format, encoding=encoding))
+    if not chunks:
+        return _type_chunk([], [], report or IngestReport(), date_format)
+    return pd.concat(chunks)
@@ -0,0 +1,118 @@
+'''
+In-process two-tier BBL hash join for E-Designation records.
+
+Each base layer (MapPLUTO, then Tax Lot Polygon) is indexed once by BBL in a hash index that maps each BBL to the row
+id (normally the OID) of the first lot carrying it. Every E-Designation row is then resolved against the tiers in
+order: rows found in MapPLUTO are taken from MapPLUTO, and only the remaining rows are looked up in Tax Lot. The
+result carries a provenance flag (SOURCE) and the matched base row id for every record, plus the unmatched residue,
+so no intermediate feature class or table has to be written to get the semi-joins. The work per release scales with
+the number of E-Designation records; the base layers are only read once to build the indexes.
+
+The generation and backfill scripts no longer use this join: they resolve records through the persistent BBL to
+centroid point index (see edesig_pointindex), which applies the same MapPLUTO-then-Tax Lot precedence. BBLIndex and
+join_chunks are kept as the reference implementation the benchmark harness times the point index against. The
+SOURCE_* provenance codes and SOURCE_NAMES defined here are shared by every module.
+'''
+
+import numpy as np
+import pandas as pd
+
+import edesig_bbl
+
+SOURCE_NONE = 0
+SOURCE_MAPPLUTO = 1
+SOURCE_TAXLOT = 2
+
+SOURCE_NAMES = {SOURCE_NONE: 'None', SOURCE_MAPPLUTO: 'MapPLUTO', SOURCE_TAXLOT: 'TaxLot'}
+
+NO_ROW = -1
+
+
+class BBLIndex(object):
+    '''Hash index from BBL to the row id of the first base-layer lot carrying that BBL.'''
+
+    def __init__(self, bbl, row_ids=None, name=None):
+        bbl = edesig_bbl.parse_bbl(bbl, errors='coerce')
+        if row_ids is None:
+            row_ids = np.arange(len(bbl), dtype=np.int64)
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+
+        valid = bbl != edesig_bbl.INVALID_BBL
+        bbl = bbl[valid]
+        row_ids = row_ids[valid]
+        first = ~pd.Index(bbl).duplicated(keep='first')
+
+        self.name = name
+        self.invalid_count = int((~valid).sum())
+        self.duplicate_count = int((~first).sum())
+        self._index = pd.Index(bbl[first])
+        self._row_ids = row_ids[first]
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, bbl):
+        '''Return the row id for each BBL in bbl, or NO_ROW where the BBL is not in the layer.'''
+
+        positions = self._index.get_indexer(np.asarray(bbl, dtype=edesig_bbl.BBL_DTYPE))
+        return np.where(positions >= 0, self._row_ids[positions], NO_ROW)
+
+
+class JoinResult(object):
+    '''Provenance (SOURCE) and matched base row id (BASE_ROW) for each resolved E-Designation row.'''
+
+    def __init__(self, source, base_row):
+        self.source = source
+        self.base_row = base_row
+
+    @property
+    def matched(self):
+        return self.source != SOURCE_NONE
+
+    def counts(self):
+        '''Return the number of rows resolved by each source, keyed by source name.'''
+
+        values, counts = np.unique(self.source, return_counts=True)
+        return dict((SOURCE_NAMES[int(value)], int(count)) for value, count in zip(values, counts))
+
+
+def resolve(bbl, tiers):
+    '''
+    Resolve int64 BBLs against tiers, an ordered list of (source code, BBLIndex) pairs. Each row is only looked up
+    in a tier if no earlier tier matched it.
+    '''
+
+    bbl = np.asarray(bbl, dtype=edesig_bbl.BBL_DTYPE)
+    source = np.full(len(bbl), SOURCE_NONE, dtype=np.int8)
+    base_row = np.full(len(bbl), NO_ROW, dtype=np.int64)
+
+    pending = np.flatnonzero(bbl != edesig_bbl.INVALID_BBL)
+    for source_code, index in tiers:
+        if not len(pending):
+            break
+        rows = index.lookup(bbl[pending])
+        found = rows != NO_ROW
+        source[pending[found]] = source_code
+        base_row[pending[found]] = rows[found]
+        pending = pending[~found]
+
+    return JoinResult(source, base_row)
+
+
+def join_chunks(chunks, tiers):
+    '''
+    Resolve a stream of typed E-Designation DataFrames (see edesig_ingest) against tiers. Returns the matched rows
+    with SOURCE and BASE_ROW columns added, and the unmatched residue, as two DataFrames.
+    '''
+
+    matched = []
+    unmatched = []
+    for chunk in chunks:
+        result = resolve(chunk['BBL'].values, tiers)
+        chunk = chunk.assign(SOURCE=result.source, BASE_ROW=result.base_row)
+        matched.append(chunk[result.matched])
+        unmatched.append(chunk[~result.matched].drop(['SOURCE', 'BASE_ROW'], axis=1))
+
+    if not matched:
+        return pd.DataFrame(), pd.DataFrame()
+    return pd.concat(matched), pd.concat(unmatched)
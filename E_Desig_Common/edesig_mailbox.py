@@ -0,0 +1,225 @@
+'''
+Mailbox access for the E-Designation Pull script.
+
+Messages are read through a small mailbox interface with a single query, messages(subject, sender, since). The
+Outlook implementation pushes the subject, sender and date filter down to the mail store with Items.Restrict, so only
+candidate messages are ever touched through COM. FakeMailbox answers the same query from a list of messages held in
+memory, so the scan can be exercised without Outlook. Running this module checks, against a FakeMailbox of 50,000
+messages, that a poll only returns and only reads the messages sent after the watermark.
+
+A watermark holding the SentOn time of the newest message already handled is persisted between runs, and each
+scheduled poll only asks for messages sent after it. A poll therefore costs about the same whatever the size of the
+inbox.
+
+Attachments are read into memory with attachment_content(), so an export can be hashed and checked against the
+archive manifest before anything is written to the archive.
+'''
+
+import os, json, bisect, shutil, datetime, tempfile, collections
+
+import edesig_manifest
+
+OUTLOOK_INBOX_FOLDER = 6
+
+# DASL property names used in the Restrict filter
+
+DASL_SUBJECT = 'urn:schemas:httpmail:subject'
+DASL_SENDER_EMAIL = 'http://schemas.microsoft.com/mapi/proptag/0x0C1F001F'
+DASL_SENT_ON = 'urn:schemas:httpmail:date'
+
+# MAPI property holding the binary contents of an attachment
+
+PR_ATTACH_DATA_BIN = 'http://schemas.microsoft.com/mapi/proptag/0x37010102'
+
+# The Restrict date filter is evaluated in UTC by the mail store, so it is widened by this margin and the exact
+# comparison against the local SentOn time is made afterwards on the few messages it returns
+
+RESTRICT_MARGIN = datetime.timedelta(days=1)
+
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+MailMessage = collections.namedtuple('MailMessage', ['subject', 'sender_email', 'sent_on', 'attachments'])
+
+
+def sent_on_datetime(sent_on):
+    '''Return a naive datetime for a COM SentOn value (a pywintypes datetime, or a string in older pywin32).'''
+
+    if isinstance(sent_on, datetime.datetime):
+        return datetime.datetime(sent_on.year, sent_on.month, sent_on.day, sent_on.hour, sent_on.minute,
+                                 sent_on.second)
+    return datetime.datetime.strptime(str(sent_on), "%m/%d/%y %H:%M:%S")
+
+
+def restrict_filter(subject=None, sender=None, since=None):
+    '''Build an Outlook DASL (@SQL) filter for subject and sender substrings and messages sent after since.'''
+
+    clauses = []
+    if subject:
+        clauses.append("\"{0}\" LIKE '%{1}%'".format(DASL_SUBJECT, subject.replace("'", "''")))
+    if sender:
+        clauses.append("\"{0}\" LIKE '%{1}%'".format(DASL_SENDER_EMAIL, sender.replace("'", "''")))
+    if since is not None:
+        clauses.append("\"{0}\" > '{1}'".format(DASL_SENT_ON, (since - RESTRICT_MARGIN).strftime('%m/%d/%Y %H:%M')))
+    return '@SQL=' + ' AND '.join(clauses) if clauses else None
+
+
+def _matches(message, subject, sender, since):
+    if subject and subject not in message.subject:
+        return False
+    if sender and sender not in message.sender_email:
+        return False
+    return since is None or message.sent_on > since
+
+
+def attachment_content(attachment):
+    '''
+    Return the contents of an attachment as bytes. Outlook attachments are read through their PropertyAccessor; one
+    too large for the property to be read that way is saved to a temporary file and read back.
+    '''
+
+    if isinstance(attachment, FakeAttachment):
+        return attachment.content
+    try:
+        return bytes(attachment.PropertyAccessor.GetProperty(PR_ATTACH_DATA_BIN))
+    except Exception:
+        temp_directory = tempfile.mkdtemp(prefix='edesig_attachment_')
+        try:
+            temp_path = os.path.join(temp_directory, 'attachment')
+            attachment.SaveAsFile(temp_path)
+            with open(temp_path, 'rb') as attachment_file:
+                return attachment_file.read()
+        finally:
+            shutil.rmtree(temp_directory)
+
+
+class OutlookMailbox(object):
+    '''Mailbox backed by an Outlook folder (the default inbox unless a folder is given).'''
+
+    def __init__(self, folder=None):
+        if folder is None:
+            import win32com.client
+            outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
+            folder = outlook.GetDefaultFolder(OUTLOOK_INBOX_FOLDER)
+        self.folder = folder
+
+    def messages(self, subject=None, sender=None, since=None):
+        '''Yield MailMessages whose subject and sender contain the given strings and that were sent after since.'''
+
+        items = self.folder.Items
+        query = restrict_filter(subject, sender, since)
+        if query is not None:
+            items = items.Restrict(query)
+
+        for item in items:
+            try:
+                message = MailMessage(item.Subject, item.SenderEmailAddress, sent_on_datetime(item.SentOn),
+                                      [item.Attachments.Item(index) for index in range(1, item.Attachments.Count + 1)])
+            # Handle messages whose properties are Unknown or contain invalid/unreadable characters
+            except (AttributeError, UnicodeEncodeError, ValueError):
+                print("A message returned an unreadable property. Skipping")
+                continue
+            if _matches(message, subject, sender, since):
+                yield message
+
+
+class FakeAttachment(object):
+    '''In-memory stand-in for an Outlook attachment.'''
+
+    def __init__(self, filename, content=b''):
+        self.FileName = filename
+        self.content = content
+
+    def SaveAsFile(self, path):
+        with open(path, 'wb') as attachment_file:
+            attachment_file.write(self.content)
+
+    def __str__(self):
+        return self.FileName
+
+
+class FakeMailbox(object):
+    '''
+    Mailbox holding MailMessages in memory. Answers the same queries as OutlookMailbox. Like a mail store answering
+    Restrict, it keeps its messages ordered by SentOn and skips those sent before since without reading them; touched
+    counts the messages actually read.
+    '''
+
+    def __init__(self, messages=()):
+        self._messages = sorted(messages, key=lambda message: message.sent_on)
+        self._sent_on = [message.sent_on for message in self._messages]
+        self.touched = 0
+
+    def add(self, subject, sender_email, sent_on, attachments=()):
+        position = bisect.bisect_right(self._sent_on, sent_on)
+        self._messages.insert(position, MailMessage(subject, sender_email, sent_on, list(attachments)))
+        self._sent_on.insert(position, sent_on)
+
+    def messages(self, subject=None, sender=None, since=None):
+        start = bisect.bisect_right(self._sent_on, since) if since is not None else 0
+        for message in self._messages[start:]:
+            self.touched += 1
+            if _matches(message, subject, sender, since):
+                yield message
+
+
+class Watermark(object):
+    '''Persisted SentOn time of the newest message already handled.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''Return the stored watermark, or None if none has been stored yet.'''
+
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as watermark_file:
+                return datetime.datetime.strptime(json.load(watermark_file)['sent_on'], WATERMARK_FORMAT)
+        except (ValueError, KeyError):
+            print("Mailbox watermark is unreadable. Scanning the whole mailbox")
+            return None
+
+    def save(self, sent_on):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as watermark_file:
+            json.dump({'sent_on': sent_on.strftime(WATERMARK_FORMAT)}, watermark_file)
+        edesig_manifest.replace_file(temp_path, self.path)
+
+
+if __name__ == '__main__':
+
+    # Self-check: a poll of a large mailbox only returns, and only reads, the messages sent after the watermark
+
+    message_count = 50000
+    newer_count = 25
+    first_sent_on = datetime.datetime(2019, 1, 1, 8, 0, 0)
+    mailbox = FakeMailbox()
+    for index in range(message_count):
+        subject = "Latest E-Designation data file as of {}".format(
+            (first_sent_on + datetime.timedelta(minutes=index)).strftime("%m/%d/%Y")) if index % 2 else "Other"
+        mailbox.add(subject, "SUSAN WONG", first_sent_on + datetime.timedelta(minutes=index),
+                    [FakeAttachment("E_GIS.txt", b"E-1,01/01/2019")])
+
+    watermark_directory = tempfile.mkdtemp(prefix='edesig_watermark_')
+    try:
+        watermark = Watermark(os.path.join(watermark_directory, 'watermark.json'))
+        watermark.save(first_sent_on + datetime.timedelta(minutes=message_count - newer_count - 1))
+        since = watermark.load()
+        found = list(mailbox.messages(since=since))
+        assert len(found) == newer_count, "{} messages returned".format(len(found))
+        assert all(message.sent_on > since for message in found)
+        assert mailbox.touched == newer_count, "{} messages read".format(mailbox.touched)
+
+        mailbox.touched = 0
+        found = list(mailbox.messages(subject="Latest", sender="SUSAN WONG", since=since))
+        assert len(found) == len([message for message in mailbox.messages(since=since) if 'Latest' in message.subject])
+        assert all('Latest' in message.subject and message.sent_on > since for message in found)
+        assert attachment_content(found[0].attachments[0]) == b"E-1,01/01/2019"
+    finally:
+        shutil.rmtree(watermark_directory)
+    print("Mailbox self-check passed: {0} of {1} messages read after the watermark".format(newer_count,
+                                                                                          message_count))
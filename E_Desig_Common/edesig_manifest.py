@@ -0,0 +1,342 @@
+'''
+Persistent manifest of the E-Designation archive directory.
+
+The archive holds one text export per release, named {prefix}_{YYYYMMDD}.txt (e.g. E_GIS_20190228.txt). Rather than
+listing the network share and re-parsing every filename on each pass, the Pull, Generation and Distribution scripts
+share a small JSON index stored in a manifest sub-directory of the archive. It records the release date, filename,
+size, modification time and SHA-256 hash of every export, plus the latest release.
+
+Every export also carries a normalized-content hash, taken over its lines with the whitespace around each field and
+blank lines removed and the lines sorted, so two exports holding the same records in a different order or with
+different padding hash alike. Together the two hashes index the archive by content: a newly received export that
+matches the latest release byte for byte, or after normalization, is recorded as an alias of that release (see
+add_alias) instead of being archived and generated again.
+
+refresh() only lists the share when the directory's own modification time has changed since the last refresh.
+Otherwise it stats the exports already indexed, since a file rewritten in place, or still being copied in when it was
+hashed, leaves the directory's modification time alone. Only files whose size or modification time changed are
+re-hashed, so answering "latest release" normally costs one stat of the directory and of each export. The index lives
+in its own sub-directory so that saving it does not change the archive directory's modification time.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, re, json, codecs, hashlib, datetime, collections
+
+MANIFEST_DIRECTORY = 'manifest'
+MANIFEST_FILENAME = 'edesig_manifest.json'
+MANIFEST_VERSION = 2
+
+# Manifest versions that are read. Entries of version 1 are brought up to date rather than rebuilt from scratch.
+
+COMPATIBLE_VERSIONS = (1, 2)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+RELEASE_FILENAME = re.compile(r'^(?P<prefix>.+)_(?P<date>\d{8})\.txt$', re.IGNORECASE)
+
+MATCH_IDENTICAL = 'identical'
+MATCH_NORMALIZED = 'normalized'
+
+
+class ManifestEntry(collections.namedtuple('ManifestEntry', ['filename', 'release_date', 'size', 'mtime', 'sha256',
+                                                             'normalized_sha256'])):
+    '''One archived export. release_date is the YYYYMMDD string taken from the filename.'''
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return os.path.splitext(self.filename)[0]
+
+    @property
+    def date(self):
+        return datetime.datetime.strptime(self.release_date, '%Y%m%d')
+
+
+def release_date_from_filename(filename):
+    '''Return the YYYYMMDD release date of an archive filename, or None if it is not an E-Designation export.'''
+
+    match = RELEASE_FILENAME.match(os.path.basename(filename))
+    if match is None:
+        return None
+    try:
+        datetime.datetime.strptime(match.group('date'), '%Y%m%d')
+    except ValueError:
+        return None
+    return match.group('date')
+
+
+# An export received again under another name and recorded against the archived release holding the same content.
+# match is MATCH_IDENTICAL for the same bytes and MATCH_NORMALIZED for the same lines in another order or padding.
+
+AliasEntry = collections.namedtuple('AliasEntry', ['filename', 'release_date', 'sha256', 'normalized_sha256',
+                                                   'canonical', 'match', 'recorded'])
+
+
+def hash_file(path):
+    '''Return the SHA-256 hex digest of the file at path, read in fixed-size blocks.'''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        block = in_file.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = in_file.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def normalized_hash(content):
+    '''
+    Return the SHA-256 hex digest of the export content (bytes) with a leading byte order mark, blank lines and the
+    whitespace around each comma-separated field removed and the lines sorted, so that exports differing only in line
+    order, line endings or padding have the same normalized hash.
+    '''
+
+    if content.startswith(codecs.BOM_UTF8):
+        content = content[len(codecs.BOM_UTF8):]
+    lines = sorted(b','.join(field.strip() for field in line.split(b',')) for line in content.splitlines()
+                   if line.strip())
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line + b'\n')
+    return digest.hexdigest()
+
+
+def hash_content(content):
+    '''Return the SHA-256 and normalized hash (see normalized_hash) of export content held in memory.'''
+
+    return hashlib.sha256(content).hexdigest(), normalized_hash(content)
+
+
+def replace_file(source, destination):
+    '''Move source over destination, replacing it. os.replace is not available on Python 2.7.'''
+
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+class ArchiveManifest(object):
+    '''Incrementally maintained index of the E-Designation exports held in archive_path.'''
+
+    def __init__(self, archive_path, manifest_path=None):
+        self.archive_path = archive_path
+        self.manifest_path = manifest_path or os.path.join(archive_path, MANIFEST_DIRECTORY, MANIFEST_FILENAME)
+        self.directory_mtime = None
+        self.latest_filename = None
+        self.files = {}
+        self.aliases = {}
+        self._load()
+
+    def _read(self):
+        # Return the directory modification time, latest filename, entries and aliases saved in the manifest file, or
+        # None if there is no readable manifest of a compatible version.
+
+        if not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                contents = json.load(manifest_file)
+        except ValueError:
+            print("Archive manifest is unreadable. Rebuilding from the archive directory")
+            return None
+        if contents.get('version') not in COMPATIBLE_VERSIONS:
+            return None
+
+        # Entries of an earlier version have no normalized hash. Forgetting the directory's modification time makes
+        # the next refresh list the archive and hash them.
+
+        directory_mtime = contents.get('directory_mtime') if contents.get('version') == MANIFEST_VERSION else None
+        files = {}
+        for record in contents.get('files', []):
+            record.setdefault('normalized_sha256', None)
+            entry = ManifestEntry(**record)
+            files[entry.filename] = entry
+        aliases = {}
+        for record in contents.get('aliases', []):
+            alias = AliasEntry(**record)
+            aliases[alias.filename] = alias
+        return directory_mtime, contents.get('latest'), files, aliases
+
+    def _load(self):
+        saved = self._read()
+        if saved is not None:
+            self.directory_mtime, self.latest_filename, self.files, self.aliases = saved
+
+    def reload(self):
+        '''Discard the in-memory index and read the manifest file again, picking up changes saved by other scripts.'''
+
+        self.directory_mtime = None
+        self.latest_filename = None
+        self.files = {}
+        self.aliases = {}
+        self._load()
+
+    def _stat_entry(self, filename, previous=None):
+        # Build an entry for filename, re-using the previous hashes when size and modification time are unchanged.
+
+        status = os.stat(os.path.join(self.archive_path, filename))
+        if previous is not None and previous.size == status.st_size and previous.mtime == status.st_mtime and \
+                previous.normalized_sha256 is not None:
+            return previous
+        with open(os.path.join(self.archive_path, filename), 'rb') as export_file:
+            sha256, normalized_sha256 = hash_content(export_file.read())
+        return ManifestEntry(filename, release_date_from_filename(filename), status.st_size, status.st_mtime, sha256,
+                             normalized_sha256)
+
+    def _update_latest(self):
+        latest = None
+        for entry in self.files.values():
+            if latest is None or (entry.release_date, entry.filename) > (latest.release_date, latest.filename):
+                latest = entry
+        self.latest_filename = latest.filename if latest is not None else None
+
+    def refresh(self, full=False):
+        '''
+        Bring the manifest up to date with the archive directory and save it if anything changed. The directory is
+        only listed when its modification time differs from the one recorded at the last refresh, or when full=True;
+        otherwise only the indexed exports are checked for a changed size or modification time.
+        '''
+
+        if not os.path.isdir(os.path.dirname(self.manifest_path)):
+            os.makedirs(os.path.dirname(self.manifest_path))
+
+        directory_mtime = os.stat(self.archive_path).st_mtime
+        if full or self.directory_mtime != directory_mtime:
+            present = set(filename for filename in os.listdir(self.archive_path)
+                          if release_date_from_filename(filename) is not None)
+        else:
+            present = set(self.files)
+
+        files = {}
+        for filename in present:
+            try:
+                files[filename] = self._stat_entry(filename, self.files.get(filename))
+            except (IOError, OSError):
+                continue
+
+        changed = files != self.files or self.directory_mtime != directory_mtime
+        self.files = files
+        self.directory_mtime = directory_mtime
+        self._update_latest()
+        if changed:
+            self.save()
+        return changed
+
+    def add(self, filename):
+        '''
+        Record a newly archived export without listing the directory again. The directory's modification time is
+        left as it was, so any other file that landed since the last refresh is still picked up by the next one.
+        '''
+
+        self.files[filename] = self._stat_entry(filename, self.files.get(filename))
+        self._update_latest()
+        self.save()
+        return self.files[filename]
+
+    def latest(self):
+        '''Return the ManifestEntry of the most recent release, or None if the archive is empty.'''
+
+        if self.latest_filename is None:
+            return None
+        return self.files[self.latest_filename]
+
+    def get(self, filename):
+        '''Return the ManifestEntry for filename, or None if it is not archived.'''
+
+        return self.files.get(filename)
+
+    def releases(self, start_date=None, end_date=None):
+        '''Return archived entries ordered by release date, optionally limited to an inclusive YYYYMMDD range.'''
+
+        entries = sorted(self.files.values(), key=lambda entry: (entry.release_date, entry.filename))
+        return [entry for entry in entries
+                if (start_date is None or entry.release_date >= start_date) and
+                (end_date is None or entry.release_date <= end_date)]
+
+    def previous(self, filename):
+        '''Return the entry of the release archived before filename, by release date, or None if there is none.'''
+
+        entries = self.releases()
+        position = [entry.filename for entry in entries].index(filename)
+        return entries[position - 1] if position > 0 else None
+
+    def find_by_hash(self, sha256):
+        '''Return every archived entry whose contents hash to sha256.'''
+
+        return [entry for entry in self.releases() if entry.sha256 == sha256]
+
+    def find_by_normalized_hash(self, normalized_sha256):
+        '''Return every archived entry whose normalized contents hash to normalized_sha256.'''
+
+        return [entry for entry in self.releases() if entry.normalized_sha256 == normalized_sha256]
+
+    def duplicate_of(self, sha256, normalized_sha256):
+        '''
+        Return (entry, match) for the most recent archived release with the same contents, MATCH_IDENTICAL for the
+        same bytes and MATCH_NORMALIZED for the same normalized contents, or (None, None) if there is none.
+        '''
+
+        for entries, match in ((self.find_by_hash(sha256), MATCH_IDENTICAL),
+                               (self.find_by_normalized_hash(normalized_sha256), MATCH_NORMALIZED)):
+            if entries:
+                return entries[-1], match
+        return None, None
+
+    def add_alias(self, filename, entry, match, sha256, normalized_sha256):
+        '''Record filename as a copy of the archived entry, without archiving it, and return the AliasEntry.'''
+
+        self.aliases[filename] = AliasEntry(filename, release_date_from_filename(filename), sha256,
+                                            normalized_sha256, entry.filename, match,
+                                            datetime.datetime.now().replace(microsecond=0).isoformat())
+        self.save()
+        return self.aliases[filename]
+
+    def path(self, entry):
+        return os.path.join(self.archive_path, entry.filename)
+
+    def _merge_saved(self):
+        # Take in the entries and aliases another script saved since this manifest was loaded, so that saving does
+        # not drop them. A saved entry whose export has since left the archive is not brought back.
+
+        saved = self._read()
+        if saved is None:
+            return
+        saved_files, saved_aliases = saved[2], saved[3]
+        for filename, entry in saved_files.items():
+            if filename not in self.files and os.path.exists(os.path.join(self.archive_path, filename)):
+                self.files[filename] = entry
+        for filename, alias in saved_aliases.items():
+            self.aliases.setdefault(filename, alias)
+        self._update_latest()
+
+    def save(self):
+        '''
+        Write the manifest atomically so a crashed run never leaves a half-written index behind. Entries and aliases
+        recorded in the file by another script since this manifest was loaded are merged in rather than overwritten.
+        '''
+
+        self._merge_saved()
+        contents = {
+            'version': MANIFEST_VERSION,
+            'directory_mtime': self.directory_mtime,
+            'latest': self.latest_filename,
+            'files': [dict(entry._asdict()) for entry in self.releases()],
+            'aliases': [dict(alias._asdict()) for filename, alias in sorted(self.aliases.items())],
+        }
+        temp_manifest_path = self.manifest_path + '.tmp'
+        with open(temp_manifest_path, 'w') as manifest_file:
+            json.dump(contents, manifest_file, indent=1, sort_keys=True)
+        replace_file(temp_manifest_path, self.manifest_path)
+
+
+def load_manifest(archive_path, manifest_path=None):
+    '''Open the manifest for archive_path and refresh it against the directory.'''
+
+    manifest = ArchiveManifest(archive_path, manifest_path)
+    manifest.refresh()
+    return manifest
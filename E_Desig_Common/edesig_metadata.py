@@ -0,0 +1,145 @@
+'''
+In-memory metadata transform chain for the E-Designation release.
+
+The FGDC metadata exported from the template feature class is loaded once and passed through a chain of in-memory
+transforms: the publication date is set, and the geoprocessing history and local storage information are removed (the
+same elements the "remove geoprocessing history" and "remove local storage info" stylesheets in ArcGIS Desktop
+remove). The result is rendered to standalone XML, and optionally to HTML, once and kept in a cache keyed on the hash
+of the template plus the publication date, so metadata that has not changed is not rebuilt. Each target then receives
+an identical copy of the rendered files.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, json, shutil, collections
+import xml.etree.ElementTree as ET
+
+import edesig_manifest
+
+METADATA_FILENAME = 'nyedes_meta_Final.xml'
+HTML_FILENAME = 'nyedes_meta_Final.html'
+RENDER_INFO_FILENAME = 'render.json'
+
+# Elements removed from the metadata root, as paths of the form 'parent/path/child'
+
+GEOPROCESSING_HISTORY_PATHS = [
+    'Esri/DataProperties/lineage',
+]
+
+LOCAL_STORAGE_PATHS = [
+    'Esri/DataProperties/itemProps/itemLocation',
+    'Esri/DataProperties/itemProps/nativeExtBox',
+    'dataIdInfo/envirDesc',
+    'idinfo/native',
+    'distinfo/stdorder/digform/digtopt/onlinopt/computer/networka',
+]
+
+RenderedMetadata = collections.namedtuple('RenderedMetadata', ['xml_path', 'html_path', 'cached'])
+
+
+def set_pubdate(root, publication_date):
+    '''Set every pubdate element to publication_date. Returns the number of elements updated.'''
+
+    updated = 0
+    for element in root.iter('pubdate'):
+        print("Date {0} will be updated to {1}".format(element.text, publication_date))
+        element.text = publication_date
+        updated += 1
+    return updated
+
+
+def strip_elements(root, paths):
+    '''Remove every element matching one of paths (relative to root). Returns the number of elements removed.'''
+
+    removed = 0
+    for path in paths:
+        parent_path, _, child_tag = path.rpartition('/')
+        parents = root.findall(parent_path) if parent_path else [root]
+        for parent in parents:
+            for child in parent.findall(child_tag):
+                parent.remove(child)
+                removed += 1
+    return removed
+
+
+def strip_geoprocessing_history(root):
+    return strip_elements(root, GEOPROCESSING_HISTORY_PATHS)
+
+
+def strip_local_storage(root):
+    return strip_elements(root, LOCAL_STORAGE_PATHS)
+
+
+def transform(tree, publication_date):
+    '''Run the full transform chain on an ElementTree in memory and return it.'''
+
+    root = tree.getroot()
+    set_pubdate(root, publication_date)
+    print("Removed {} geoprocessing history element(s)".format(strip_geoprocessing_history(root)))
+    print("Removed {} local storage element(s)".format(strip_local_storage(root)))
+    return tree
+
+
+def cache_key(template_sha256, publication_date):
+    return '{0}_{1}'.format(template_sha256[:16], publication_date)
+
+
+class MetadataCache(object):
+    '''
+    Rendered metadata keyed on template hash plus publication date. Each entry holds the standalone XML and, when a
+    renderer is given, the HTML rendered from it.
+    '''
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_path, key)
+
+    def render(self, template_path, publication_date, render_html=None):
+        '''
+        Return the rendered metadata for template_path and publication_date, building it on a cache miss.
+        render_html(xml_path, html_path), if given, renders the HTML from the transformed XML.
+        '''
+
+        template_sha256 = edesig_manifest.hash_file(template_path)
+        key = cache_key(template_sha256, publication_date)
+        path = self.entry_path(key)
+        xml_path = os.path.join(path, METADATA_FILENAME)
+        html_path = os.path.join(path, HTML_FILENAME) if render_html is not None else None
+
+        if os.path.exists(os.path.join(path, RENDER_INFO_FILENAME)) and (html_path is None or
+                                                                         os.path.exists(html_path)):
+            print("Metadata for template {0} and publication date {1} is cached. Skipping render".format(
+                template_sha256[:16], publication_date))
+            return RenderedMetadata(xml_path, html_path, True)
+
+        print("Rendering metadata for template {0} and publication date {1}".format(template_sha256[:16],
+                                                                                   publication_date))
+        staging_path = '{0}.staging.{1}'.format(path, os.getpid())
+        if os.path.exists(staging_path):
+            shutil.rmtree(staging_path)
+        os.makedirs(staging_path)
+
+        tree = transform(ET.parse(template_path), publication_date)
+        tree.write(os.path.join(staging_path, METADATA_FILENAME), encoding='UTF-8', xml_declaration=True)
+        if render_html is not None:
+            render_html(os.path.join(staging_path, METADATA_FILENAME), os.path.join(staging_path, HTML_FILENAME))
+        with open(os.path.join(staging_path, RENDER_INFO_FILENAME), 'w') as info_file:
+            json.dump({'template_sha256': template_sha256, 'publication_date': publication_date}, info_file)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(staging_path, path)
+        return RenderedMetadata(xml_path, html_path, False)
+
+
+def write_copy(source_path, destination_path):
+    '''Copy a rendered file to a target, replacing any previous copy only once the new copy is complete.'''
+
+    temp_destination_path = destination_path + '.tmp'
+    shutil.copyfile(source_path, temp_destination_path)
+    edesig_manifest.replace_file(temp_destination_path, destination_path)
+
@@ -0,0 +1,176 @@
+'''
+Persistent, memory-mapped BBL to centroid point index.
+
+Lot geometry only changes when a new MapPLUTO or Tax Lot Polygon version is published, so the centroid of every lot
+is computed once per pair of base-layer versions and stored as four parallel NumPy arrays: the sorted int64 BBLs, the
+x and y of each lot's centroid, and the source layer (MapPLUTO or Tax Lot) the point was taken from. A BBL carried by
+both layers takes its point from MapPLUTO, as in the tiered join in edesig_join.
+
+The arrays are written as .npy files and opened with mmap_mode='r', so loading an index is instant and only the pages
+touched by a lookup are read. Each release is then resolved with a vectorized searchsorted over the BBL array and no
+polygon is read at all. The lots themselves (BBL and flat polygon arrays of each layer) are stored alongside, for the
+spatial QA of the output points (see edesig_qa).
+'''
+
+import os, json, hashlib, datetime
+import numpy as np
+import pandas as pd
+
+import edesig_bbl, edesig_geometry, edesig_join
+
+FORMAT_VERSION = 2
+INDEX_ARRAYS = ('bbl', 'x', 'y', 'source')
+INDEX_INFO_FILENAME = 'point_index.json'
+
+# Layer name of point indexes kept in the base-layer cache (see edesig_cache)
+
+CACHE_LAYER = 'POINT_INDEX'
+
+
+def index_fingerprint(layer_fingerprints, centroid_inside=False):
+    '''Return a short hex fingerprint for an index built from base layers with the given fingerprints.'''
+
+    contents = json.dumps({
+        'format': FORMAT_VERSION,
+        'layers': list(layer_fingerprints),
+        'centroid_inside': bool(centroid_inside),
+    }, sort_keys=True)
+    return hashlib.sha1(contents.encode('utf-8')).hexdigest()[:16]
+
+
+class PointIndex(object):
+    '''Sorted BBLs with the centroid and source layer of the lot carrying each of them.'''
+
+    def __init__(self, bbl, x, y, source, info=None):
+        self.bbl = bbl
+        self.x = x
+        self.y = y
+        self.source = source
+        self.info = info or {}
+        self.path = None
+
+    def __len__(self):
+        return len(self.bbl)
+
+    @classmethod
+    def build(cls, tiers):
+        '''
+        Build an index from tiers, an ordered list of (source code, bbl, x, y) arrays with one entry per lot. Invalid
+        BBLs are dropped; a BBL that occurs more than once keeps the point of the first lot in the earliest tier.
+        '''
+
+        info = {'created': str(datetime.datetime.now().replace(microsecond=0)), 'tiers': []}
+        bbl = []
+        x = []
+        y = []
+        source = []
+        for source_code, tier_bbl, tier_x, tier_y in tiers:
+            tier_bbl = edesig_bbl.parse_bbl(tier_bbl, errors='coerce')
+            valid = tier_bbl != edesig_bbl.INVALID_BBL
+            bbl.append(tier_bbl[valid])
+            x.append(np.asarray(tier_x, dtype=np.float64)[valid])
+            y.append(np.asarray(tier_y, dtype=np.float64)[valid])
+            source.append(np.full(int(valid.sum()), source_code, dtype=np.int8))
+            info['tiers'].append({'source': edesig_join.SOURCE_NAMES[source_code], 'lots': len(tier_bbl),
+                                  'invalid': int((~valid).sum())})
+
+        bbl = np.concatenate(bbl) if bbl else np.zeros(0, dtype=edesig_bbl.BBL_DTYPE)
+        order = np.argsort(bbl, kind='mergesort')
+        sorted_bbl = bbl[order]
+        first = np.ones(len(sorted_bbl), dtype=bool)
+        first[1:] = sorted_bbl[1:] != sorted_bbl[:-1]
+        order = order[first]
+
+        index = cls(bbl[order], np.concatenate(x)[order] if x else np.zeros(0),
+                    np.concatenate(y)[order] if y else np.zeros(0),
+                    np.concatenate(source)[order] if source else np.zeros(0, dtype=np.int8), info)
+        info['bbls'] = len(index)
+        info['duplicates'] = int((~first).sum())
+        return index
+
+    def save(self, path, lots=()):
+        '''
+        Write the index arrays and a JSON summary into directory path. lots is an optional list of (source code, bbl,
+        FlatPolygons) holding the lots of each layer, which are written alongside for load_lots.
+        '''
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        for source_code, lot_bbl, polygons in lots:
+            np.save(os.path.join(path, 'lots_{}_bbl.npy'.format(source_code)),
+                    edesig_bbl.parse_bbl(lot_bbl, errors='coerce'))
+            edesig_geometry.save_polygons(polygons, os.path.join(path, 'lots_{}'.format(source_code)))
+        with open(os.path.join(path, INDEX_INFO_FILENAME), 'w') as info_file:
+            json.dump(dict(self.info, format=FORMAT_VERSION, lot_sources=[lot[0] for lot in lots]), info_file,
+                      indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        '''Open an index written by save. The arrays are memory-mapped read-only rather than read into memory.'''
+
+        with open(os.path.join(path, INDEX_INFO_FILENAME), 'r') as info_file:
+            info = json.load(info_file)
+        if info.get('format') != FORMAT_VERSION:
+            raise ValueError("Point index {0} has format {1}, expected {2}".format(path, info.get('format'),
+                                                                                 FORMAT_VERSION))
+        index = cls(*[np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in INDEX_ARRAYS], info=info)
+        index.path = path
+        return index
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(os.path.join(path, name + '.npy')) for name in INDEX_ARRAYS) and \
+            os.path.exists(os.path.join(path, INDEX_INFO_FILENAME))
+
+    def load_lots(self):
+        '''Return the (source code, bbl, FlatPolygons) lots saved with a loaded index, memory-mapped read-only.'''
+
+        return [(source_code, np.load(os.path.join(self.path, 'lots_{}_bbl.npy'.format(source_code)), mmap_mode='r'),
+                 edesig_geometry.load_polygons(os.path.join(self.path, 'lots_{}'.format(source_code))))
+                for source_code in self.info.get('lot_sources', [])]
+
+    def lookup(self, bbl):
+        '''
+        Return the source code, x and y for each BBL in bbl. BBLs that are not in the index get SOURCE_NONE and NaN
+        coordinates.
+        '''
+
+        bbl = np.asarray(bbl, dtype=edesig_bbl.BBL_DTYPE)
+        source = np.full(len(bbl), edesig_join.SOURCE_NONE, dtype=np.int8)
+        x = np.full(len(bbl), np.nan)
+        y = np.full(len(bbl), np.nan)
+        if not len(self.bbl) or not len(bbl):
+            return source, x, y
+
+        positions = np.searchsorted(self.bbl, bbl)
+        positions[positions == len(self.bbl)] = 0
+        found = (np.asarray(self.bbl[positions]) == bbl) & (bbl != edesig_bbl.INVALID_BBL)
+        found_positions = positions[found]
+        source[found] = self.source[found_positions]
+        x[found] = self.x[found_positions]
+        y[found] = self.y[found_positions]
+        return source, x, y
+
+
+def locate_chunks(chunks, index, columns=None):
+    '''
+    Resolve a stream of typed E-Designation DataFrames (see edesig_ingest) against a PointIndex. Returns the matched
+    rows with SOURCE, POINT_X and POINT_Y columns added, and the unmatched residue, as two DataFrames. If columns is
+    given, matched rows keep only those columns as each chunk is resolved; unmatched rows keep every column for
+    review. Matched rows whose lot has no geometry keep NaN coordinates.
+    '''
+
+    matched = []
+    unmatched = []
+    for chunk in chunks:
+        source, x, y = index.lookup(chunk['BBL'].values)
+        found = source != edesig_join.SOURCE_NONE
+        matched_rows = chunk[found] if columns is None else chunk.loc[found, list(columns)]
+        matched.append(matched_rows.assign(SOURCE=source[found], POINT_X=x[found], POINT_Y=y[found]))
+        unmatched.append(chunk[~found])
+
+    if not matched:
+        return pd.DataFrame(), pd.DataFrame()
+    return pd.concat(matched), pd.concat(unmatched)
@@ -0,0 +1,377 @@
+'''
+Atomic, versioned publication of a release under a fixed name.
+
+A release is loaded under a staging name next to the live one ({name}_staging), verified against the row count and
+content checksum of its source and only then swapped in: the live release is retired under a versioned name
+({name}_{version}) and the staging copy is renamed to the live name. Readers therefore see either the previous release
+or the new one in full, never a partial copy. The last keep retired versions are kept for an instant rollback, which is
+the same swap in reverse, and older ones are deleted. The version held under each name is recorded in a JSON registry.
+
+The same publisher drives three stores: directories on a file system (the Bytes release directory), tables in a SQLite
+database (a stand-in for testing) and feature classes in a geodatabase through arcpy (SDE PROD). In SQLite both renames
+of a swap run in one transaction. A geodatabase has no transactional rename, so its swap is two renames in quick
+succession. A new directory, such as the dated Bytes directory of a new release, is swapped in with a single rename.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, json, shutil, sqlite3, hashlib, datetime, threading
+
+import edesig_manifest
+
+STAGING_SUFFIX = '_staging'
+DEFAULT_KEEP = 3
+REGISTRY_FILENAME = 'edesig_publish.json'
+REGISTRY_VERSION = 1
+
+# Field types left out of geodatabase checksums, since their values are assigned by the database
+
+GEODATABASE_SKIPPED_TYPES = ('OID', 'Geometry', 'GlobalID', 'Raster', 'Blob')
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class PublishError(Exception):
+    '''Raised when a staged release fails verification or there is no retired version to roll back to.'''
+
+
+def _field_text(value):
+    # Render a value the same way whichever store or Python version it was read from
+
+    if value is None:
+        return u''
+    if isinstance(value, float) and value.is_integer():
+        return text_type(int(value))
+    if isinstance(value, bytes) and not isinstance(value, text_type):
+        return value.decode('utf-8', 'replace')
+    return text_type(value)
+
+
+def row_checksum(rows):
+    '''Return an order-independent SHA-256 hex digest of rows, sequences of field values.'''
+
+    digests = sorted(hashlib.sha1(u'\x1f'.join(_field_text(value) for value in row).encode('utf-8')).digest()
+                     for row in rows)
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+def files_checksum(files):
+    '''Return the checksum of a release directory from (relative path, file path) pairs of the files it should hold.'''
+
+    return row_checksum((relative_path.replace(os.sep, '/'), edesig_manifest.hash_file(file_path))
+                        for relative_path, file_path in files)
+
+
+class DirectoryStore(object):
+    '''Releases held as directories under parent_path. Rows are files, found recursively.'''
+
+    def __init__(self, parent_path):
+        self.parent_path = parent_path
+
+    def key(self, name):
+        return os.path.normcase(os.path.abspath(os.path.join(self.parent_path, name)))
+
+    def path(self, name):
+        return os.path.join(self.parent_path, name)
+
+    def exists(self, name):
+        return os.path.isdir(self.path(name))
+
+    def prepare(self, name):
+        os.makedirs(self.path(name))
+
+    def delete(self, name):
+        shutil.rmtree(self.path(name))
+
+    def swap(self, live_name, incoming_name, retired_name=None):
+        if retired_name is not None:
+            os.rename(self.path(live_name), self.path(retired_name))
+        try:
+            os.rename(self.path(incoming_name), self.path(live_name))
+        except Exception:
+            # Put the retired release back, so a failed swap never leaves the name without a live release
+
+            if retired_name is not None:
+                os.rename(self.path(retired_name), self.path(live_name))
+            raise
+
+    def _files(self, name):
+        root_path = self.path(name)
+        for directory, subdirectories, filenames in os.walk(root_path):
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                yield os.path.relpath(file_path, root_path), file_path
+
+    def count(self, name):
+        return len(list(self._files(name)))
+
+    def checksum(self, name):
+        return files_checksum(self._files(name))
+
+
+class SQLiteStore(object):
+    '''Releases held as tables of a SQLite database. Load functions write through self.connection.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+
+        # Autocommit, so that a swap's explicit transaction covers both renames on every Python version
+
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+    def key(self, name):
+        return '{0}::{1}'.format(os.path.normcase(os.path.abspath(self.path)), name)
+
+    @staticmethod
+    def quote(name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def exists(self, name):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                           (name,)).fetchone() is not None
+
+    def prepare(self, name):
+        pass
+
+    def delete(self, name):
+        with self.lock:
+            self.connection.execute("DROP TABLE {}".format(self.quote(name)))
+
+    def swap(self, live_name, incoming_name, retired_name=None):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if retired_name is not None:
+                    self.connection.execute("ALTER TABLE {0} RENAME TO {1}".format(self.quote(live_name),
+                                                                                self.quote(retired_name)))
+                self.connection.execute("ALTER TABLE {0} RENAME TO {1}".format(self.quote(incoming_name),
+                                                                            self.quote(live_name)))
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def count(self, name):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM {}".format(self.quote(name))).fetchone()[0]
+
+    def checksum(self, name):
+        with self.lock:
+            return row_checksum(self.connection.execute("SELECT * FROM {}".format(self.quote(name))))
+
+
+class GeodatabaseStore(object):
+    '''
+    Releases held as feature classes of a geodatabase workspace (for example an SDE connection), through the arcpy
+    module passed in. Checksums cover fields, by default every field other than object ids and geometry.
+    '''
+
+    def __init__(self, arcpy, workspace, fields=None):
+        self.arcpy = arcpy
+        self.workspace = workspace
+        self.fields = fields
+
+    def key(self, name):
+        return os.path.join(self.workspace, name)
+
+    def path(self, name):
+        return os.path.join(self.workspace, name)
+
+    def exists(self, name):
+        return self.arcpy.Exists(self.path(name))
+
+    def prepare(self, name):
+        pass
+
+    def delete(self, name):
+        self.arcpy.Delete_management(self.path(name))
+
+    def swap(self, live_name, incoming_name, retired_name=None):
+        if retired_name is not None:
+            self.arcpy.Rename_management(self.path(live_name), self.path(retired_name))
+        try:
+            self.arcpy.Rename_management(self.path(incoming_name), self.path(live_name))
+        except Exception:
+            # Put the retired release back, for example when a schema lock stops the incoming one being renamed
+
+            if retired_name is not None:
+                self.arcpy.Rename_management(self.path(retired_name), self.path(live_name))
+            raise
+
+    def count(self, name):
+        return int(self.arcpy.GetCount_management(self.path(name))[0])
+
+    def checksum_fields(self, name):
+        if self.fields is not None:
+            return list(self.fields)
+        return [field.name for field in self.arcpy.ListFields(self.path(name))
+                if field.type not in GEODATABASE_SKIPPED_TYPES]
+
+    def checksum(self, name):
+        with self.arcpy.da.SearchCursor(self.path(name), self.checksum_fields(name)) as cursor:
+            return row_checksum(cursor)
+
+
+class PublishRegistry(object):
+    '''The live and retired versions of every published name, saved atomically as JSON.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.targets = {}
+        if os.path.exists(path):
+            with open(path, 'r') as registry_file:
+                contents = json.load(registry_file)
+            if contents.get('version') == REGISTRY_VERSION:
+                self.targets = contents.get('targets', {})
+
+    def target(self, key):
+        return self.targets.setdefault(key, {'live': None, 'retired': []})
+
+    def has(self, key):
+        '''Return True if anything has been published under key.'''
+
+        with self.lock:
+            return key in self.targets
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        temp_registry_path = self.path + '.tmp'
+        with open(temp_registry_path, 'w') as registry_file:
+            json.dump({'version': REGISTRY_VERSION, 'targets': self.targets}, registry_file, indent=1, sort_keys=True)
+        edesig_manifest.replace_file(temp_registry_path, self.path)
+
+
+class Publisher(object):
+    '''
+    Publishes releases under name in store (a DirectoryStore, SQLiteStore or GeodatabaseStore), recording versions in
+    registry (a PublishRegistry) and keeping the keep most recently retired versions for rollback.
+    '''
+
+    def __init__(self, store, name, registry, keep=DEFAULT_KEEP):
+        self.store = store
+        self.name = name
+        self.registry = registry
+        self.keep = max(0, int(keep))
+        self.key = store.key(name)
+
+    @property
+    def staging_name(self):
+        return self.name + STAGING_SUFFIX
+
+    def versions(self):
+        '''Return the live version entry (or None) and the retired version entries, most recent first.'''
+
+        with self.registry.lock:
+            target = self.registry.target(self.key)
+            return target['live'], list(target['retired'])
+
+    def discard(self):
+        '''Remove anything left under the staging name.'''
+
+        if self.store.exists(self.staging_name):
+            self.store.delete(self.staging_name)
+
+    def stage(self):
+        '''Clear and prepare the staging name, and return it for the release to be loaded into.'''
+
+        self.discard()
+        self.store.prepare(self.staging_name)
+        return self.staging_name
+
+    def verify(self, expected_rows=None, expected_checksum=None):
+        '''
+        Check the staged release against the expected row count and checksum, where given. Returns (rows, checksum)
+        of the staged release; raises PublishError on a mismatch.
+        '''
+
+        rows = self.store.count(self.staging_name)
+        if expected_rows is not None and rows != expected_rows:
+            raise PublishError("Staged {0} holds {1} rows, expected {2}".format(self.name, rows, expected_rows))
+        checksum = self.store.checksum(self.staging_name)
+        if expected_checksum is not None and checksum != expected_checksum:
+            raise PublishError("Staged {0} does not match the checksum of its source".format(self.name))
+        return rows, checksum
+
+    def _free_name(self, name):
+        candidate = name
+        suffix = 0
+        while self.store.exists(candidate):
+            suffix += 1
+            candidate = '{0}_{1}'.format(name, suffix)
+        return candidate
+
+    def _swap_in(self, target, incoming_name, incoming_entry):
+        # Retire the live release (if there is one) under its versioned name and move incoming_name into its place
+
+        retired_entry = None
+        retired_name = None
+        if self.store.exists(self.name):
+            retired_entry = dict(target['live'] or {'version': 'unversioned', 'rows': None, 'checksum': None,
+                                                    'published': None})
+            retired_name = self._free_name('{0}_{1}'.format(self.name, retired_entry['version']))
+            retired_entry['name'] = retired_name
+        if retired_name:
+            print("Swapping {0} into {1}, retiring the previous release as {2}".format(incoming_name, self.name,
+                                                                                       retired_name))
+        else:
+            print("Swapping {0} into {1}".format(incoming_name, self.name))
+        self.store.swap(self.name, incoming_name, retired_name)
+        incoming_entry = dict(incoming_entry, name=self.name)
+        target['live'] = incoming_entry
+        if retired_entry is not None:
+            target['retired'].insert(0, retired_entry)
+
+    def _prune(self, target):
+        for entry in target['retired'][self.keep:]:
+            if self.store.exists(entry['name']):
+                print("Deleting retired version {0} of {1}".format(entry['name'], self.name))
+                self.store.delete(entry['name'])
+        del target['retired'][self.keep:]
+
+    def swap(self, version, rows=None, checksum=None):
+        '''Swap the staged release in as version, retire the live one and delete versions beyond keep.'''
+
+        with self.registry.lock:
+            target = self.registry.target(self.key)
+            self._swap_in(target, self.staging_name, {
+                'version': version, 'rows': rows, 'checksum': checksum,
+                'published': datetime.datetime.now().replace(microsecond=0).isoformat()})
+            self._prune(target)
+            self.registry.save()
+
+    def publish(self, load, version, expected_rows=None, expected_checksum=None):
+        '''
+        Stage, load, verify and swap in a release. load(staging_name) writes the release under the staging name.
+        A release that fails verification is discarded and the live release is left untouched.
+        '''
+
+        load(self.stage())
+        try:
+            rows, checksum = self.verify(expected_rows, expected_checksum)
+        except PublishError:
+            self.discard()
+            raise
+        self.swap(version, rows, checksum)
+        return rows, checksum
+
+    def rollback(self):
+        '''Swap the most recently retired version back in, retiring the live one in its place.'''
+
+        with self.registry.lock:
+            target = self.registry.target(self.key)
+            if not target['retired']:
+                raise PublishError("No retired version of {} to roll back to".format(self.name))
+            previous_entry = target['retired'].pop(0)
+            if not self.store.exists(previous_entry['name']):
+                raise PublishError("Retired version {0} of {1} no longer exists".format(previous_entry['name'],
+                                                                                       self.name))
+            self._swap_in(target, previous_entry['name'], previous_entry)
+            self.registry.save()
+        return previous_entry['version']
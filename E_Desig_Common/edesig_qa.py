@@ -0,0 +1,168 @@
+'''
+Spatial QA of the E-Designation output points against the lots they were taken from.
+
+Every output point carries the BBL of its lot. An STR tree over the lot bounding boxes of each base layer finds the
+candidate lots under every point, and a batched point-in-polygon test over the candidates decides which lots actually
+contain it. A point passes when it lies inside a lot with its own BBL. Any other point is reported as lying outside
+every lot or inside a lot with a different BBL, together with the nearest lot and the distance to its own lot.
+'''
+
+import collections
+import numpy as np
+import pandas as pd
+
+import edesig_bbl, edesig_geometry, edesig_strtree
+
+STATUS_OUTSIDE_LOT = 'outside_lot'
+STATUS_OTHER_LOT = 'inside_other_lot'
+STATUS_NO_LOT = 'no_lot_for_bbl'
+
+# Nearest lots are searched within a square of this half-width (feet), widened until a lot is found or the maximum
+# is reached
+
+NEAREST_START_DISTANCE = 100.0
+NEAREST_MAX_DISTANCE = 5000.0
+
+ISSUE_COLUMNS = ['ROW', 'BBL', 'POINT_X', 'POINT_Y', 'STATUS', 'CONTAINING_BBL', 'NEAREST_BBL', 'NEAREST_DISTANCE',
+                 'OWN_LOT_DISTANCE']
+
+
+class LotLayer(object):
+    '''The lots of one base layer with an STR tree over their bounding boxes and a BBL lookup.'''
+
+    def __init__(self, name, bbl, polygons):
+        self.name = name
+        self.bbl = edesig_bbl.parse_bbl(bbl, errors='coerce')
+        self.polygons = polygons
+        self.tree = edesig_strtree.STRTree(*polygons.bounds())
+        self._bbl_order = np.argsort(self.bbl, kind='mergesort')
+        self._sorted_bbl = self.bbl[self._bbl_order]
+
+    def containing(self, x, y):
+        '''Return (point position, lot position) pairs for every lot that contains point (x[i], y[i]).'''
+
+        point, lot = self.tree.query_points(x, y)
+        inside = edesig_geometry.points_in_polygons(self.polygons, x[point], y[point], lot)
+        return point[inside], lot[inside]
+
+    def lots_for_bbl(self, bbl):
+        '''Return (position in bbl, lot position) pairs for every lot carrying each BBL in bbl.'''
+
+        first = np.searchsorted(self._sorted_bbl, bbl, side='left')
+        counts = np.searchsorted(self._sorted_bbl, bbl, side='right') - first
+        return (np.repeat(np.arange(len(bbl), dtype=np.int64), counts),
+                self._bbl_order[edesig_geometry.concatenate_ranges(first, counts)])
+
+    def nearest(self, x, y, start_distance=NEAREST_START_DISTANCE, max_distance=NEAREST_MAX_DISTANCE):
+        '''Return the position of and distance to the nearest lot of every point, or -1 and NaN if none is in reach.'''
+
+        lot = np.full(len(x), -1, dtype=np.int64)
+        distance = np.full(len(x), np.nan)
+        pending = np.arange(len(x), dtype=np.int64)
+        reach = start_distance
+        while len(pending):
+            px = x[pending]
+            py = y[pending]
+            point, candidate = self.tree.query_boxes(px - reach, py - reach, px + reach, py + reach)
+            candidate_distance = edesig_geometry.polygon_distances(self.polygons, px[point], py[point], candidate)
+
+            # Lots beyond reach may still be nearer than a candidate found in the corners of the search square
+
+            within = candidate_distance <= reach
+            point, candidate, candidate_distance = point[within], candidate[within], candidate_distance[within]
+            order = np.lexsort((candidate_distance, point))
+            point, candidate, candidate_distance = point[order], candidate[order], candidate_distance[order]
+            best = np.ones(len(point), dtype=bool)
+            best[1:] = point[1:] != point[:-1]
+            lot[pending[point[best]]] = candidate[best]
+            distance[pending[point[best]]] = candidate_distance[best]
+
+            found = np.zeros(len(pending), dtype=bool)
+            found[point[best]] = True
+            pending = pending[~found]
+            if reach >= max_distance:
+                break
+            reach = min(reach * 4, max_distance)
+        return lot, distance
+
+
+class QAReport(object):
+    '''Outcome of a QA run: the number of points checked and one row per failing point.'''
+
+    def __init__(self, point_count, issues):
+        self.point_count = point_count
+        self.issues = issues
+
+    @property
+    def passed(self):
+        return not len(self.issues)
+
+    def counts(self):
+        return collections.OrderedDict((status, int((self.issues['STATUS'] == status).sum()))
+                                       for status in (STATUS_OUTSIDE_LOT, STATUS_OTHER_LOT, STATUS_NO_LOT))
+
+    def summary(self):
+        if self.passed:
+            return "QA: all {} points fall inside a lot with their own BBL".format(self.point_count)
+        return "QA: {0} of {1} points failed ({2})".format(
+            len(self.issues), self.point_count,
+            ", ".join("{0} {1}".format(count, status) for status, count in self.counts().items() if count))
+
+    def write(self, path):
+        self.issues.to_csv(path, index=False)
+
+
+def check_points(x, y, bbl, layers):
+    '''
+    Check that every point (x[i], y[i]) lies inside a lot carrying BBL bbl[i] in any of layers, a list of LotLayer.
+    Points with no coordinates are not checked. Returns a QAReport.
+    '''
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    bbl = edesig_bbl.parse_bbl(bbl, errors='coerce')
+    checked = np.isfinite(x) & np.isfinite(y)
+
+    own_lot = np.zeros(len(x), dtype=bool)
+    has_lot = np.zeros(len(x), dtype=bool)
+    containing_bbl = np.full(len(x), edesig_bbl.INVALID_BBL, dtype=edesig_bbl.BBL_DTYPE)
+    for layer in layers:
+        point, lot = layer.containing(x, y)
+        same = layer.bbl[lot] == bbl[point]
+        own_lot[point[same]] = True
+        containing_bbl[point[~same]] = layer.bbl[lot[~same]]
+        has_lot[np.unique(layer.lots_for_bbl(bbl)[0])] = True
+
+    failed = np.flatnonzero(checked & ~own_lot)
+    status = np.where(~has_lot[failed], STATUS_NO_LOT,
+                      np.where(containing_bbl[failed] != edesig_bbl.INVALID_BBL, STATUS_OTHER_LOT,
+                               STATUS_OUTSIDE_LOT))
+
+    # Nearest lot over all layers, and the distance to the nearest lot carrying the point's own BBL
+
+    nearest_bbl = np.full(len(failed), edesig_bbl.INVALID_BBL, dtype=edesig_bbl.BBL_DTYPE)
+    nearest_distance = np.full(len(failed), np.inf)
+    own_distance = np.full(len(failed), np.inf)
+    for layer in layers:
+        lot, distance = layer.nearest(x[failed], y[failed])
+        nearer = (lot >= 0) & (distance < nearest_distance)
+        nearest_bbl[nearer] = layer.bbl[lot[nearer]]
+        nearest_distance[nearer] = distance[nearer]
+
+        point, lot = layer.lots_for_bbl(bbl[failed])
+        if len(point):
+            lot_distance = edesig_geometry.polygon_distances(layer.polygons, x[failed][point], y[failed][point], lot)
+            np.minimum.at(own_distance, point, lot_distance)
+
+    issues = pd.DataFrame({
+        'ROW': failed,
+        'BBL': bbl[failed],
+        'POINT_X': x[failed],
+        'POINT_Y': y[failed],
+        'STATUS': status,
+        'CONTAINING_BBL': np.where(containing_bbl[failed] != edesig_bbl.INVALID_BBL, containing_bbl[failed], 0),
+        'NEAREST_BBL': nearest_bbl,
+        'NEAREST_DISTANCE': np.where(np.isfinite(nearest_distance), nearest_distance, np.nan),
+        'OWN_LOT_DISTANCE': np.where(np.isfinite(own_distance), own_distance, np.nan),
+    }, columns=ISSUE_COLUMNS)
+    return QAReport(int(checked.sum()), issues)
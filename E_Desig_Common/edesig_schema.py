@@ -0,0 +1,122 @@
+'''
+Declarative schema of the E-Designation release.
+
+The fields of the published nyedes_{date} dataset are declared once, in RELEASE_SCHEMA, in the order previous releases
+used: the name, ArcGIS field type and length of each field and the column of the E-Designation export it is taken
+from. The BBL column of each base layer is declared alongside in BASE_LAYER_BBL_COLUMNS.
+
+Everything downstream is derived from these declarations: the columns the join keeps, the NumPy dtype handed to
+arcpy.da.NumPyArrayToFeatureClass, the DBF fields of the shapefile and the fingerprint that stage checkpoints use to
+notice a schema change. Changing the release schema therefore means editing this module only.
+'''
+
+import json, hashlib, collections
+import numpy as np
+
+import edesig_join, edesig_shapefile
+
+ReleaseField = collections.namedtuple('ReleaseField', ['name', 'type', 'length', 'source'])
+
+# Release fields in output order: name, ArcGIS field type, length (TEXT fields only) and source export column
+
+RELEASE_SCHEMA = [
+    ReleaseField('ENUMBER', 'TEXT', 20, 'ENUMBER'),
+    ReleaseField('CEQR_NUM', 'TEXT', 30, 'CEQR_NUM'),
+    ReleaseField('ULURP_NUM', 'TEXT', 30, 'ULURP_NUM'),
+    ReleaseField('BOROCODE', 'SHORT', None, 'BOROCODE'),
+    ReleaseField('TAXBLOCK', 'LONG', None, 'TAXBLOCK'),
+    ReleaseField('TAXLOT', 'SHORT', None, 'TAXLOT'),
+    ReleaseField('BBL', 'DOUBLE', None, 'BBL'),
+]
+
+# Column holding the BBL of each base layer, by source code. It is the only column pulled into the base-layer cache.
+
+BASE_LAYER_BBL_COLUMNS = {
+    edesig_join.SOURCE_MAPPLUTO: 'BBL',
+    edesig_join.SOURCE_TAXLOT: 'BBL',
+}
+
+# Coordinate columns of point arrays, used as the shape fields of arcpy.da.NumPyArrayToFeatureClass
+
+POINT_FIELDS = ('POINT_X', 'POINT_Y')
+
+NUMPY_FIELD_TYPES = {'SHORT': np.int16, 'LONG': np.int32, 'FLOAT': np.float32, 'DOUBLE': np.float64}
+
+
+def check_schema(schema=RELEASE_SCHEMA):
+    '''Raise ValueError if a field is declared twice, has an unknown type or a name too long for a shapefile.'''
+
+    names = set()
+    for field in schema:
+        if field.name in names:
+            raise ValueError("Release field {} is declared more than once".format(field.name))
+        if field.type != 'TEXT' and field.type not in NUMPY_FIELD_TYPES:
+            raise ValueError("Release field {0} has unsupported type {1}".format(field.name, field.type))
+        if field.type == 'TEXT' and not field.length:
+            raise ValueError("TEXT release field {} needs a length".format(field.name))
+        if len(field.name) > 10:
+            raise ValueError("Release field {} is longer than the 10 characters a shapefile allows".format(field.name))
+        names.add(field.name)
+
+
+def field_names(schema=RELEASE_SCHEMA):
+    return [field.name for field in schema]
+
+
+def source_columns(schema=RELEASE_SCHEMA):
+    '''Return the export columns the release is built from, without duplicates, in output order.'''
+
+    columns = []
+    for field in schema:
+        if field.source not in columns:
+            columns.append(field.source)
+    return columns
+
+
+def fingerprint(schema=RELEASE_SCHEMA):
+    '''Return a short hex fingerprint of the schema, for stage checkpoint parameters.'''
+
+    return hashlib.sha1(json.dumps([list(field) for field in schema]).encode('utf-8')).hexdigest()[:16]
+
+
+def numpy_dtype(schema=RELEASE_SCHEMA, extra_fields=()):
+    '''Return the structured dtype of a point array: the release fields, extra_fields and the point coordinates.'''
+
+    dtype = [(field.name, '<U{}'.format(field.length) if field.type == 'TEXT' else NUMPY_FIELD_TYPES[field.type])
+             for field in schema]
+    return np.dtype(dtype + list(extra_fields) + [(name, np.float64) for name in POINT_FIELDS])
+
+
+def dbf_fields(schema=RELEASE_SCHEMA):
+    '''Return the edesig_shapefile.DBFField ArcGIS would write for each release field, in output order.'''
+
+    return [edesig_shapefile.dbf_field(field.name, field.type, field.length) for field in schema]
+
+
+def project_points(frame, point_x, point_y, schema=RELEASE_SCHEMA, extra_fields=()):
+    '''
+    Project a typed DataFrame (see edesig_ingest) into a NumPy structured array holding the release fields, taken
+    from their source columns, plus extra_fields (a list of (name, dtype) pairs of columns of frame) and the point
+    coordinates.
+    '''
+
+    point_array = np.empty(len(frame), dtype=numpy_dtype(schema, extra_fields))
+    for field in schema:
+        point_array[field.name] = frame[field.source].values
+    for name, dtype in extra_fields:
+        point_array[name] = frame[name].values
+    point_array[POINT_FIELDS[0]] = point_x
+    point_array[POINT_FIELDS[1]] = point_y
+    return point_array
+
+
+def release_array(point_array, schema=RELEASE_SCHEMA):
+    '''Return a packed copy of point_array holding only the release fields and the point coordinates.'''
+
+    release = np.empty(len(point_array), dtype=numpy_dtype(schema))
+    for name in release.dtype.names:
+        release[name] = point_array[name]
+    return release
+
+
+check_schema()
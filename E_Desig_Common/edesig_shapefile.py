@@ -0,0 +1,193 @@
+'''
+Streaming point shapefile writer.
+
+Writes the .shp, .shx, .dbf, .prj and .cpg files of a point shapefile straight from in-memory arrays: the x and y
+coordinate arrays and a NumPy structured array (or DataFrame) holding the attribute columns. The headers are known
+up front, so every file is written in one sequential, buffered pass. Records are encoded chunk by chunk with
+vectorized NumPy operations, and each encoded chunk is written to every destination, so several copies of the same
+shapefile cost one encoding pass.
+
+Each destination is written under temporary names and renamed into place once complete, so a failed write never
+leaves a partial shapefile behind.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, struct, datetime, collections
+import numpy as np
+
+import edesig_manifest
+
+SHAPE_POINT = 1
+FILE_CODE = 9994
+VERSION = 1000
+HEADER_BYTES = 100
+DEFAULT_CHUNK_SIZE = 50000
+DEFAULT_ENCODING = 'UTF-8'
+
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# dBASE field type, width and decimals written by ArcGIS for each ArcGIS field type. TEXT fields use their length.
+
+DBF_FIELD_TYPES = {
+    'SHORT': ('N', 4, 0),
+    'LONG': ('N', 9, 0),
+    'FLOAT': ('F', 13, 11),
+    'DOUBLE': ('N', 19, 11),
+    'DATE': ('D', 8, 0),
+}
+
+DBFField = collections.namedtuple('DBFField', ['name', 'type', 'width', 'decimals'])
+
+_SHP_RECORD = np.dtype([('number', '>i4'), ('length', '>i4'), ('shape_type', '<i4'), ('x', '<f8'), ('y', '<f8')])
+_SHX_RECORD = np.dtype([('offset', '>i4'), ('length', '>i4')])
+_POINT_CONTENT_WORDS = 10
+
+
+def dbf_field(name, field_type, length=None):
+    '''Return the DBFField ArcGIS would write for a field of the given ArcGIS type (and length, for TEXT fields).'''
+
+    if field_type == 'TEXT':
+        return DBFField(name, 'C', int(length), 0)
+    dbf_type, width, decimals = DBF_FIELD_TYPES[field_type]
+    return DBFField(name, dbf_type, width, decimals)
+
+
+def _file_header(length_bytes, bounds):
+    return (struct.pack('>7i', FILE_CODE, 0, 0, 0, 0, 0, length_bytes // 2) +
+            struct.pack('<2i', VERSION, SHAPE_POINT) + struct.pack('<4d', *bounds) + struct.pack('<4d', 0, 0, 0, 0))
+
+
+def _dbf_header(fields, record_count):
+    today = datetime.date.today()
+    record_length = 1 + sum(field.width for field in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    header = struct.pack('<4BIHH20x', 3, today.year - 1900, today.month, today.day, record_count, header_length,
+                         record_length)
+    for field in fields:
+        name = field.name.encode('ascii')[:10]
+        header += struct.pack('<11sc4xBB14x', name, field.type.encode('ascii'), field.width, field.decimals)
+    return header + b'\r'
+
+
+def _fixed_width(text, width, right):
+    # Truncate or pad an 'S' array to exactly width bytes.
+
+    text = text.astype('S{}'.format(width))
+    return np.char.rjust(text, width) if right else np.char.ljust(text, width)
+
+
+def _format_numbers(values, field):
+    # Format numbers right-justified in field.width characters. Values too wide for the field's decimals keep as many
+    # decimals as fit, as ArcGIS does. Missing values are left blank.
+
+    values = np.asarray(values, dtype=np.float64)
+    text = np.full(len(values), b' ' * field.width, dtype='S{}'.format(field.width))
+    finite = np.isfinite(values)
+    if not finite.any():
+        return text
+
+    integer_width = np.char.str_len(np.char.mod('%.0f', values[finite]))
+    decimals = np.clip(field.width - integer_width - 1, 0, field.decimals) if field.decimals else \
+        np.zeros(len(integer_width), dtype=np.int64)
+    formatted = np.empty(len(integer_width), dtype='S{}'.format(field.width))
+    for decimal_count in np.unique(decimals):
+        selected = decimals == decimal_count
+        formatted[selected] = np.char.encode(np.char.mod('%.{}f'.format(decimal_count), values[finite][selected]),
+                                             'ascii')
+    text[finite] = _fixed_width(formatted, field.width, True)
+    return text
+
+
+def _format_column(values, field, encoding):
+    if field.type == 'C':
+        values = np.asarray(values, dtype=object)
+        values = np.where([value is None for value in values], '', values)
+        return _fixed_width(np.char.encode(values.astype('U'), encoding), field.width, False)
+    if field.type == 'D':
+        dates = np.asarray(values, dtype='datetime64[D]')
+        text = np.full(len(dates), b' ' * 8, dtype='S8')
+        present = dates.astype(np.int64) != np.iinfo(np.int64).min
+        text[present] = np.char.encode(np.char.replace(dates[present].astype('U10'), '-', ''), 'ascii')
+        return text
+    return _format_numbers(values, field)
+
+
+def write_points(paths, x, y, records, fields, prj=None, encoding=DEFAULT_ENCODING, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Write a point shapefile to every path in paths (each without extension). x and y are the point coordinates,
+    records holds a column for every DBFField in fields (a structured array, a DataFrame or a dict of arrays), in the
+    field order of the output. prj is the ESRI WKT of the coordinate system. Returns the number of points written.
+    '''
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if not (np.isfinite(x).all() and np.isfinite(y).all()):
+        raise ValueError("Every shapefile point must have finite coordinates")
+    count = len(x)
+    bounds = (x.min(), y.min(), x.max(), y.max()) if count else (0.0, 0.0, 0.0, 0.0)
+    shp_header = _file_header(HEADER_BYTES + count * _SHP_RECORD.itemsize, bounds)
+    shx_header = _file_header(HEADER_BYTES + count * _SHX_RECORD.itemsize, bounds)
+    dbf_header = _dbf_header(fields, count)
+    dbf_record = np.dtype([('deleted', 'S1')] + [('f{}'.format(position), 'S{}'.format(field.width))
+                                                 for position, field in enumerate(fields)])
+
+    destinations = []
+    complete = False
+    try:
+        for path in paths:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            files = dict((extension, open(path + extension + '.tmp', 'wb')) for extension in SHAPEFILE_EXTENSIONS)
+            destinations.append((path, files))
+            files['.shp'].write(shp_header)
+            files['.shx'].write(shx_header)
+            files['.dbf'].write(dbf_header)
+            if prj:
+                files['.prj'].write(prj.encode('ascii'))
+            files['.cpg'].write(encoding.encode('ascii'))
+
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            number = np.arange(start, stop)
+
+            shp_chunk = np.empty(stop - start, dtype=_SHP_RECORD)
+            shp_chunk['number'] = number + 1
+            shp_chunk['length'] = _POINT_CONTENT_WORDS
+            shp_chunk['shape_type'] = SHAPE_POINT
+            shp_chunk['x'] = x[start:stop]
+            shp_chunk['y'] = y[start:stop]
+
+            shx_chunk = np.empty(stop - start, dtype=_SHX_RECORD)
+            shx_chunk['offset'] = (HEADER_BYTES + number * _SHP_RECORD.itemsize) // 2
+            shx_chunk['length'] = _POINT_CONTENT_WORDS
+
+            dbf_chunk = np.empty(stop - start, dtype=dbf_record)
+            dbf_chunk['deleted'] = b' '
+            for position, field in enumerate(fields):
+                dbf_chunk['f{}'.format(position)] = _format_column(np.asarray(records[field.name])[start:stop],
+                                                                   field, encoding)
+
+            chunks = {'.shp': shp_chunk.tobytes(), '.shx': shx_chunk.tobytes(), '.dbf': dbf_chunk.tobytes()}
+            for path, files in destinations:
+                for extension, chunk in chunks.items():
+                    files[extension].write(chunk)
+
+        for path, files in destinations:
+            files['.dbf'].write(b'\x1a')
+        complete = True
+    finally:
+        for path, files in destinations:
+            for shapefile_file in files.values():
+                shapefile_file.close()
+                if not complete:
+                    os.remove(shapefile_file.name)
+
+    for path, files in destinations:
+        for extension in SHAPEFILE_EXTENSIONS:
+            if extension == '.prj' and not prj:
+                os.remove(path + extension + '.tmp')
+                continue
+            edesig_manifest.replace_file(path + extension + '.tmp', path + extension)
+    return count
@@ -0,0 +1,240 @@
+'''
+Named pipeline stages with content-fingerprinted checkpoints, resume and concurrent execution.
+
+A pipeline is a set of stages, each declaring its inputs, its outputs and the stages it runs after. Before a stage
+runs, a fingerprint is taken of its parameters, of its input files (size and modification time, or the literal value
+for anything that is not a path on disk) and of the fingerprints of the stages it depends on. The fingerprint is
+recorded in a checkpoint file once the stage succeeds.
+
+On the next run a stage is skipped only if its recorded fingerprint matches, all of its outputs still exist and none
+of the stages it depends on had to run again. A checkpoint left by another release or by a crashed run therefore never
+passes for a valid one, and a rerun resumes from the first invalid stage. Stages whose dependencies are satisfied run
+concurrently in a bounded pool of threads. The pool holds one thread unless max_workers says otherwise, since stages
+calling arcpy must never run at the same time.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, json, time, shutil, hashlib, threading, traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import edesig_manifest
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class StageFailed(Exception):
+    '''Raised when one or more stages fail. failures maps stage name to the exception it raised.'''
+
+    def __init__(self, failures):
+        Exception.__init__(self, "Stage(s) failed: {}".format(
+            "; ".join("{0} ({1})".format(name, failures[name]) for name in sorted(failures))))
+        self.failures = failures
+
+
+class Stage(object):
+    '''
+    A named unit of work. func is called with the Pipeline and returns a JSON-serializable result (for example an
+    output path) that later stages can read from pipeline.results, even when this stage is skipped. Outputs are
+    removed before the stage runs unless keep_outputs is set, for outputs managed elsewhere such as cache entries.
+    '''
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), params=None, keep_outputs=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.params = params or {}
+        self.keep_outputs = keep_outputs
+
+
+def path_fingerprint(path):
+    '''Summarize a file or directory tree by name, size and modification time. Other values are used as-is.'''
+
+    if not isinstance(path, string_types) or not os.path.exists(path):
+        return repr(path)
+    if os.path.isfile(path):
+        status = os.stat(path)
+        return '{0}:{1}:{2}'.format(path, status.st_size, status.st_mtime)
+
+    digest = hashlib.sha1()
+    for directory, subdirectories, filenames in os.walk(path):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.lock'):
+                continue
+            status = os.stat(os.path.join(directory, filename))
+            digest.update('{0}:{1}:{2};'.format(os.path.relpath(os.path.join(directory, filename), path),
+                                                status.st_size, status.st_mtime).encode('utf-8'))
+    return '{0}:{1}'.format(path, digest.hexdigest())
+
+
+class Pipeline(object):
+    '''
+    Runs stages in dependency order, skipping those with a valid checkpoint. exists and remove are used to check for
+    and clear stage outputs (os.path.exists and a file/directory remover by default; arcpy.Exists and
+    arcpy.Delete_management work as well). If an edesig_telemetry.Telemetry is given, every stage is recorded in it.
+    '''
+
+    def __init__(self, checkpoint_path, exists=os.path.exists, remove=None, max_workers=1, telemetry=None):
+        self.checkpoint_path = checkpoint_path
+        self.exists = exists
+        self.remove = remove or _remove_path
+        self.max_workers = max(1, int(max_workers))
+        self.telemetry = telemetry
+        self.stages = []
+        self.results = {}
+        self.status = {}
+        self._lock = threading.Lock()
+        self.checkpoints = self._load_checkpoints()
+
+    def _load_checkpoints(self):
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        try:
+            with open(self.checkpoint_path, 'r') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except ValueError:
+            print("Checkpoint file is unreadable. All stages will run")
+            return {}
+
+    def _save_checkpoints(self):
+        temp_checkpoint_path = self.checkpoint_path + '.tmp'
+        with open(temp_checkpoint_path, 'w') as checkpoint_file:
+            json.dump(self.checkpoints, checkpoint_file, indent=1, sort_keys=True)
+        edesig_manifest.replace_file(temp_checkpoint_path, self.checkpoint_path)
+
+    def add(self, name, func, inputs=(), outputs=(), after=(), params=None, keep_outputs=False):
+        '''Add a stage. Stages named in after must already have been added.'''
+
+        known = set(stage.name for stage in self.stages)
+        if name in known:
+            raise ValueError("Stage {} is already defined".format(name))
+        missing = [dependency for dependency in after if dependency not in known]
+        if missing:
+            raise ValueError("Stage {0} runs after unknown stage(s) {1}".format(name, missing))
+        stage = Stage(name, func, inputs, outputs, after, params, keep_outputs)
+        self.stages.append(stage)
+        return stage
+
+    def fingerprint(self, stage):
+        '''Fingerprint a stage from its parameters, its inputs and the fingerprints of its dependencies.'''
+
+        contents = json.dumps({
+            'params': dict((str(key), repr(value)) for key, value in stage.params.items()),
+            'inputs': [path_fingerprint(path) for path in stage.inputs],
+            'after': [self.checkpoints.get(dependency, {}).get('fingerprint') for dependency in stage.after],
+        }, sort_keys=True)
+        return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+    def _is_valid(self, stage, fingerprint, rerun):
+        checkpoint = self.checkpoints.get(stage.name)
+        if checkpoint is None or checkpoint.get('fingerprint') != fingerprint:
+            return False
+        if any(dependency in rerun for dependency in stage.after):
+            return False
+        return all(self.exists(output) for output in stage.outputs)
+
+    def _execute(self, stage, fingerprint, completed):
+        try:
+            for output in ([] if stage.keep_outputs else stage.outputs):
+                if self.exists(output):
+                    self.remove(output)
+            started = time.time()
+            if self.telemetry is not None:
+                with self.telemetry.stage(stage.name):
+                    result = stage.func(self)
+            else:
+                result = stage.func(self)
+            with self._lock:
+                self.results[stage.name] = result
+                self.checkpoints[stage.name] = {
+                    'fingerprint': fingerprint,
+                    'result': result,
+                    'completed': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'duration': round(time.time() - started, 3),
+                }
+                self._save_checkpoints()
+            completed.put((stage.name, None))
+        except Exception as error:
+            error.stage_traceback = traceback.format_exc()
+            completed.put((stage.name, error))
+
+    def run(self, force=()):
+        '''
+        Run every stage that has no valid checkpoint, plus those named in force, in dependency order. Raises
+        StageFailed once running stages finish if any stage failed; stages that depend on it are not started.
+        '''
+
+        pending = list(self.stages)
+        running = {}
+        rerun = set(force)
+        done = set()
+        failures = {}
+        completed = queue.Queue()
+
+        while pending or running:
+            ready = [stage for stage in pending if all(dependency in done for dependency in stage.after)]
+            if failures:
+                ready = []
+
+            for stage in ready:
+                if len(running) >= self.max_workers:
+                    break
+                pending.remove(stage)
+                fingerprint = self.fingerprint(stage)
+                if stage.name not in rerun and self._is_valid(stage, fingerprint, rerun):
+                    print("Stage {} has a valid checkpoint. Skipping".format(stage.name))
+                    self.results[stage.name] = self.checkpoints[stage.name].get('result')
+                    self.status[stage.name] = 'skipped'
+                    if self.telemetry is not None:
+                        self.telemetry.skipped(stage.name)
+                    done.add(stage.name)
+                    continue
+                print("Running stage {}".format(stage.name))
+                rerun.add(stage.name)
+                worker = threading.Thread(target=self._execute, args=(stage, fingerprint, completed))
+                worker.daemon = True
+                running[stage.name] = worker
+                worker.start()
+
+            if not running:
+                if pending and (failures or not [stage for stage in pending
+                                                 if all(dependency in done for dependency in stage.after)]):
+                    break
+                continue
+
+            name, error = completed.get()
+            running.pop(name).join()
+            if error is None:
+                self.status[name] = 'completed'
+                done.add(name)
+            else:
+                print("Stage {0} failed: {1}".format(name, error))
+                print(getattr(error, 'stage_traceback', ''))
+                self.status[name] = 'failed'
+                failures[name] = error
+                with self._lock:
+                    self.checkpoints.pop(name, None)
+                    self._save_checkpoints()
+
+        for stage in pending:
+            self.status[stage.name] = 'not run'
+        if failures:
+            raise StageFailed(failures)
+        return self.results
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
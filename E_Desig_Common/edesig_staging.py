@@ -0,0 +1,293 @@
+'''
+Local staging of network inputs and bulk transfer of outputs to network shares.
+
+Reading from and writing to network shares file by file is what makes a run from a network path several times slower
+than a run from the C: drive. Inputs are therefore copied once into local scratch storage and every step reads the
+local copy, and outputs are built locally and pushed to their shares in one bulk transfer at the end.
+
+A transfer splits every file into fixed-size chunks and copies the chunks of all of its files across a pool of threads,
+recording the SHA-256 digest of each chunk as it is read. Chunks are written into {destination}.part and recorded in a
+{destination}.part.json journal as they complete, so a retry (within the transfer, or a later run) only copies the
+chunks that are still missing. Once every chunk is in place the .part file is read back and checked chunk by chunk,
+and against the whole-file SHA-256 where one is known (for example from the archive manifest), before it is renamed
+into place with the source's modification time. A destination whose size and modification time already match its
+source is skipped.
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, json, time, hashlib, threading, traceback, collections
+from multiprocessing.pool import ThreadPool
+
+import edesig_manifest
+
+DEFAULT_WORKERS = 8
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_DELAY = 5
+
+PART_SUFFIX = '.part'
+JOURNAL_SUFFIX = '.part.json'
+
+# Modification times are compared to within this many seconds, the resolution of some network file systems
+
+MTIME_TOLERANCE = 2
+
+STATUS_COPIED = 'copied'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+
+TransferResult = collections.namedtuple('TransferResult', ['source', 'destination', 'status', 'bytes', 'chunks',
+                                                           'attempts', 'sha256', 'error'])
+
+
+class TransferError(Exception):
+    '''Raised by TransferReport.check when one or more files could not be transferred.'''
+
+    def __init__(self, results):
+        Exception.__init__(self, "File transfer(s) failed: {}".format(
+            "; ".join("{0}: {1}".format(result.source, result.error) for result in results)))
+        self.results = results
+
+
+class TransferReport(object):
+    '''Outcome of a transfer: one TransferResult per file, in the order the files were given.'''
+
+    def __init__(self, results, seconds):
+        self.results = results
+        self.seconds = seconds
+
+    @property
+    def failed(self):
+        return [result for result in self.results if result.status == STATUS_FAILED]
+
+    def counts(self):
+        return collections.OrderedDict([
+            ('files', len(self.results)),
+            ('copied', len([result for result in self.results if result.status == STATUS_COPIED])),
+            ('skipped', len([result for result in self.results if result.status == STATUS_SKIPPED])),
+            ('failed', len(self.failed)),
+            ('bytes', sum(result.bytes for result in self.results if result.status == STATUS_COPIED)),
+        ])
+
+    def summary(self):
+        counts = self.counts()
+        lines = ["Transfer: {0} files, {1} copied ({2:.1f} MB), {3} already up to date, {4} failed in {5:.1f} s".format(
+            counts['files'], counts['copied'], counts['bytes'] / 1024.0 ** 2, counts['skipped'], counts['failed'],
+            self.seconds)]
+        for result in self.failed:
+            lines.append("  {0}: {1}".format(result.source, result.error))
+        return '\n'.join(lines)
+
+    def check(self):
+        '''Raise TransferError if any file failed.'''
+
+        if self.failed:
+            raise TransferError(self.failed)
+
+
+class _FileTransfer(object):
+    # The state of one file: its chunks, the digests of those already copied and its journal
+
+    def __init__(self, source, destination, sha256, chunk_size):
+        self.source = source
+        self.destination = destination
+        self.sha256 = sha256
+        self.chunk_size = chunk_size
+        self.part_path = destination + PART_SUFFIX
+        self.journal_path = destination + JOURNAL_SUFFIX
+        self.lock = threading.Lock()
+        self.size = 0
+        self.mtime = None
+        self.digests = {}
+        self.status = None
+        self.attempts = 0
+        self.copied_bytes = 0
+        self.result_sha256 = None
+        self.error = None
+
+    @property
+    def chunks(self):
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def _journal_header(self):
+        return {'source': self.source, 'size': self.size, 'mtime': self.mtime, 'chunk_size': self.chunk_size}
+
+    def prepare(self):
+        '''Stat the source and either skip the file, resume it from its journal or start it afresh.'''
+
+        status = os.stat(self.source)
+        self.size = status.st_size
+        self.mtime = status.st_mtime
+        if os.path.isfile(self.destination):
+            destination_status = os.stat(self.destination)
+            if destination_status.st_size == self.size and abs(destination_status.st_mtime - self.mtime) <= \
+                    MTIME_TOLERANCE:
+                self.status = STATUS_SKIPPED
+                return
+
+        if os.path.isfile(self.journal_path) and os.path.isfile(self.part_path):
+            try:
+                with open(self.journal_path, 'r') as journal_file:
+                    journal = json.load(journal_file)
+            except ValueError:
+                journal = {}
+            if dict((key, journal.get(key)) for key in self._journal_header()) == self._journal_header() and \
+                    os.path.getsize(self.part_path) == self.size:
+                self.digests = dict((int(index), digest) for index, digest in journal.get('chunks', {}).items())
+                if self.digests:
+                    print("Resuming {0}: {1} of {2} chunks already copied".format(self.destination,
+                                                                                  len(self.digests), self.chunks))
+                return
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(self.destination))):
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.destination)))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(os.path.abspath(self.destination))):
+                    raise
+        with open(self.part_path, 'wb') as part_file:
+            part_file.truncate(self.size)
+        self.digests = {}
+        self._save_journal()
+
+    def _save_journal(self):
+        journal = self._journal_header()
+        journal['chunks'] = dict((str(index), digest) for index, digest in self.digests.items())
+        with open(self.journal_path + '.tmp', 'w') as journal_file:
+            json.dump(journal, journal_file)
+        edesig_manifest.replace_file(self.journal_path + '.tmp', self.journal_path)
+
+    def missing_chunks(self):
+        return [index for index in range(self.chunks) if index not in self.digests]
+
+    def copy_chunk(self, index):
+        offset = index * self.chunk_size
+        with open(self.source, 'rb') as source_file:
+            source_file.seek(offset)
+            block = source_file.read(min(self.chunk_size, self.size - offset))
+        with open(self.part_path, 'r+b') as part_file:
+            part_file.seek(offset)
+            part_file.write(block)
+        with self.lock:
+            self.digests[index] = hashlib.sha256(block).hexdigest()
+            self.copied_bytes += len(block)
+            self._save_journal()
+
+    def finish(self):
+        '''Read the .part file back, check it against the chunk digests and the expected hash, and move it in place.'''
+
+        whole_digest = hashlib.sha256()
+        bad_chunks = []
+        with open(self.part_path, 'rb') as part_file:
+            for index in range(self.chunks):
+                block = part_file.read(self.chunk_size)
+                whole_digest.update(block)
+                if hashlib.sha256(block).hexdigest() != self.digests.get(index):
+                    bad_chunks.append(index)
+        if bad_chunks:
+            with self.lock:
+                for index in bad_chunks:
+                    self.digests.pop(index, None)
+                self._save_journal()
+            raise IOError("{0} of {1} chunks of {2} do not match the source".format(len(bad_chunks), self.chunks,
+                                                                                 self.destination))
+        if self.sha256 is not None and whole_digest.hexdigest() != self.sha256:
+            with self.lock:
+                self.digests = {}
+                self._save_journal()
+            raise IOError("{0} does not match the expected SHA-256 of {1}".format(self.destination, self.source))
+
+        edesig_manifest.replace_file(self.part_path, self.destination)
+        os.utime(self.destination, (self.mtime, self.mtime))
+        os.remove(self.journal_path)
+        self.result_sha256 = whole_digest.hexdigest()
+        self.status = STATUS_COPIED
+
+    def result(self):
+        return TransferResult(self.source, self.destination, self.status or STATUS_FAILED, self.copied_bytes,
+                              self.chunks if self.status != STATUS_SKIPPED else 0, self.attempts, self.result_sha256,
+                              self.error)
+
+
+def _run_chunk(task):
+    # Copy one chunk, catching the error so the file is reported as failed rather than stopping the pool
+
+    file_transfer, index = task
+    try:
+        file_transfer.copy_chunk(index)
+        return None
+    except Exception as error:
+        print("Copy of chunk {0} of {1} failed: {2}".format(index, file_transfer.source, error))
+        return file_transfer, "{0}: {1}".format(type(error).__name__, error)
+
+
+def transfer(files, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE, retries=DEFAULT_RETRIES,
+             retry_delay=DEFAULT_RETRY_DELAY):
+    '''
+    Copy files, (source, destination) or (source, destination, sha256) tuples, in parallel chunks across workers
+    threads. A file that fails is retried up to retries times, resuming with its missing chunks. Returns a
+    TransferReport; call its check() to raise TransferError if any file failed.
+    '''
+
+    started = time.time()
+    file_transfers = [_FileTransfer(item[0], item[1], item[2] if len(item) > 2 else None, chunk_size)
+                      for item in files]
+    pending = list(file_transfers)
+    pool = ThreadPool(max(1, int(workers)))
+    try:
+        attempt = 0
+        while pending:
+            attempt += 1
+            tasks = []
+            for file_transfer in pending:
+                file_transfer.attempts = attempt
+                file_transfer.error = None
+                try:
+                    file_transfer.prepare()
+                except Exception as error:
+                    print(traceback.format_exc())
+                    file_transfer.error = "{0}: {1}".format(type(error).__name__, error)
+                    continue
+                if file_transfer.status != STATUS_SKIPPED:
+                    tasks += [(file_transfer, index) for index in file_transfer.missing_chunks()]
+
+            for failure in pool.map(_run_chunk, tasks, chunksize=1):
+                if failure is not None:
+                    failure[0].error = failure[0].error or failure[1]
+
+            for file_transfer in pending:
+                if file_transfer.status is None and file_transfer.error is None:
+                    try:
+                        file_transfer.finish()
+                    except Exception as error:
+                        print("Verification of {0} failed: {1}".format(file_transfer.destination, error))
+                        file_transfer.error = "{0}: {1}".format(type(error).__name__, error)
+
+            pending = [file_transfer for file_transfer in pending if file_transfer.status is None]
+            if pending and attempt <= retries:
+                print("Retrying {0} file(s) (attempt {1})".format(len(pending), attempt + 1))
+                time.sleep(retry_delay * attempt)
+            elif pending:
+                break
+    finally:
+        pool.close()
+        pool.join()
+
+    report = TransferReport([file_transfer.result() for file_transfer in file_transfers], time.time() - started)
+    print(report.summary())
+    return report
+
+
+def stage_files(files, staging_path, **options):
+    '''
+    Copy files, (source, sha256) pairs with sha256 None where it is not known, into the local directory staging_path
+    under their own names and return the staged paths in the same order. Raises TransferError if any file could not
+    be staged. options are passed to transfer().
+    '''
+
+    files = list(files)
+    staged_paths = [os.path.join(staging_path, os.path.basename(source)) for source, sha256 in files]
+    transfer([(source, staged_path, sha256) for (source, sha256), staged_path in zip(files, staged_paths)],
+             **options).check()
+    return staged_paths
@@ -0,0 +1,119 @@
+'''
+Packed Sort-Tile-Recursive (STR) tree over bounding boxes, with batched point and box queries.
+
+The tree is bulk-loaded once: boxes are sorted into vertical slices by x, each slice is sorted by y and cut into leaves
+of node_capacity boxes, and the same tiling is applied to the nodes of each level until a single root remains. Every
+node covers a contiguous range of the level below it, so the tree is a handful of flat NumPy arrays.
+
+Queries are answered for a whole batch at once: the (query, node) pairs of each level whose boxes overlap are expanded
+into the (query, child) pairs of the next level with vectorized array operations, down to the (query, item) pairs.
+'''
+
+import numpy as np
+
+import edesig_geometry
+
+DEFAULT_NODE_CAPACITY = 16
+
+
+def _str_order(xmin, ymin, xmax, ymax, node_capacity):
+    # Return the order that tiles boxes into STR nodes of node_capacity boxes.
+
+    count = len(xmin)
+    node_count = int(np.ceil(count / float(node_capacity)))
+    slice_count = int(np.ceil(np.sqrt(node_count)))
+    slice_size = slice_count * node_capacity
+
+    by_x = np.argsort((xmin + xmax) / 2.0, kind='mergesort')
+    slice_of = np.arange(count) // slice_size
+    center_y = ((ymin + ymax) / 2.0)[by_x]
+    return by_x[np.lexsort((center_y, slice_of))]
+
+
+class _Level(object):
+    def __init__(self, xmin, ymin, xmax, ymax, child_start, child_count):
+        self.xmin = xmin
+        self.ymin = ymin
+        self.xmax = xmax
+        self.ymax = ymax
+        self.child_start = child_start
+        self.child_count = child_count
+
+    def __len__(self):
+        return len(self.xmin)
+
+    def take(self, order):
+        return _Level(self.xmin[order], self.ymin[order], self.xmax[order], self.ymax[order],
+                      self.child_start[order], self.child_count[order])
+
+
+def _pack(level, node_capacity):
+    # Group consecutive entries of level into parent nodes of node_capacity entries.
+
+    starts = np.arange(0, len(level), node_capacity, dtype=np.int64)
+    counts = np.minimum(node_capacity, len(level) - starts)
+    return _Level(np.minimum.reduceat(level.xmin, starts), np.minimum.reduceat(level.ymin, starts),
+                  np.maximum.reduceat(level.xmax, starts), np.maximum.reduceat(level.ymax, starts), starts, counts)
+
+
+class STRTree(object):
+    '''
+    Packed STR tree over boxes (xmin, ymin, xmax, ymax). Queries return pairs of query positions and item positions,
+    where an item position is the index of the box in the arrays the tree was built from. Boxes with NaN bounds
+    (empty geometries) are left out of the tree.
+    '''
+
+    def __init__(self, xmin, ymin, xmax, ymax, node_capacity=DEFAULT_NODE_CAPACITY):
+        bounds = [np.asarray(values, dtype=np.float64) for values in (xmin, ymin, xmax, ymax)]
+        items = np.flatnonzero(np.isfinite(bounds[0]) & np.isfinite(bounds[1]) & np.isfinite(bounds[2]) &
+                               np.isfinite(bounds[3]))
+        self.node_capacity = max(2, int(node_capacity))
+        self.size = len(bounds[0])
+
+        order = _str_order(*[values[items] for values in bounds] + [self.node_capacity])
+        self.items = items[order]
+        level = _Level(*[values[self.items] for values in bounds] +
+                       [np.zeros(len(self.items), dtype=np.int64), np.zeros(len(self.items), dtype=np.int64)])
+
+        # levels[0] holds the items, levels[-1] the root. Each parent covers a contiguous range of the level below.
+
+        self.levels = [level]
+        while len(level) > 1:
+            level = _pack(level, self.node_capacity)
+            if len(level) > 1:
+                level = level.take(_str_order(level.xmin, level.ymin, level.xmax, level.ymax, self.node_capacity))
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _query(self, query_xmin, query_ymin, query_xmax, query_ymax):
+        query_count = len(query_xmin)
+        if not len(self.items) or not query_count:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        query = np.arange(query_count, dtype=np.int64)
+        node = np.zeros(query_count, dtype=np.int64)
+        for depth in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[depth]
+            overlaps = ((level.xmin[node] <= query_xmax[query]) & (level.xmax[node] >= query_xmin[query]) &
+                        (level.ymin[node] <= query_ymax[query]) & (level.ymax[node] >= query_ymin[query]))
+            query = query[overlaps]
+            node = node[overlaps]
+            if depth:
+                counts = level.child_count[node]
+                query = np.repeat(query, counts)
+                node = edesig_geometry.concatenate_ranges(level.child_start[node], counts)
+        return query, self.items[node]
+
+    def query_points(self, x, y):
+        '''Return (point position, item position) pairs for every box that contains point (x[i], y[i]).'''
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        return self._query(x, y, x, y)
+
+    def query_boxes(self, xmin, ymin, xmax, ymax):
+        '''Return (query position, item position) pairs for every box that intersects query box i.'''
+
+        return self._query(*[np.asarray(values, dtype=np.float64) for values in (xmin, ymin, xmax, ymax)])
@@ -0,0 +1,218 @@
+'''
+Synthetic E-Designation inputs at realistic and stress scales, for benchmarking.
+
+synthetic_layers() builds MapPLUTO-like and Tax Lot-like polygon layers laid out on a grid across the New York State
+Plane (Long Island, feet) extent of the city. Most lots are single rectangles, and a share are multipart, have a
+hole or are concave (U and L shapes, whose centroids fall outside the lot, as with corner and through lots). The Tax
+Lot layer holds every MapPLUTO lot plus a share of condominium unit lots (lot numbers 1001 and up) that
+MapPLUTO does not carry.
+
+write_edesig_export() writes a 14-column E-Designation export whose BBLs are drawn mostly from MapPLUTO, with a share
+of condominium unit BBLs (matched by Tax Lot only), a share of BBLs found in neither layer and a share of malformed
+lines.
+'''
+
+import collections
+import numpy as np
+import pandas as pd
+
+import edesig_bbl, edesig_geometry, edesig_ingest
+
+# NYC extent in State Plane feet
+
+CITY_EXTENT = (913000.0, 120000.0, 1067000.0, 273000.0)
+
+LOTS_PER_BLOCK = 30
+CONDO_UNIT_FIRST_LOT = 1001
+
+# Number of E-Designation rows and MapPLUTO lots for each named scale
+
+SCALES = collections.OrderedDict([
+    ('small', {'edesig_rows': 10000, 'lots': 100000}),
+    ('realistic', {'edesig_rows': 40000, 'lots': 860000}),
+    ('stress', {'edesig_rows': 200000, 'lots': 2000000}),
+])
+
+SyntheticLayers = collections.namedtuple('SyntheticLayers', ['mappluto_bbl', 'mappluto', 'taxlot_bbl', 'taxlot'])
+
+
+def _rectangles(xmin, ymin, xmax, ymax):
+    # Return an (n, 4, 2) array with the four corners of each rectangle.
+
+    return np.stack([np.stack([xmin, ymin], axis=1), np.stack([xmax, ymin], axis=1),
+                     np.stack([xmax, ymax], axis=1), np.stack([xmin, ymax], axis=1)], axis=1)
+
+
+def _u_shapes(xmin, ymin, xmax, ymax):
+    # Return an (n, 8, 2) array with the corners of a U open at the top: two arms a quarter of the width each on a
+    # base a fifth of the height, so the centroid falls in the opening.
+
+    arm = (xmax - xmin) / 4.0
+    base = ymin + (ymax - ymin) / 5.0
+    return np.stack([np.stack(corner, axis=1) for corner in [
+        (xmin, ymin), (xmax, ymin), (xmax, ymax), (xmax - arm, ymax), (xmax - arm, base), (xmin + arm, base),
+        (xmin + arm, ymax), (xmin, ymax)]], axis=1)
+
+
+def _l_shapes(xmin, ymin, xmax, ymax):
+    # Return an (n, 6, 2) array with the corners of an L whose arms are a fifth of the width and height, so the
+    # centroid falls beside both arms.
+
+    arm_x = xmin + (xmax - xmin) / 5.0
+    arm_y = ymin + (ymax - ymin) / 5.0
+    return np.stack([np.stack(corner, axis=1) for corner in [
+        (xmin, ymin), (xmax, ymin), (xmax, arm_y), (arm_x, arm_y), (arm_x, ymax), (xmin, ymax)]], axis=1)
+
+
+def synthetic_lots(count, multipart_share=0.02, hole_share=0.01, concave_share=0.03, seed=0):
+    '''
+    Return FlatPolygons holding count lots, one per grid cell across the city extent, in random cell order.
+    Single-rectangle lots come first, then multipart lots (two rectangles), then lots with a hole, then concave lots
+    (U shapes, then L shapes).
+    '''
+
+    random = np.random.RandomState(seed)
+    multipart_count = int(count * multipart_share)
+    hole_count = int(count * hole_share)
+    concave_count = int(count * concave_share)
+    u_count = concave_count // 2
+    l_count = concave_count - u_count
+    simple_count = count - multipart_count - hole_count - concave_count
+
+    side = int(np.ceil(np.sqrt(count)))
+    cell_width = (CITY_EXTENT[2] - CITY_EXTENT[0]) / side
+    cell_height = (CITY_EXTENT[3] - CITY_EXTENT[1]) / side
+    cells = random.permutation(side * side)[:count]
+    xmin = CITY_EXTENT[0] + (cells % side) * cell_width + random.uniform(0.02, 0.1, count) * cell_width
+    ymin = CITY_EXTENT[1] + (cells // side) * cell_height + random.uniform(0.02, 0.1, count) * cell_height
+    xmax = xmin + random.uniform(0.5, 0.88, count) * cell_width
+    ymax = ymin + random.uniform(0.5, 0.88, count) * cell_height
+
+    simple = slice(0, simple_count)
+    multipart = slice(simple_count, simple_count + multipart_count)
+    holed = slice(simple_count + multipart_count, simple_count + multipart_count + hole_count)
+    u_shaped = slice(holed.stop, holed.stop + u_count)
+    l_shaped = slice(u_shaped.stop, count)
+
+    xmid = (xmin + xmax) / 2.0
+    gap = (xmax - xmin) * 0.05
+    hole_xmin = xmin + (xmax - xmin) / 3.0
+    hole_ymin = ymin + (ymax - ymin) / 3.0
+    hole_xmax = xmax - (xmax - xmin) / 3.0
+    hole_ymax = ymax - (ymax - ymin) / 3.0
+
+    rings = [
+        _rectangles(xmin[simple], ymin[simple], xmax[simple], ymax[simple]),
+        np.stack([_rectangles(xmin[multipart], ymin[multipart], xmid[multipart] - gap[multipart], ymax[multipart]),
+                  _rectangles(xmid[multipart] + gap[multipart], ymin[multipart], xmax[multipart], ymax[multipart])],
+                 axis=1).reshape(-1, 4, 2),
+        np.stack([_rectangles(xmin[holed], ymin[holed], xmax[holed], ymax[holed]),
+                  _rectangles(hole_xmin[holed], hole_ymin[holed], hole_xmax[holed], hole_ymax[holed])],
+                 axis=1).reshape(-1, 4, 2),
+    ]
+    coords = np.concatenate([ring.reshape(-1, 2) for ring in rings] + [
+        _u_shapes(xmin[u_shaped], ymin[u_shaped], xmax[u_shaped], ymax[u_shaped]).reshape(-1, 2),
+        _l_shapes(xmin[l_shaped], ymin[l_shaped], xmax[l_shaped], ymax[l_shaped]).reshape(-1, 2)])
+    ring_lengths = np.concatenate([np.full(simple_count + 2 * multipart_count + 2 * hole_count, 4, dtype=np.int64),
+                                   np.full(u_count, 8, dtype=np.int64), np.full(l_count, 6, dtype=np.int64)])
+
+    rings_per_part = np.concatenate([np.ones(simple_count + 2 * multipart_count, dtype=np.int64),
+                                     np.full(hole_count, 2, dtype=np.int64),
+                                     np.ones(concave_count, dtype=np.int64)])
+    parts_per_geometry = np.concatenate([np.ones(simple_count, dtype=np.int64),
+                                         np.full(multipart_count, 2, dtype=np.int64),
+                                         np.ones(hole_count + concave_count, dtype=np.int64)])
+    return edesig_geometry.FlatPolygons(coords, np.concatenate([[0], np.cumsum(ring_lengths)]),
+                                        np.concatenate([[0], np.cumsum(rings_per_part)]),
+                                        np.concatenate([[0], np.cumsum(parts_per_geometry)]))
+
+
+def synthetic_bbls(count, seed=0):
+    '''Return count unique, valid BBLs spread over the five boroughs, LOTS_PER_BLOCK lots per block, shuffled.'''
+
+    block_index = np.arange(count, dtype=np.int64) // LOTS_PER_BLOCK
+    lot = np.arange(count, dtype=np.int64) % LOTS_PER_BLOCK + 1
+    boro = block_index % 5 + 1
+    block = block_index // 5 + 1
+    return np.random.RandomState(seed).permutation(edesig_bbl.encode_bbl(boro, block, lot))
+
+
+def synthetic_layers(lots, condo_share=0.05, seed=0):
+    '''
+    Return SyntheticLayers with lots MapPLUTO lots and, in the Tax Lot layer, those lots plus condo_share * lots
+    condominium unit lots sharing the geometry of a MapPLUTO lot on the same block.
+    '''
+
+    random = np.random.RandomState(seed + 1)
+    mappluto_bbl = synthetic_bbls(lots, seed)
+    mappluto = synthetic_lots(lots, seed=seed)
+
+    condo_count = int(lots * condo_share)
+    condo_base = random.choice(lots, condo_count, replace=False)
+    boro, block, lot = edesig_bbl.decode_bbl(mappluto_bbl[condo_base])
+    condo_bbl = edesig_bbl.encode_bbl(boro, block, CONDO_UNIT_FIRST_LOT + np.arange(condo_count) % 5000)
+    condo_bbl, first = np.unique(condo_bbl, return_index=True)
+    condo_base = condo_base[first]
+
+    taxlot_bbl = np.concatenate([mappluto_bbl, condo_bbl])
+    taxlot = mappluto.take(np.concatenate([np.arange(lots), condo_base]))
+    return SyntheticLayers(mappluto_bbl, mappluto, taxlot_bbl, taxlot)
+
+
+def write_edesig_export(path, rows, layers, condo_share=0.03, unmatched_share=0.02, malformed_share=0.001, seed=0):
+    '''
+    Write a synthetic E-Designation export of rows lines to path, drawing BBLs from layers (see synthetic_layers).
+    Returns the number of lines of each kind as a dict.
+    '''
+
+    random = np.random.RandomState(seed + 2)
+    condo_bbl = layers.taxlot_bbl[len(layers.mappluto_bbl):]
+    condo_rows = min(int(rows * condo_share), len(condo_bbl))
+    unmatched_rows = int(rows * unmatched_share)
+    malformed_rows = int(rows * malformed_share)
+    mappluto_rows = rows - condo_rows - unmatched_rows - malformed_rows
+
+    unmatched_boro, unmatched_block, unmatched_lot = edesig_bbl.decode_bbl(random.choice(layers.mappluto_bbl,
+                                                                                         unmatched_rows))
+    bbl = np.concatenate([random.choice(layers.mappluto_bbl, mappluto_rows),
+                          random.choice(condo_bbl, condo_rows, replace=False) if condo_rows else
+                          np.zeros(0, dtype=np.int64),
+                          edesig_bbl.encode_bbl(unmatched_boro, unmatched_block, 9000 + unmatched_lot)])
+    order = random.permutation(len(bbl))
+    bbl = bbl[order]
+    boro, block, lot = edesig_bbl.decode_bbl(bbl)
+
+    def dates(share):
+        days = pd.to_datetime('2000-01-01') + pd.to_timedelta(random.randint(0, 7300, len(bbl)), unit='D')
+        text = np.asarray(days.strftime('%m/%d/%Y'), dtype=object)
+        text[random.uniform(size=len(bbl)) >= share] = ''
+        return text
+
+    # Each HAZMAT/AIR/NOISE flag is set exactly when its date is
+
+    flags = np.array(['', 'Yes'], dtype=object)
+    hazmat_d, air_date, noise_d = dates(0.5), dates(0.5), dates(0.5)
+    export = pd.DataFrame({
+        'ENUMBER': ['E-{}'.format(number) for number in random.randint(1, 900, len(bbl))],
+        'E_DATE': dates(1.0),
+        'BOROCODE': boro,
+        'TAXBLOCK': block,
+        'TAXLOT': lot,
+        'HAZMAT': flags[(hazmat_d != '').astype(int)],
+        'AIR': flags[(air_date != '').astype(int)],
+        'NOISE': flags[(noise_d != '').astype(int)],
+        'HAZMAT_D': hazmat_d,
+        'AIR_DATE': air_date,
+        'NOISE_D': noise_d,
+        'CEQR_NUM': ['{0:02d}DCP{1:03d}{2}'.format(year, number, 'KMQRX'[borough - 1]) for year, number, borough in
+                     zip(random.randint(0, 21, len(bbl)), random.randint(1, 999, len(bbl)), boro)],
+        'ULURP_NUM': ['C{0:06d}ZM{1}'.format(number, 'KMQRX'[borough - 1]) for number, borough in
+                      zip(random.randint(1, 999999, len(bbl)), boro)],
+        'BBL': bbl,
+    }, columns=edesig_ingest.EDESIG_COLUMNS)
+
+    malformed = export.iloc[:malformed_rows].copy()
+    malformed['TAXBLOCK'] = 'N/A'
+    pd.concat([export, malformed]).sample(frac=1, random_state=seed).to_csv(path, header=False, index=False)
+    return {'mappluto': mappluto_rows, 'condo': condo_rows, 'unmatched': unmatched_rows, 'malformed': malformed_rows}
+
@@ -0,0 +1,247 @@
+'''
+Per-stage run telemetry for the Pull, Generation and Distribution scripts, with historical regression detection.
+
+Every stage of a run appends one JSON line to a telemetry file: the script and run it belongs to, wall time, CPU time,
+rows in and out, bytes read and written, whether it was served from a cache or skipped, and whether it failed. CPU
+time is taken from os.times() for the whole process (and its finished child processes), so for stages that run
+concurrently it includes the work of the stages running alongside.
+
+The report command reads the history and flags stages whose latest duration exceeds a multiple of the rolling median
+of their previous runs:
+
+    python edesig_telemetry.py report <telemetry.jsonl> [--threshold 1.5] [--window 10]
+
+Must remain compatible with the Python 2.7 installation used by the Distribution script.
+'''
+
+import os, sys, json, time, datetime, threading, argparse, collections
+
+TELEMETRY_FILENAME = 'edesig_telemetry.jsonl'
+
+DEFAULT_THRESHOLD = 1.5
+DEFAULT_WINDOW = 10
+MIN_HISTORY = 3
+
+# Stages that finish within this many seconds of their median are not flagged, however large the ratio
+
+MIN_SECONDS = 1.0
+
+Regression = collections.namedtuple('Regression', ['script', 'stage', 'run_id', 'wall_seconds', 'median_seconds',
+                                                   'ratio', 'history'])
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageRecord(object):
+    '''Measurements for one stage. Code running the stage fills in rows, bytes and the cached/skipped flags.'''
+
+    def __init__(self, script, run_id, stage):
+        self.script = script
+        self.run_id = run_id
+        self.stage = stage
+        self.started = datetime.datetime.now().replace(microsecond=0)
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.cached = False
+        self.skipped = False
+        self.status = 'ok'
+        self.error = None
+        self.extra = {}
+
+    def as_dict(self):
+        record = {
+            'script': self.script,
+            'run_id': self.run_id,
+            'stage': self.stage,
+            'started': str(self.started),
+            'wall_seconds': round(self.wall_seconds, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'cached': self.cached,
+            'skipped': self.skipped,
+            'status': self.status,
+            'error': self.error,
+        }
+        record.update(self.extra)
+        return record
+
+
+class _StageContext(object):
+    def __init__(self, telemetry, record):
+        self.telemetry = telemetry
+        self.record = record
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = _cpu_seconds()
+        self.telemetry._local.record = self.record
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.record.wall_seconds = time.time() - self._wall
+        self.record.cpu_seconds = _cpu_seconds() - self._cpu
+        if exc_type is not None:
+            self.record.status = 'failed'
+            self.record.error = '{0}: {1}'.format(exc_type.__name__, exc_value)
+        self.telemetry._local.record = None
+        self.telemetry.write(self.record)
+        return False
+
+
+class Telemetry(object):
+    '''Appends stage records for one run of a script to a JSON lines file.'''
+
+    def __init__(self, path, script, run_id=None):
+        self.path = path
+        self.script = script
+        self.run_id = run_id or datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def stage(self, name):
+        '''Context manager timing stage name. Yields the StageRecord, which is written when the block exits.'''
+
+        return _StageContext(self, StageRecord(self.script, self.run_id, name))
+
+    def current(self):
+        '''Return the record of the stage running on this thread, or None.'''
+
+        return getattr(self._local, 'record', None)
+
+    def skipped(self, name, cached=False):
+        '''Write a record for a stage that did not run this time.'''
+
+        record = StageRecord(self.script, self.run_id, name)
+        record.skipped = True
+        record.cached = cached
+        self.write(record)
+        return record
+
+    def write(self, record):
+        with self._lock:
+            with open(self.path, 'a') as telemetry_file:
+                telemetry_file.write(json.dumps(record.as_dict(), sort_keys=True) + '\n')
+
+
+def file_size(*paths):
+    '''Return the total size in bytes of the given files and directory trees that exist.'''
+
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for directory, subdirectories, filenames in os.walk(path):
+                for filename in filenames:
+                    total += os.path.getsize(os.path.join(directory, filename))
+    return total
+
+
+def read_history(path):
+    '''Return every record in a telemetry file, skipping lines that cannot be parsed.'''
+
+    records = []
+    with open(path, 'r') as telemetry_file:
+        for line in telemetry_file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def regressions(records, threshold=DEFAULT_THRESHOLD, window=DEFAULT_WINDOW, min_history=MIN_HISTORY,
+                min_seconds=MIN_SECONDS):
+    '''
+    Compare the latest executed run of every (script, stage) with the median of up to window earlier executed runs
+    and return a Regression for each that took more than threshold times as long. Skipped, cached and failed records
+    are left out of the comparison, stages with fewer than min_history earlier runs are not judged, and stages less
+    than min_seconds slower than their median are not flagged.
+    '''
+
+    history = collections.defaultdict(list)
+    for record in records:
+        if record.get('skipped') or record.get('cached') or record.get('status') != 'ok':
+            continue
+        history[(record['script'], record['stage'])].append(record)
+
+    found = []
+    for (script, stage), stage_records in sorted(history.items()):
+        stage_records.sort(key=lambda record: record['started'])
+        latest = stage_records[-1]
+        previous = [record['wall_seconds'] for record in stage_records[:-1][-window:]]
+        if len(previous) < min_history:
+            continue
+        median = _median(previous)
+        if median > 0 and latest['wall_seconds'] > threshold * median and \
+                latest['wall_seconds'] - median >= min_seconds:
+            found.append(Regression(script, stage, latest['run_id'], latest['wall_seconds'], median,
+                                    latest['wall_seconds'] / median, len(previous)))
+    return found
+
+
+def report(records, threshold=DEFAULT_THRESHOLD, window=DEFAULT_WINDOW):
+    '''Return a plain-text summary of the latest run of every script and any stage regressions.'''
+
+    lines = []
+    latest_runs = {}
+    for record in records:
+        latest_runs[record['script']] = max(latest_runs.get(record['script'], ''), record['run_id'])
+    for script in sorted(latest_runs):
+        lines.append('{0} run {1}'.format(script, latest_runs[script]))
+        for record in records:
+            if record['script'] == script and record['run_id'] == latest_runs[script]:
+                flags = [flag for flag in ('cached', 'skipped') if record.get(flag)]
+                if record.get('status') != 'ok':
+                    flags.append('failed')
+                rows = [record.get(field) for field in ('rows_in', 'rows_out')]
+                lines.append('  {0:<28} {1:>9.1f} s wall {2:>9.1f} s cpu  rows {3}/{4}  {5}'.format(
+                    record['stage'], record['wall_seconds'], record['cpu_seconds'],
+                    *['-' if count is None else count for count in rows] + [' '.join(flags)]).rstrip())
+
+    found = regressions(records, threshold, window)
+    lines.append('')
+    if not found:
+        lines.append('No stage regressed beyond {0}x its rolling median'.format(threshold))
+    for regression in found:
+        lines.append('REGRESSION {0} {1}: {2:.1f} s in run {3} vs median {4:.1f} s of {5} runs ({6:.1f}x)'.format(
+            regression.script, regression.stage, regression.wall_seconds, regression.run_id,
+            regression.median_seconds, regression.history, regression.ratio))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="E-Designation run telemetry")
+    subparsers = parser.add_subparsers(dest='command')
+    report_parser = subparsers.add_parser('report', help="summarize the latest runs and flag stage regressions")
+    report_parser.add_argument('path', help="telemetry JSON lines file")
+    report_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                               help="flag stages slower than this multiple of their rolling median")
+    report_parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help="number of earlier runs compared")
+    args = parser.parse_args()
+
+    if args.command != 'report':
+        parser.print_help()
+        sys.exit(2)
+    history_records = read_history(args.path)
+    print(report(history_records, args.threshold, args.window))
+    sys.exit(1 if regressions(history_records, args.threshold, args.window) else 0)
@@ -0,0 +1,214 @@
+'''
+Data-quality validation of an E-Designation export, run right after it arrives and before any base-layer work.
+
+The export is split into its 14 text columns once and every check runs over whole columns at a time: the number of
+fields on each line, required values, whole-number borough/block/lot codes within range (see edesig_bbl), dates that
+parse and fall within a plausible range, the BBL column against the one rebuilt from its parts, duplicate
+(ENUMBER, BBL) keys, and HAZMAT/AIR/NOISE flags that agree with their date columns.
+
+Each check has a severity. A line with any error is rejected: it would be dropped by the ingest or could not be
+placed on a lot. Warnings are reported but do not reject the line. The report is written as a row-level rejection file
+(one row per line and check) and a plain-text summary, and the generation script stops before pulling the base
+layers when more lines are rejected than it allows.
+'''
+
+import io, csv, datetime, collections
+import numpy as np
+import pandas as pd
+
+import edesig_bbl, edesig_ingest
+
+SEVERITY_ERROR = 'error'
+SEVERITY_WARNING = 'warning'
+
+# Every check, in report order: its severity and a description for the summary
+
+CHECKS = collections.OrderedDict([
+    ('field_count', (SEVERITY_ERROR, "line does not have 14 fields")),
+    ('missing_value', (SEVERITY_ERROR, "required value is blank")),
+    ('not_integer', (SEVERITY_ERROR, "borough, block or lot is not a whole number")),
+    ('out_of_range', (SEVERITY_ERROR, "borough, block or lot is out of range")),
+    ('bad_date', (SEVERITY_ERROR, "date cannot be parsed")),
+    ('date_out_of_range', (SEVERITY_WARNING, "date is before {} or in the future")),
+    ('bbl_mismatch', (SEVERITY_WARNING, "BBL differs from the one built from borough, block and lot")),
+    ('duplicate_key', (SEVERITY_WARNING, "ENUMBER and BBL repeat an earlier line")),
+    ('flag_without_date', (SEVERITY_WARNING, "flag is set but its date is blank")),
+    ('date_without_flag', (SEVERITY_WARNING, "date is set but its flag is blank")),
+])
+
+REQUIRED_COLUMNS = ['ENUMBER', 'E_DATE', 'BOROCODE', 'TAXBLOCK', 'TAXLOT']
+
+# HAZMAT/AIR/NOISE flag columns and the date column each must agree with
+
+FLAG_DATE_COLUMNS = [('HAZMAT', 'HAZMAT_D'), ('AIR', 'AIR_DATE'), ('NOISE', 'NOISE_D')]
+
+# Dates before this are reported as out of range
+
+MIN_DATE = '1970-01-01'
+
+ISSUE_COLUMNS = ['LINE', 'COLUMN', 'CHECK', 'SEVERITY', 'VALUE']
+REJECTION_FILENAME = '{}_rejected.csv'
+SUMMARY_FILENAME = '{}_validation.txt'
+
+
+class ValidationReport(object):
+    '''Outcome of a validation run: the number of lines read and one row per line and failed check.'''
+
+    def __init__(self, rows_read, issues):
+        self.rows_read = rows_read
+        self.issues = issues
+
+    @property
+    def rejected_lines(self):
+        '''Line numbers with at least one error, in file order.'''
+
+        return np.unique(self.issues['LINE'].values[(self.issues['SEVERITY'] == SEVERITY_ERROR).values])
+
+    @property
+    def warned_lines(self):
+        return np.unique(self.issues['LINE'].values[(self.issues['SEVERITY'] == SEVERITY_WARNING).values])
+
+    def passed(self, max_rejected=0):
+        return len(self.rejected_lines) <= max_rejected
+
+    def counts(self):
+        return collections.OrderedDict((check, int((self.issues['CHECK'] == check).sum())) for check in CHECKS)
+
+    def summary(self):
+        lines = ["Validation: {0} lines read, {1} rejected, {2} with warnings".format(
+            self.rows_read, len(self.rejected_lines), len(self.warned_lines))]
+        for check, count in self.counts().items():
+            if count:
+                severity, description = CHECKS[check]
+                lines.append("  {0} {1} ({2}): {3}".format(count, check, severity, description.format(MIN_DATE)))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        '''Write every issue, ordered by line, to a comma-delimited rejection file.'''
+
+        self.issues.sort_values(['LINE', 'CHECK'], kind='mergesort').to_csv(path, index=False)
+
+    def write_summary(self, path):
+        with io.open(path, 'w', encoding='utf-8') as summary_file:
+            summary_file.write(u'{}\n'.format(self.summary()))
+
+
+class _Column(object):
+    # One export column factorized into distinct stripped values and a code per line, so that parsing and range
+    # checks run once per distinct value rather than once per line.
+
+    def __init__(self, values):
+        self.codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        self.uniques = np.array([value.strip() for value in uniques], dtype=object)
+        self.values = self.uniques[self.codes]
+        self.blank = (self.uniques == '')[self.codes]
+
+    def expand(self, unique_values):
+        return np.asarray(unique_values)[self.codes]
+
+
+def read_fields(path, encoding='utf-8'):
+    '''
+    Read the export at path into a DataFrame of text, one column per export column and indexed by line number, plus
+    the line numbers and text of lines that do not have one field per column.
+    '''
+
+    rows = []
+    line_numbers = []
+    malformed = []
+    with io.open(path, 'r', encoding=encoding, errors='replace', newline='') as export:
+        reader = csv.reader(export)
+        for fields in reader:
+            if not fields or (len(fields) == 1 and not fields[0].strip()):
+                continue
+            if len(fields) != len(edesig_ingest.EDESIG_COLUMNS):
+                malformed.append((reader.line_num, ','.join(fields)))
+                continue
+            rows.append(fields)
+            line_numbers.append(reader.line_num)
+    columns = list(zip(*rows)) or [()] * len(edesig_ingest.EDESIG_COLUMNS)
+    return pd.DataFrame(collections.OrderedDict((column, np.array(values, dtype=object)) for column, values in
+                                                zip(edesig_ingest.EDESIG_COLUMNS, columns)),
+                        index=pd.Index(line_numbers, dtype=np.int64, name='LINE')), malformed
+
+
+def validate_fields(fields, malformed=(), date_format=None, today=None):
+    '''
+    Run every check over fields and malformed as returned by read_fields. date_format is handed to
+    pandas.to_datetime, as in the ingest; None lets pandas infer it. Returns a ValidationReport.
+    '''
+
+    issues = []
+    lines = fields.index.values
+    columns = dict((column, _Column(fields[column].values)) for column in edesig_ingest.EDESIG_COLUMNS)
+
+    def add(check, column, failed):
+        positions = np.flatnonzero(failed)
+        if len(positions):
+            issues.append(pd.DataFrame({'LINE': lines[positions], 'COLUMN': column, 'CHECK': check,
+                                        'SEVERITY': CHECKS[check][0], 'VALUE': columns[column].values[positions]},
+                                       columns=ISSUE_COLUMNS))
+
+    if malformed:
+        issues.append(pd.DataFrame({'LINE': [line for line, text in malformed], 'COLUMN': '', 'CHECK': 'field_count',
+                                    'SEVERITY': CHECKS['field_count'][0], 'VALUE': [text for line, text in malformed]},
+                                   columns=ISSUE_COLUMNS))
+
+    for column in REQUIRED_COLUMNS:
+        add('missing_value', column, columns[column].blank)
+
+    # Borough, block and lot: whole numbers within the ranges of the BBL codec
+
+    codes = {}
+    for column, low, high in (('BOROCODE', edesig_bbl.BORO_MIN, edesig_bbl.BORO_MAX),
+                              ('TAXBLOCK', edesig_bbl.BLOCK_MIN, edesig_bbl.BLOCK_MAX),
+                              ('TAXLOT', edesig_bbl.LOT_MIN, edesig_bbl.LOT_MAX)):
+        values = np.asarray(pd.to_numeric(columns[column].uniques, errors='coerce'), dtype=np.float64)
+        whole = np.isfinite(values)
+        whole[whole] = values[whole] == np.floor(values[whole])
+        values = np.where(whole, values, 0).astype(np.int64)
+        whole = columns[column].expand(whole)
+        values = columns[column].expand(values)
+        add('not_integer', column, ~whole & ~columns[column].blank)
+        add('out_of_range', column, whole & ((values < low) | (values > high)))
+        codes[column] = (values, whole)
+
+    valid = edesig_bbl.valid_parts(*[codes[column][0] for column in edesig_ingest.CODE_COLUMNS])
+    for column in edesig_ingest.CODE_COLUMNS:
+        valid &= codes[column][1]
+    bbl = np.where(valid, edesig_bbl.encode_bbl(*[codes[column][0] for column in edesig_ingest.CODE_COLUMNS],
+                                                errors='coerce'), edesig_bbl.INVALID_BBL)
+    export_bbl = columns['BBL'].expand(np.asarray(pd.to_numeric(columns['BBL'].uniques, errors='coerce'),
+                                                  dtype=np.float64))
+    add('bbl_mismatch', 'BBL', valid & ~columns['BBL'].blank & ~(export_bbl == bbl))
+
+    # Dates: parsed as the ingest parses them, then checked against a plausible range
+
+    today = pd.Timestamp(today or datetime.date.today())
+    for column in edesig_ingest.DATE_COLUMNS:
+        parsed = pd.to_datetime(pd.Series(columns[column].uniques), format=date_format, errors='coerce')
+        parsed_ok = columns[column].expand(parsed.notnull().values)
+        in_range = columns[column].expand(((parsed >= pd.Timestamp(MIN_DATE)) & (parsed <= today)).values)
+        add('bad_date', column, ~parsed_ok & ~columns[column].blank)
+        add('date_out_of_range', column, parsed_ok & ~in_range)
+
+    # Each HAZMAT/AIR/NOISE flag must be set exactly when its date is
+
+    for flag_column, date_column in FLAG_DATE_COLUMNS:
+        add('flag_without_date', flag_column, ~columns[flag_column].blank & columns[date_column].blank)
+        add('date_without_flag', date_column, columns[flag_column].blank & ~columns[date_column].blank)
+
+    # Duplicate (ENUMBER, BBL) keys among the lines whose BBL could be built; the first line of each key is kept
+
+    keys = pd.DataFrame({'ENUMBER': columns['ENUMBER'].values, 'BBL': bbl})
+    add('duplicate_key', 'ENUMBER', valid & keys.duplicated(keep='first').values)
+
+    issues = pd.concat(issues, ignore_index=True) if issues else pd.DataFrame(columns=ISSUE_COLUMNS)
+    return ValidationReport(len(fields) + len(malformed), issues)
+
+
+def validate_export(path, date_format=None, encoding='utf-8', today=None):
+    '''Validate the export at path. Returns a ValidationReport.'''
+
+    fields, malformed = read_fields(path, encoding)
+    return validate_fields(fields, malformed, date_format, today)
@@ -0,0 +1,128 @@
+'''
+Polling watcher for the E-Designation archive directory.
+
+ArchiveWatcher polls the archive for release files (*_YYYYMMDD.txt) that were not in the archive manifest when it
+started and have not been delivered since. A new file only counts as delivered once its size and modification time
+have stayed the same for a settle period, so a file that is still being copied in is never picked up half-written.
+Delivered files are added to the manifest, which is read again from disk first so that entries and aliases saved by
+the Pull script in the meantime are kept.
+
+GenerationRunner runs the generation script as a child process without blocking the watcher. Generation always
+builds the latest release in the manifest, so releases delivered while a run is in progress are coalesced into a
+single follow-up run.
+'''
+
+import os, time, subprocess, traceback, collections
+
+import edesig_manifest
+
+DEFAULT_POLL_SECONDS = 10
+DEFAULT_SETTLE_SECONDS = 30
+
+GenerationJob = collections.namedtuple('GenerationJob', ['releases', 'started', 'finished', 'returncode'])
+
+
+class ArchiveWatcher(object):
+    '''Detects completed new release files in an archive directory by polling.'''
+
+    def __init__(self, archive_manifest, settle_seconds=DEFAULT_SETTLE_SECONDS, clock=time.time):
+        self.manifest = archive_manifest
+        self.settle_seconds = settle_seconds
+        self.clock = clock
+        self._candidates = {}
+        self._known = set(archive_manifest.files)
+
+    def poll(self):
+        '''Return the filenames of release files that completed since the last poll, oldest release first.'''
+
+        now = self.clock()
+        seen = set()
+        delivered = []
+        for filename in os.listdir(self.manifest.archive_path):
+            if edesig_manifest.release_date_from_filename(filename) is None or filename in self._known:
+                continue
+            path = os.path.join(self.manifest.archive_path, filename)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            seen.add(filename)
+
+            signature = (status.st_size, status.st_mtime)
+            previous = self._candidates.get(filename)
+            if previous is None or previous[0] != signature:
+                if previous is None:
+                    print("New E-Designation file detected - {}. Waiting for it to settle".format(filename))
+                self._candidates[filename] = (signature, now)
+            elif now - previous[1] >= self.settle_seconds:
+                delivered.append(filename)
+
+        for filename in list(self._candidates):
+            if filename not in seen or filename in delivered:
+                del self._candidates[filename]
+
+        delivered.sort(key=edesig_manifest.release_date_from_filename)
+        if delivered:
+            self.manifest.reload()
+        for filename in delivered:
+            print("E-Designation file delivered - {}".format(filename))
+            self.manifest.add(filename)
+            self._known.add(filename)
+        return delivered
+
+
+class GenerationRunner(object):
+    '''Runs the generation command asynchronously, one run at a time, coalescing releases queued in the meantime.'''
+
+    def __init__(self, command, cwd=None):
+        self.command = command
+        self.cwd = cwd
+        self.pending = []
+        self._process = None
+        self._running = None
+        self._started = None
+
+    def submit(self, releases):
+        '''Queue a generation run for releases.'''
+
+        self.pending.extend(releases)
+
+    def poll(self):
+        '''
+        Check on the running generation and start the next one if releases are pending. Returns a finished
+        GenerationJob when a run completed during this call, otherwise None.
+        '''
+
+        finished = None
+        if self._process is not None and self._process.poll() is not None:
+            finished = GenerationJob(self._running, self._started, time.time(), self._process.returncode)
+            self._process = None
+            self._running = None
+
+        if self._process is None and self.pending:
+            self._running = self.pending
+            self.pending = []
+            self._started = time.time()
+            print("Starting E-Designation generation for {}".format(", ".join(self._running)))
+            self._process = subprocess.Popen(self.command, cwd=self.cwd)
+        return finished
+
+
+def watch(watcher, runner, poll_seconds=DEFAULT_POLL_SECONDS, on_finished=None, should_stop=None):
+    '''
+    Poll the archive and the generation runner until should_stop() returns True, calling on_finished(job). An error
+    raised by on_finished, such as a notification email that could not be sent, is printed and watching carries on.
+    '''
+
+    while should_stop is None or not should_stop():
+        delivered = watcher.poll()
+        if delivered:
+            runner.submit(delivered)
+        job = runner.poll()
+        if job is not None and on_finished is not None:
+            try:
+                on_finished(job)
+            except Exception:
+                print("Handling the finished generation for {} failed. Still watching".format(", ".join(job.releases)))
+                traceback.print_exc()
+        time.sleep(poll_seconds)
@@ -0,0 +1,266 @@
+'''
+Pluggable writers for additional output formats of the E-Designation release.
+
+Each writer takes the same in-memory point array (see edesig_schema.project_points) and writes one file holding the
+release fields and point geometry, so any number of formats can be produced from one join without re-reading the
+feature class or the shapefile. The formats available out of the box are:
+
+geoparquet  GeoParquet 1.0 with WKB point geometry, sorted by BOROCODE and BBL so that the row-group statistics on
+            those columns let readers skip row groups. Requires pyarrow.
+geopackage  OGC GeoPackage, written with the standard library sqlite3 module.
+geojson     GeoJSON FeatureCollection in the coordinate system of the release, named in a "crs" member.
+csv         Comma-delimited release fields with POINT_X and POINT_Y columns.
+
+Further formats are added with register(). Every file is written under a temporary name and renamed into place once
+complete.
+'''
+
+import os, io, json, sqlite3, collections
+import numpy as np
+import pandas as pd
+
+import edesig_manifest, edesig_schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+DEFAULT_ROW_GROUP_SIZE = 10000
+
+# Columns the GeoParquet output is sorted by, so that their row-group statistics are selective
+
+PARQUET_SORT_COLUMNS = ('BOROCODE', 'BBL')
+
+SpatialReference = collections.namedtuple('SpatialReference', ['wkt', 'epsg'])
+
+OutputWriter = collections.namedtuple('OutputWriter', ['name', 'extension', 'write', 'requires'])
+
+WRITERS = collections.OrderedDict()
+
+# Little-endian WKB point: byte order, geometry type, x, y
+
+_WKB_POINT = np.dtype([('byte_order', 'u1'), ('geometry_type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+
+
+def register(name, extension, write, requires=None):
+    '''
+    Register a writer. write(path, layer_name, point_array, spatial_reference, schema) writes one file at path,
+    naming the layer in it layer_name where the format has layer names. requires, if given, is the name of a module
+    that must be importable for the writer to be used.
+    '''
+
+    WRITERS[name] = OutputWriter(name, extension, write, requires)
+
+
+def _importable(module_name):
+    try:
+        __import__(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+def available_formats():
+    '''Return the names of the registered formats whose required packages are installed.'''
+
+    return [name for name, writer in WRITERS.items() if not writer.requires or _importable(writer.requires)]
+
+
+def parse_formats(text):
+    '''Return the format names in a comma-separated list such as "geoparquet, csv", checking each is usable.'''
+
+    names = [name.strip().lower() for name in (text or '').split(',') if name.strip()]
+    for name in names:
+        if name not in WRITERS:
+            raise ValueError("Unknown output format {0}. Available formats: {1}".format(name, ", ".join(WRITERS)))
+        if WRITERS[name].requires and not _importable(WRITERS[name].requires):
+            raise ImportError("The {0} output format requires the {1} package".format(name, WRITERS[name].requires))
+    return names
+
+
+def write_outputs(names, base_path, point_array, spatial_reference, schema=edesig_schema.RELEASE_SCHEMA):
+    '''
+    Write point_array in each named format to base_path plus the format's extension, naming the layer after the
+    file. Returns an ordered dictionary of format name to the path written.
+    '''
+
+    paths = collections.OrderedDict()
+    for name in parse_formats(','.join(names)):
+        writer = WRITERS[name]
+        path = base_path + writer.extension
+        print("Writing {}".format(path))
+        writer.write(path + '.tmp', os.path.basename(base_path), point_array, spatial_reference, schema)
+        edesig_manifest.replace_file(path + '.tmp', path)
+        paths[name] = path
+    return paths
+
+
+def point_wkb(x, y):
+    '''Return the little-endian WKB of every point as one contiguous buffer of fixed-size records.'''
+
+    wkb = np.empty(len(x), dtype=_WKB_POINT)
+    wkb['byte_order'] = 1
+    wkb['geometry_type'] = 1
+    wkb['x'] = x
+    wkb['y'] = y
+    return wkb
+
+
+def _bounds(point_array):
+    if not len(point_array):
+        return [0.0, 0.0, 0.0, 0.0]
+    x = point_array[edesig_schema.POINT_FIELDS[0]]
+    y = point_array[edesig_schema.POINT_FIELDS[1]]
+    return [float(x.min()), float(y.min()), float(x.max()), float(y.max())]
+
+
+def _projjson(spatial_reference):
+    # GeoParquet names the coordinate system in PROJJSON. A full definition needs pyproj; without it the EPSG
+    # identifier alone is written.
+
+    try:
+        import pyproj
+        return pyproj.CRS.from_epsg(spatial_reference.epsg).to_json_dict()
+    except Exception:
+        return {'id': {'authority': 'EPSG', 'code': int(spatial_reference.epsg)}}
+
+
+def write_geoparquet(path, layer_name, point_array, spatial_reference, schema=edesig_schema.RELEASE_SCHEMA,
+                     row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    '''Write a GeoParquet file with a WKB point geometry column and statistics on the sort columns.'''
+
+    sort_columns = [name for name in PARQUET_SORT_COLUMNS if name in edesig_schema.field_names(schema)]
+    if sort_columns:
+        point_array = point_array[np.lexsort([point_array[name] for name in reversed(sort_columns)])]
+
+    wkb = point_wkb(point_array[edesig_schema.POINT_FIELDS[0]], point_array[edesig_schema.POINT_FIELDS[1]])
+    offsets = np.arange(0, (len(wkb) + 1) * _WKB_POINT.itemsize, _WKB_POINT.itemsize, dtype=np.int32)
+    geometry = pa.Array.from_buffers(pa.binary(), len(wkb), [None, pa.py_buffer(offsets.tobytes()),
+                                                              pa.py_buffer(wkb.tobytes())])
+    columns = [pa.array(point_array[field.name]) for field in schema] + [geometry]
+    table = pa.Table.from_arrays(columns, names=edesig_schema.field_names(schema) + ['geometry'])
+
+    geo = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'], 'bbox': _bounds(point_array),
+                                 'crs': _projjson(spatial_reference)}},
+    }
+    table = table.replace_schema_metadata({b'geo': json.dumps(geo).encode('utf-8')})
+    pq.write_table(table, path, row_group_size=row_group_size, write_statistics=sort_columns or True)
+
+
+# GeoPackage column types for each ArcGIS field type
+
+GEOPACKAGE_FIELD_TYPES = {'TEXT': 'TEXT({})', 'SHORT': 'SMALLINT', 'LONG': 'MEDIUMINT', 'FLOAT': 'FLOAT',
+                          'DOUBLE': 'DOUBLE'}
+
+GEOPACKAGE_APPLICATION_ID = 0x47504B47
+GEOPACKAGE_USER_VERSION = 10200
+
+_GEOPACKAGE_TABLES = [
+    '''CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+       organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL,
+       description TEXT)''',
+    '''CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+       identifier TEXT UNIQUE, description TEXT DEFAULT '',
+       last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE,
+       max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+       CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))''',
+    '''CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+       geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+       CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+       CONSTRAINT uk_gc_table_name UNIQUE (table_name),
+       CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+       CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))''',
+]
+
+_WGS84_WKT = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],'
+              'UNIT["degree",0.0174532925199433],AUTHORITY["EPSG","4326"]]')
+
+
+def write_geopackage(path, layer_name, point_array, spatial_reference, schema=edesig_schema.RELEASE_SCHEMA):
+    '''Write a GeoPackage holding one point feature table named after the file.'''
+
+    srs_id = int(spatial_reference.epsg)
+
+    # GeoPackage geometry blobs: "GP", version 0, flags (little-endian, no envelope) and the srs_id, then the WKB
+
+    blob = np.empty(len(point_array), dtype=[('header', 'S4'), ('srs_id', '<i4'), ('wkb', _WKB_POINT)])
+    blob['header'] = b'GP\x00\x01'
+    blob['srs_id'] = srs_id
+    blob['wkb'] = point_wkb(point_array[edesig_schema.POINT_FIELDS[0]], point_array[edesig_schema.POINT_FIELDS[1]])
+    blobs = blob.view('V{}'.format(blob.dtype.itemsize))
+
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('PRAGMA application_id = {}'.format(GEOPACKAGE_APPLICATION_ID))
+        connection.execute('PRAGMA user_version = {}'.format(GEOPACKAGE_USER_VERSION))
+        for statement in _GEOPACKAGE_TABLES:
+            connection.execute(statement)
+        connection.executemany('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+            ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+            ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+            ('WGS 84 geodetic', 4326, 'EPSG', 4326, _WGS84_WKT, None),
+        ])
+        if srs_id not in (-1, 0, 4326):
+            connection.execute('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                               ('EPSG:{}'.format(srs_id), srs_id, 'EPSG', srs_id, spatial_reference.wkt, None))
+
+        columns = ', '.join('"{0}" {1}'.format(field.name, GEOPACKAGE_FIELD_TYPES[field.type].format(field.length))
+                            for field in schema)
+        connection.execute('CREATE TABLE "{0}" (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom POINT, {1})'
+                           .format(layer_name, columns))
+        connection.execute('INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, '
+                           'max_y, srs_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [layer_name, 'features', layer_name] + _bounds(point_array) + [srs_id])
+        connection.execute('INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, ?, ?)',
+                           (layer_name, 'geom', 'POINT', srs_id, 0, 0))
+
+        values = [[bytes(value) for value in blobs.tolist()]] + [point_array[field.name].tolist() for field in schema]
+        connection.executemany('INSERT INTO "{0}" (geom, {1}) VALUES ({2})'.format(
+            layer_name, ', '.join('"{}"'.format(field.name) for field in schema), ', '.join('?' * len(values))),
+            zip(*values))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def write_geojson(path, layer_name, point_array, spatial_reference, schema=edesig_schema.RELEASE_SCHEMA,
+                  chunk_size=10000):
+    '''Write a GeoJSON FeatureCollection, streaming the features in chunks.'''
+
+    names = edesig_schema.field_names(schema)
+    with io.open(path, 'w', encoding='utf-8') as geojson_file:
+        geojson_file.write(u'{"type": "FeatureCollection", "name": %s, "crs": {"type": "name", "properties": '
+                           u'{"name": "urn:ogc:def:crs:EPSG::%d"}}, "bbox": %s, "features": [\n'
+                           % (json.dumps(layer_name), int(spatial_reference.epsg), json.dumps(_bounds(point_array))))
+        for start in range(0, len(point_array), chunk_size):
+            chunk = point_array[start:start + chunk_size]
+            columns = [chunk[name].tolist() for name in names]
+            features = []
+            for x, y, values in zip(chunk[edesig_schema.POINT_FIELDS[0]].tolist(),
+                                    chunk[edesig_schema.POINT_FIELDS[1]].tolist(), zip(*columns)):
+                features.append(u'{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%r, %r]}, '
+                                u'"properties": %s}' % (x, y, json.dumps(collections.OrderedDict(zip(names, values)))))
+            separator = u',\n' if start + chunk_size < len(point_array) else u'\n'
+            geojson_file.write(u',\n'.join(features) + separator)
+        geojson_file.write(u']}\n')
+
+
+def write_csv(path, layer_name, point_array, spatial_reference, schema=edesig_schema.RELEASE_SCHEMA):
+    '''Write the release fields and point coordinates to a comma-delimited file.'''
+
+    names = edesig_schema.field_names(schema) + list(edesig_schema.POINT_FIELDS)
+    pd.DataFrame(dict((name, point_array[name]) for name in names), columns=names).to_csv(path, index=False)
+
+
+register('geoparquet', '.parquet', write_geoparquet, requires='pyarrow')
+register('geopackage', '.gpkg', write_geopackage)
+register('geojson', '.geojson', write_geojson)
+register('csv', '.csv', write_csv)
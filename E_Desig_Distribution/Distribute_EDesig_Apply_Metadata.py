@@ -5,7 +5,11 @@ desired metadata format. If this file is renamed or moved, a new template Featur
 97 of this script.
 '''
 
-import xml.etree.ElementTree as ET, arcpy, os, datetime, shutil, ConfigParser, zipfile, sys, traceback, calendar
+import arcpy, os, datetime, ConfigParser, sys, traceback, calendar, glob
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_distribute, edesig_manifest, edesig_metadata, edesig_publish, edesig_shapefile, edesig_staging
+import edesig_telemetry
 
 try:
     # Set script start-time for logging run-time purposes
@@ -22,6 +26,13 @@ try:
     log_path = config.get('DISTRIBUTION_PATHS', 'Log_Path')
     log = open(os.path.join(log_path, 'log_distribute_edesignations.txt'), "a")
 
+    # Record wall/CPU time, rows and bytes of every stage and distribution target as JSON lines
+
+    telemetry_path = config.get('DISTRIBUTION_PATHS', 'Telemetry_Path') \
+        if config.has_option('DISTRIBUTION_PATHS', 'Telemetry_Path') \
+        else os.path.join(log_path, edesig_telemetry.TELEMETRY_FILENAME)
+    telemetry = edesig_telemetry.Telemetry(telemetry_path, 'distribute')
+
     # Set current date variables.
 
     print("Start")
@@ -33,8 +44,6 @@ try:
                        str(datetime.datetime.today().month) + \
                        str(calendar.monthrange(datetime.datetime.today().year, datetime.datetime.today().month)[1])
 
-    xslt = arcpy.GetInstallInfo('desktop')['InstallDir'] + "Metadata/Stylesheets/ArcGIS.xsl"
-
     # Create directory for corresponding release date in Bytes Production directory
     output_path = config.get('DISTRIBUTION_PATHS', 'Output_Path')
 
@@ -47,54 +56,37 @@ try:
 
     latest_year_dir = str(max(latest_year_array))
 
-    if os.path.isdir(os.path.join(output_path, latest_year_dir, directory_current_date)):
-        print("Date directory already exists. Skipping")
-    else:
-        print("Creating date directory in M: drive")
-        os.makedirs(os.path.join(output_path, latest_year_dir, directory_current_date))
+    # The Bytes release directory and the SDE feature class are published as versions: each is loaded under a staging
+    # name, verified and swapped into place in one step. Retired versions are recorded in the publish registry and the
+    # last Keep_Versions of them are kept for Rollback_EDesig.py.
 
-    # Create shapefile directory in Bytes Production directory
+    publish_registry = edesig_publish.PublishRegistry(
+        config.get('DISTRIBUTION_PATHS', 'Publish_Registry_Path')
+        if config.has_option('DISTRIBUTION_PATHS', 'Publish_Registry_Path')
+        else os.path.join(log_path, edesig_publish.REGISTRY_FILENAME))
+    keep_versions = config.getint('DISTRIBUTION_PATHS', 'Keep_Versions') \
+        if config.has_option('DISTRIBUTION_PATHS', 'Keep_Versions') else edesig_publish.DEFAULT_KEEP
 
-    if os.path.isdir(os.path.join(output_path, latest_year_dir, directory_current_date, "shp")):
-        print("Shapefile directory already exists. Skipping")
-    else:
-        print("Creating shapefile directory in M: drive")
-        os.makedirs(os.path.join(output_path, latest_year_dir, directory_current_date, "shp"))
+    # Create the staging date directory, with its shapefile and metadata directories, in Bytes Production directory.
+    # It replaces the date directory only once every Bytes file has been copied and verified.
 
-    # Create metadata directory in Bytes Production directory
-
-    if os.path.isdir(os.path.join(output_path, latest_year_dir, directory_current_date, "meta")):
-        print("Metadata directory already exists. Skipping")
-    else:
-        print("Creating shapefile directory in M: drive")
-        os.makedirs(os.path.join(output_path, latest_year_dir, directory_current_date, "meta"))
+    bytes_store = edesig_publish.DirectoryStore(os.path.join(output_path, latest_year_dir))
+    bytes_publisher = edesig_publish.Publisher(bytes_store, directory_current_date, publish_registry, keep_versions)
+    print("Creating staging date directory in M: drive")
+    bytes_staging_path = os.path.join(output_path, latest_year_dir, bytes_publisher.stage())
+    os.makedirs(os.path.join(bytes_staging_path, "shp"))
+    os.makedirs(os.path.join(bytes_staging_path, "meta"))
 
     # Export original EDesignation text file to Bytes Production directory
 
     edesig_path = config.get('DISTRIBUTION_PATHS', 'EDesig_Path')
 
-    edesig_file_names = []
-    edesig_file_dates = []
-
-    for filename in os.listdir(edesig_path):
-        if filename.endswith('.txt'):
-            filename_date = datetime.datetime.strptime(filename.split("_")[2][:-4], "%Y%m%d")
-            edesig_file_dates.append(filename_date)
-            edesig_file_names.append(filename.split(".")[0])
-
-    # Assign most recent E-Designation file to variable
+    # Assign most recent E-Designation file from the archive manifest
 
-    latest_edesig_txt = max(edesig_file_dates)
-
-    for filename in os.listdir(edesig_path):
-        if filename.endswith('.txt'):
-            filename_date = datetime.datetime.strptime(filename.split("_")[2][:-4], "%Y%m%d")
-            if filename_date == latest_edesig_txt:
-
-                # Export original EDesignation text file to BytesProduction folder.
-                print("Exporting original E-Designation text file to BytesProduction folder")
-                shutil.copyfile(os.path.join(edesig_path, filename), os.path.join(output_path, latest_year_dir, directory_current_date, filename))
-                print('Export complete')
+    with telemetry.stage('load_manifest') as record:
+        archive_manifest = edesig_manifest.load_manifest(edesig_path)
+        latest_edesig_entry = archive_manifest.latest()
+        record.rows_out = len(archive_manifest.files)
 
     # Set path for translation xml file and xslt file. This is required for exporting xml files from a shapefile or FC.
 
@@ -103,148 +95,162 @@ try:
     translator = Arcdir + "Metadata/Translator/ARCGIS2FGDC.xml"
     xslt = Arcdir + "Metadata/Stylesheets/ArcGIS.xsl"
     xslt_remove_geoprocessing = Arcdir + "Metadata/Stylesheets/gpTools/remove geoprocessing history.xslt"
-    xslt_remove_local_storage = Arcdir + "Metadata/Stylesheets/gpTools/remove local storage info.xslt"
 
     # Set path variables.
 
     print("Setting initial paths")
 
     edes_old_sde_path = config.get('DISTRIBUTION_PATHS', 'EDesig_Old_SDE_Path')
-    output_gen_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Output_Path'), latest_year_dir, directory_current_date)
-    output_meta_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Output_Path'), latest_year_dir, directory_current_date, 'meta')
-    output_shp_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Output_Path'), latest_year_dir, directory_current_date, 'shp')
     interim_meta_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Temp_Path'), 'meta')
     interim_shp_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Temp_Path'), 'shp')
+    interim_formats_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Temp_Path'), 'formats')
     output_lyr_path_zoning = config.get('DISTRIBUTION_PATHS', 'Output_Zoning_Layer_Path')
     output_lyr_path_bytes_zoning = config.get('DISTRIBUTION_PATHS', 'Output_Bytes_Zoning_Layer_Path')
     output_lyr_path_boundaries_zoning = config.get('DISTRIBUTION_PATHS', 'Output_Boundaries_Zoning_Layer_Path')
     gdb_path = os.path.join(config.get('DISTRIBUTION_PATHS', 'Temp_Path'), 'EDES_GDB.gdb')
     sde_path = config.get('DISTRIBUTION_PATHS', 'SDE_Path')
 
-    # Check if previous metadata files have already been created.
-
-    print("Checking if metadata outputs already exist from previous iteration.")
-    if arcpy.Exists(os.path.join(interim_meta_path, 'nyedes_meta.xml')):
-        print("Previous metadata output found. Deleting now.")
-        arcpy.Delete_management(os.path.join(interim_meta_path, 'nyedes_meta.xml'))
-    if arcpy.Exists(os.path.join(interim_meta_path, 'nyedes_meta_updated.xml')):
-        print("Previous metadata output found. Deleting now.")
-        arcpy.Delete_management(os.path.join(interim_meta_path, 'nyedes_meta_updated.xml'))
-    if arcpy.Exists(os.path.join(interim_meta_path, 'nyedes_meta_updated_geoprocess.xml')):
-        print("Previous metadata output found. Deleting now.")
-        arcpy.Delete_management(os.path.join(interim_meta_path, 'nyedes_meta_updated_geoprocess.xml'))
-    if arcpy.Exists(os.path.join(interim_meta_path, 'nyedes_meta_updated_geoprocess_localstorage.xml')):
-        print("Previous metadata output found. Deleting now.")
-        arcpy.Delete_management(os.path.join(interim_meta_path, 'nyedes_meta_updated_geoprocess_localstorage.xml'))
-
-    # Export metadata from original EDes file as standalone xml file.
+    # Export metadata from the template EDes feature class as a standalone xml file. This is the only intermediate
+    # metadata file; every transform below runs in memory.
 
     print("Exporting xml metadata to intermediary folder")
-    arcpy.ExportMetadata_conversion(edes_old_sde_path, translator, os.path.join(interim_meta_path, "nyedes_meta.xml"))
+    with telemetry.stage('metadata_export') as record:
+        if arcpy.Exists(os.path.join(interim_meta_path, 'nyedes_meta.xml')):
+            arcpy.Delete_management(os.path.join(interim_meta_path, 'nyedes_meta.xml'))
+        arcpy.ExportMetadata_conversion(edes_old_sde_path, translator,
+                                        os.path.join(interim_meta_path, "nyedes_meta.xml"))
+        record.bytes_written = edesig_telemetry.file_size(os.path.join(interim_meta_path, "nyedes_meta.xml"))
     print("Export complete")
-    print("Printing XML Text")
-    tree = ET.parse(os.path.join(interim_meta_path, "nyedes_meta.xml"))
-    root = tree.getroot()
-
-    # Update standalone xml file with current date for publication date.
-
-    for x in root.iter('pubdate'):
-        print("Date {0} will be updated to {1}".format(x.text, current_date))
-        x.text = publication_date
-    tree.write(os.path.join(interim_meta_path, "nyedes_meta_updated.xml"))
 
-    # Remove geoprocessing history and local storage information from standalone xml file.
-
-    arcpy.XSLTransform_conversion(os.path.join(interim_meta_path, "nyedes_meta_updated.xml"),
-                                  xslt_remove_geoprocessing,
-                                  os.path.join(interim_meta_path, "nyedes_meta_updated_geoprocess.xml"))
-
-    arcpy.XSLTransform_conversion(os.path.join(interim_meta_path, "nyedes_meta_updated_geoprocess.xml"),
-                                  xslt_remove_local_storage,
-                                  os.path.join(interim_meta_path, "nyedes_meta_updated_geoprocess_localstorage.xml"))
+    # Update the publication date and remove geoprocessing history and local storage information in one in-memory
+    # pass, and render the standalone xml and html once. Renders are cached on the template hash and publication date.
 
+    metadata_cache = edesig_metadata.MetadataCache(os.path.join(interim_meta_path, 'cache'))
+    with telemetry.stage('metadata_render') as record:
+        rendered_metadata = metadata_cache.render(os.path.join(interim_meta_path, "nyedes_meta.xml"),
+                                                  publication_date, lambda xml_path, html_path:
+                                                  arcpy.XSLTransform_conversion(xml_path, xslt, html_path, '#'))
+        record.cached = rendered_metadata.cached
+        record.bytes_read = edesig_telemetry.file_size(os.path.join(interim_meta_path, "nyedes_meta.xml"))
+        record.bytes_written = edesig_telemetry.file_size(rendered_metadata.xml_path, rendered_metadata.html_path)
 
     # Apply new metadata xml to temporary Feature Class (e.g. EDES_GDB.gdb/nyedes_{current_date}
 
-    arcpy.MetadataImporter_conversion(os.path.join(interim_meta_path, "nyedes_meta_updated_geoprocess_localstorage.xml"),
+    arcpy.MetadataImporter_conversion(rendered_metadata.xml_path,
                                       os.path.join(gdb_path, 'nyedes_{}'.format(current_date)))
     arcpy.UpgradeMetadata_conversion(os.path.join(gdb_path, 'nyedes_{}'.format(current_date)), 'FGDC_TO_ARCGIS')
 
     # Apply new metadata xml to temporary shapefile (e.g. C:/tempEDesig/shp/nyedes_{current_date}
 
-    arcpy.MetadataImporter_conversion(os.path.join(interim_meta_path, "nyedes_meta_updated_geoprocess_localstorage.xml"),
+    arcpy.MetadataImporter_conversion(rendered_metadata.xml_path,
                                       os.path.join(interim_shp_path, 'nyedes_{}.shp'.format(current_date)))
-    arcpy.UpgradeMetadata_conversion(os.path.join(gdb_path, 'nyedes_{}'.format(current_date)), 'FGDC_TO_ARCGIS')
+    arcpy.UpgradeMetadata_conversion(os.path.join(interim_shp_path, 'nyedes_{}.shp'.format(current_date)),
+                                     'FGDC_TO_ARCGIS')
 
-    # Copy new standalone xml file to Bytes folder.
-
-    if os.path.exists(os.path.join(interim_meta_path, 'nyedes_meta_Final.xml')):
-        print("Standalone xml already exists in Bytes folder")
-    else:
-        print("Copying new standalone xml to Bytes folder")
-        shutil.copyfile(os.path.join(interim_meta_path, "nyedes_meta_updated_geoprocess_localstorage.xml"),
-                        os.path.join(output_meta_path, "nyedes_meta_Final.xml"))
-        print("Copy complete.")
-
-    # Produce HTML document from XML stand-alone output
-
-    if os.path.exists(os.path.join(gdb_path, "nyedes_{}".format(current_date))):
-        print("Creating new standalone html in Bytes folder")
-        arcpy.XSLTransform_conversion(os.path.join(gdb_path, "nyedes_{}".format(current_date)),
-                                      xslt,
-                                      os.path.join(output_meta_path, 'nyedes_{}.html'.format(directory_current_date)),
-                                      '#')
-
-    # Export final product Shapefile to Bytes Production directory
-
-    print("Exporting shapefile to Bytes directory")
-    if os.path.exists(os.path.join(output_shp_path, "nyedes_{}.shp".format(current_date))):
-        print("Shapefile files already exist. Skipping")
-    else:
-        arcpy.FeatureClassToShapefile_conversion(os.path.join(gdb_path, "nyedes_{}".format(current_date)),
-                                                 output_shp_path)
-
-    # Export final product Feature Class to SDE PROD
-
-    if arcpy.Exists(os.path.join(sde_path, "DCP_EARD_Edesignations")):
-        print("EARD_EDesignations already exists in SDE. Renaming new export with appended date on end. "
-              "Remember to archive/delete the old version.")
-        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(gdb_path, "nyedes_{}".format(current_date)), sde_path,
-                                                    "DCP_EARD_Edesignations_{}".format(current_date))
-        arcpy.XSLTransform_conversion(os.path.join(sde_path, "DCP_EARD_Edesignations_{}".format(current_date)),
-                                      xslt_remove_geoprocessing, os.path.join(interim_meta_path, 'DCP_EARD_Edes.xml'))
-        arcpy.MetadataImporter_conversion(os.path.join(interim_meta_path, 'DCP_EARD_Edes.xml'),
-                                          os.path.join(sde_path, 'DCP_EARD_Edesignations_{}'.format(current_date)))
-        arcpy.Delete_management(os.path.join(interim_meta_path, 'DCP_EARD_Edes.xml'))
-    else:
-        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(gdb_path, "nyedes_{}".format(current_date)), sde_path,
-                                                    "DCP_EARD_Edesignations")
-        arcpy.XSLTransform_conversion(os.path.join(sde_path, "DCP_EARD_Edesignations"),
+    # Export the layer metadata once from the updated feature class. Each layer directory receives a copy of it.
+
+    print("Exporting layer metadata")
+    layer_meta_path = os.path.join(interim_meta_path, 'Environmental designation.lyr.xml')
+    with telemetry.stage('layer_metadata_export') as record:
+        if arcpy.Exists(layer_meta_path):
+            arcpy.Delete_management(layer_meta_path)
+        arcpy.ExportMetadata_conversion(os.path.join(gdb_path, 'nyedes_{}'.format(current_date)), translator,
+                                        layer_meta_path)
+        arcpy.UpgradeMetadata_conversion(layer_meta_path, 'FGDC_TO_ARCGIS')
+        record.bytes_written = edesig_telemetry.file_size(layer_meta_path)
+
+    # Every remaining step reads the finished nyedes_{current_date} dataset and writes to its own target, most of them
+    # on network drives. They are published concurrently, each with its own retries, so one slow or failed share does
+    # not hold up or abort the others.
+
+    distribution = edesig_distribute.DistributionExecutor(
+        max_workers=config.getint('DISTRIBUTION_PATHS', 'Max_Distribution_Workers')
+        if config.has_option('DISTRIBUTION_PATHS', 'Max_Distribution_Workers') else 4,
+        retries=config.getint('DISTRIBUTION_PATHS', 'Distribution_Retries')
+        if config.has_option('DISTRIBUTION_PATHS', 'Distribution_Retries') else 2,
+        telemetry=telemetry)
+
+    # Every file of the Bytes release directory, by its path in the directory, and the source it is copied from. The
+    # staged directory must hold exactly these files, byte for byte, before it is swapped in.
+
+    shp_file_paths = [path for path in (os.path.join(interim_shp_path, "nyedes_{0}{1}".format(current_date, extension))
+                                        for extension in edesig_shapefile.SHAPEFILE_EXTENSIONS + ('.shp.xml',))
+                      if os.path.exists(path)]
+    format_paths = [path for path in sorted(glob.glob(os.path.join(interim_formats_path,
+                                                                   "nyedes_{}.*".format(current_date))))
+                    if not path.endswith('.tmp')]
+    bytes_files = [(latest_edesig_entry.filename, archive_manifest.path(latest_edesig_entry)),
+                   (os.path.join('meta', "nyedes_meta_Final.xml"), rendered_metadata.xml_path),
+                   (os.path.join('meta', 'nyedes_{}.html'.format(directory_current_date)), rendered_metadata.html_path)]
+    bytes_files += [(os.path.join('shp', os.path.basename(path)), path) for path in shp_file_paths + format_paths]
+
+    # Push every Bytes file into the staging directory as one bulk transfer: the files are copied in parallel,
+    # checksummed chunks and a retry resumes with the chunks still missing. The Bytes shapefile is a file-by-file copy
+    # of the temporary shapefile written by the Generation script, with the metadata applied above, rather than a
+    # second conversion of the feature class. Any additional output formats are copied next to it.
+
+    transfer_workers = config.getint('DISTRIBUTION_PATHS', 'Transfer_Workers') \
+        if config.has_option('DISTRIBUTION_PATHS', 'Transfer_Workers') else edesig_staging.DEFAULT_WORKERS
+
+    bytes_target = "Bytes release files"
+    distribution.add(bytes_target, lambda: edesig_staging.transfer(
+        [(source, os.path.join(bytes_staging_path, relative_path)) for relative_path, source in bytes_files],
+        workers=transfer_workers).check())
+
+    # Publish final product Feature Class to SDE PROD as DCP_EARD_Edesignations. It is loaded as
+    # DCP_EARD_Edesignations_staging, checked against the row count and attribute checksum of the generated feature
+    # class and swapped in, retiring the previous release as DCP_EARD_Edesignations_{its date}.
+
+    gdb_fc_name = "nyedes_{}".format(current_date)
+    with telemetry.stage('sde_checksum') as record:
+        release_fields = edesig_publish.GeodatabaseStore(arcpy, gdb_path).checksum_fields(gdb_fc_name)
+        gdb_store = edesig_publish.GeodatabaseStore(arcpy, gdb_path, release_fields)
+        release_rows = gdb_store.count(gdb_fc_name)
+        release_checksum = gdb_store.checksum(gdb_fc_name)
+        record.rows_in = release_rows
+    sde_publisher = edesig_publish.Publisher(edesig_publish.GeodatabaseStore(arcpy, sde_path, release_fields),
+                                             "DCP_EARD_Edesignations", publish_registry, keep_versions)
+
+    def load_sde(sde_fc_name):
+        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(gdb_path, gdb_fc_name), sde_path, sde_fc_name)
+        arcpy.XSLTransform_conversion(os.path.join(sde_path, sde_fc_name),
                                       xslt_remove_geoprocessing, os.path.join(interim_meta_path, 'DCP_EARD_Edes.xml'))
         arcpy.MetadataImporter_conversion(os.path.join(interim_meta_path, 'DCP_EARD_Edes.xml'),
-                                          os.path.join(sde_path, 'DCP_EARD_Edesignations'))
+                                          os.path.join(sde_path, sde_fc_name))
         arcpy.Delete_management(os.path.join(interim_meta_path, 'DCP_EARD_Edes.xml'))
 
-    # Export layer metadata to M drive Zoning directory
+    distribution.add("SDE PROD feature class", lambda: sde_publisher.publish(load_sde, current_date, release_rows,
+                                                                             release_checksum), sde_publisher.discard)
 
+    # Copy layer metadata to M drive Zoning directories in one bulk transfer
 
-    def update_lyr_meta(in_path):
-        print("Exporting metadata for {}".format(in_path))
-        arcpy.Delete_management(os.path.join(in_path, 'Environmental designation.lyr.xml'))
-        arcpy.ExportMetadata_conversion(os.path.join(gdb_path, 'nyedes_{}'.format(current_date)), translator,
-                                        os.path.join(in_path, 'Environmental designation.lyr.xml'))
-        arcpy.UpgradeMetadata_conversion(os.path.join(in_path, 'Environmental designation.lyr.xml'),
-                                         'FGDC_TO_ARCGIS')
-        print("New layer metadata exported for {}".format(in_path))
+    distribution.add("Layer metadata", lambda: edesig_staging.transfer(
+        [(layer_meta_path, os.path.join(in_path, 'Environmental designation.lyr.xml'))
+         for in_path in (output_lyr_path_zoning, output_lyr_path_boundaries_zoning, output_lyr_path_bytes_zoning)],
+        workers=transfer_workers).check())
+
+    distribution.run()
+    print(distribution.report())
+    log.write(distribution.report() + "\n")
 
-    update_lyr_meta(output_lyr_path_zoning)
-    update_lyr_meta(output_lyr_path_boundaries_zoning)
-    update_lyr_meta(output_lyr_path_bytes_zoning)
+    # Swap the staged Bytes release directory into the date directory once the Bytes transfer has succeeded. If it
+    # failed, the date directory is left as it was and the next run stages the release again.
+
+    if bytes_target not in [result.name for result in distribution.failed]:
+        with telemetry.stage('bytes_swap') as record:
+            bytes_rows, bytes_checksum = bytes_publisher.verify(len(bytes_files),
+                                                                edesig_publish.files_checksum(bytes_files))
+            bytes_publisher.swap(StartTime.strftime('%Y%m%d%H%M%S'), bytes_rows, bytes_checksum)
+            record.rows_out = bytes_rows
 
     EndTime = datetime.datetime.now().replace(microsecond=0)
     print("Script runtime: {}".format(EndTime - StartTime))
     log.write(str(StartTime) + "\t" + str(EndTime) + "\t" + str(EndTime - StartTime) + "\n")
 
+    # Report any target that failed after all of its retries once every other target has been published
+
+    distribution.check()
+
 except:
     print("error")
     tb = sys.exc_info()[2]
@@ -0,0 +1,60 @@
+'''
+This script must be run using the Python version associated with standard ArcGIS (Python 2.7, 32-bit)
+Rolls a release published by Distribute_EDesig_Apply_Metadata.py back to the version it replaced: the SDE PROD feature
+class, or the Bytes Production date directory of a given release date. The live version is retired in its place, so a
+second rollback restores it. With --list, prints the live and retired versions instead.
+'''
+
+import arcpy, os, sys, argparse, ConfigParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_publish
+
+parser = argparse.ArgumentParser(description="Roll back the SDE PROD feature class or a Bytes Production directory "
+                                             "to its previously published version.")
+parser.add_argument('target', choices=['sde', 'bytes'])
+parser.add_argument('--date', help="Release date (YYYYMMDD) of the Bytes Production directory to roll back")
+parser.add_argument('--list', action='store_true', help="List the live and retired versions without rolling back")
+args = parser.parse_args()
+
+# Set path to configuration ini file for paths
+
+config = ConfigParser.ConfigParser()
+config.read(r'edesig_config_template.ini')
+
+publish_registry = edesig_publish.PublishRegistry(
+    config.get('DISTRIBUTION_PATHS', 'Publish_Registry_Path')
+    if config.has_option('DISTRIBUTION_PATHS', 'Publish_Registry_Path')
+    else os.path.join(config.get('DISTRIBUTION_PATHS', 'Log_Path'), edesig_publish.REGISTRY_FILENAME))
+
+if args.target == 'sde':
+    publisher = edesig_publish.Publisher(
+        edesig_publish.GeodatabaseStore(arcpy, config.get('DISTRIBUTION_PATHS', 'SDE_Path')),
+        "DCP_EARD_Edesignations", publish_registry)
+else:
+    if not args.date:
+        parser.error("--date is required to roll back a Bytes Production directory")
+
+    # Distribute_EDesig_Apply_Metadata.py publishes into the latest year directory of Output_Path, which is not always
+    # the year of the release date (e.g. early in January), so use the year directory the release was published in
+
+    output_path = config.get('DISTRIBUTION_PATHS', 'Output_Path')
+    year_dirs = sorted((directory for directory in os.listdir(output_path)
+                        if directory.isdigit() and os.path.isdir(os.path.join(output_path, directory))), reverse=True)
+    published_year_dirs = [year_dir for year_dir in year_dirs if publish_registry.has(
+        edesig_publish.DirectoryStore(os.path.join(output_path, year_dir)).key(args.date))]
+    if not published_year_dirs:
+        parser.error("No Bytes Production directory {0} has been published under {1}".format(args.date, output_path))
+    publisher = edesig_publish.Publisher(
+        edesig_publish.DirectoryStore(os.path.join(output_path, published_year_dirs[0])), args.date, publish_registry)
+
+# The number of retired versions kept is only applied when publishing, so a rollback never deletes one
+
+live_entry, retired_entries = publisher.versions()
+if args.list:
+    for label, entry in [('live', live_entry)] + [('retired', entry) for entry in retired_entries]:
+        if entry:
+            print("{0:8} {1:32} version {2}, {3} rows, published {4}".format(
+                label, entry['name'], entry['version'], entry['rows'], entry['published']))
+else:
+    print("Rolled {0} back to version {1}".format(publisher.name, publisher.rollback()))
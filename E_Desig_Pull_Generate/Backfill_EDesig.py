@@ -0,0 +1,193 @@
+'''
+This script must be run using the Python version associated with ArcGIS Pro (Python 3.6, 64-bit) unless Backend = open
+
+Regenerates past E-Designation releases from the archive, for example after a base-layer or logic fix. The releases
+are chosen by an inclusive release-date range or by archive filename, and each one is named by its own release date
+(nyedes_{release_date}) rather than the date the script is run.
+
+MapPLUTO and TAXLOT_POLYGON are pulled through the base-layer cache and the point index is built or opened once, as
+in the generation script, and the selected exports are staged on local disk (Staging_Path) in one parallel,
+checksummed transfer. The releases are then generated across a pool of worker processes, each resolving releases
+against the same memory-mapped point index, and a summary table of per-release counts and timings is printed and
+written to the output directory.
+
+Base layers are read and releases written through the geoprocessing backend named by Backend in the ini file (see
+edesig_backend), so with Backend = open the backfill runs without ArcGIS as well.
+
+Usage: python Backfill_EDesig.py [--start YYYYMMDD] [--end YYYYMMDD] [--files NAME [NAME ...]] [--workers N]
+                                 [--output PATH] [--no-qa] [--no-feature-classes]
+'''
+
+
+import argparse, configparser, datetime, os, sys, traceback
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_backend, edesig_backfill, edesig_manifest, edesig_pointindex, edesig_schema, edesig_staging
+import edesig_telemetry
+
+# Worker processes import this script without running it, so the geoprocessing backend is only loaded by the parent
+# process
+
+if __name__ == '__main__':
+    import numpy as np
+    import edesig_cache
+
+    parser = argparse.ArgumentParser(description="Regenerate archived E-Designation releases in parallel")
+    parser.add_argument('--start', help="first release date to regenerate (YYYYMMDD, inclusive)")
+    parser.add_argument('--end', help="last release date to regenerate (YYYYMMDD, inclusive)")
+    parser.add_argument('--files', nargs='+', help="archive filenames to regenerate (instead of a date range)")
+    parser.add_argument('--workers', type=int, help="worker processes (default Max_Backfill_Workers, or one per CPU)")
+    parser.add_argument('--output', help="output directory (default Backfill_Path, or Temp_Path/backfill)")
+    parser.add_argument('--no-qa', action='store_true', help="skip the spatial QA of each release")
+    parser.add_argument('--no-feature-classes', action='store_true',
+                        help="only write shapefiles, not releases in the backend's EDES_BACKFILL workspace")
+    args = parser.parse_args()
+
+    for release_date in (args.start, args.end):
+        if release_date is not None:
+            datetime.datetime.strptime(release_date, '%Y%m%d')
+
+    try:
+        StartTime = datetime.datetime.now().replace(microsecond=0)
+
+        # Path Declarations
+
+        config = configparser.ConfigParser()
+        config.read(r'edesig_config_template.ini')
+        temp_path = config.get('GENERATION_PATHS', 'Temp_Path')
+        output_path = args.output or config.get('GENERATION_PATHS', 'Backfill_Path',
+                                                fallback=os.path.join(temp_path, 'backfill'))
+        workers = args.workers or config.getint('GENERATION_PATHS', 'Max_Backfill_Workers', fallback=0) or None
+        backend = edesig_backend.get_backend(config.get('GENERATION_PATHS', 'Backend',
+                                                        fallback=edesig_backend.DEFAULT_BACKEND))
+
+        print("Checking backfill directory")
+        if not os.path.isdir(output_path):
+            os.makedirs(output_path)
+
+        # Log outputs in text file
+
+        log_path = config.get('GENERATION_PATHS', 'Log_Path')
+        log = open(os.path.join(log_path, "log_backfill_edesignations.txt"), "a")
+
+        telemetry_path = config.get('GENERATION_PATHS', 'Telemetry_Path',
+                                    fallback=os.path.join(log_path, edesig_telemetry.TELEMETRY_FILENAME))
+        telemetry = edesig_telemetry.Telemetry(telemetry_path, 'backfill')
+
+        # Choose the releases to regenerate from the archive manifest
+
+        edesig_path = config.get('GENERATION_PATHS', 'EDesig_Path')
+        with telemetry.stage('load_manifest') as record:
+            archive_manifest = edesig_manifest.load_manifest(edesig_path)
+            record.rows_out = len(archive_manifest.files)
+
+        if args.files:
+            entries = []
+            for filename in args.files:
+                entry = archive_manifest.get(os.path.basename(filename))
+                if entry is None:
+                    raise ValueError("{0} is not in the E-Designation archive {1}".format(filename, edesig_path))
+                entries.append(entry)
+        else:
+            entries = archive_manifest.releases(args.start, args.end)
+        print("{} archived releases selected for backfill".format(len(entries)))
+
+        # Stage the selected exports on local disk in one parallel transfer, each checked against the SHA-256
+        # recorded in the archive manifest, so the workers read local copies rather than the network archive
+
+        with telemetry.stage('stage_inputs') as record:
+            input_paths = edesig_staging.stage_files(
+                [(archive_manifest.path(entry), entry.sha256) for entry in entries],
+                config.get('GENERATION_PATHS', 'Staging_Path', fallback=os.path.join(temp_path, 'staging')),
+                workers=config.getint('GENERATION_PATHS', 'Transfer_Workers',
+                                      fallback=edesig_staging.DEFAULT_WORKERS))
+            record.rows_out = len(input_paths)
+            record.bytes_written = edesig_telemetry.file_size(*input_paths)
+
+        # Pull MapPLUTO and TaxLot Polygon through the base-layer cache and open the point index once for every
+        # release
+
+        base_layer_cache = edesig_cache.BaseLayerCache(
+            config.get('GENERATION_PATHS', 'Cache_Path'),
+            int(config.getfloat('GENERATION_PATHS', 'Cache_Max_GB') * 1024 ** 3))
+        centroid_inside = config.getboolean('GENERATION_PATHS', 'Centroid_Inside', fallback=False)
+
+        base_layers = []
+        layer_fingerprints = []
+        for stage_name, source_code, out_name, source_fc in backend.base_layer_sources(config):
+            print("Fingerprinting {}".format(source_fc))
+            layer_fingerprint = backend.source_fingerprint(source_fc)
+            layer_fingerprints.append(layer_fingerprint)
+            with telemetry.stage(stage_name) as record:
+                base_layers.append((source_code, backend.pull_base_layer(
+                    base_layer_cache, source_code, source_fc, out_name, layer_fingerprint, record)))
+
+        with telemetry.stage('point_index') as record:
+            index_path = edesig_backend.point_index(
+                backend, base_layer_cache, base_layers,
+                edesig_pointindex.index_fingerprint(layer_fingerprints, centroid_inside), centroid_inside, record)
+
+        output_sr = backend.spatial_reference(base_layers[0][1])
+        tasks = edesig_backfill.release_tasks(entries, archive_manifest, index_path, output_path,
+                                              prj=edesig_backend.esri_wkt(output_sr), qa=not args.no_qa,
+                                              input_paths=input_paths)
+
+        # Generate the releases across the process pool
+
+        with telemetry.stage('generate_releases') as record:
+            results = edesig_backfill.run_backfill(tasks, workers)
+            record.rows_in = sum(result.rows_read or 0 for result in results)
+            record.rows_out = sum(result.points or 0 for result in results)
+            record.extra['releases'] = len(results)
+
+        # Write each generated release to the backfill workspace (EDES_BACKFILL.gdb, or the EDES_BACKFILL GeoPackage
+        # directory with the open backend) from its point array
+
+        if not args.no_feature_classes:
+            with telemetry.stage('feature_classes') as record:
+                backfill_workspace_path = backend.create_workspace(output_path, 'EDES_BACKFILL')
+                for result in results:
+                    if result.status != edesig_backfill.STATUS_SUCCEEDED:
+                        continue
+                    fc_path = backend.dataset_path(backfill_workspace_path, 'nyedes_{}'.format(result.release_date))
+                    if backend.exists(fc_path):
+                        backend.remove(fc_path)
+                    point_array = edesig_schema.release_array(np.load(os.path.join(
+                        edesig_backfill.release_output_path(output_path, result.release_date),
+                        'nyedes_{}.npy'.format(result.release_date))))
+                    backend.write_points(fc_path, point_array, output_sr)
+                    record.rows_out = (record.rows_out or 0) + len(point_array)
+
+        # Summarize every release
+
+        summary = edesig_backfill.summary_table(results)
+        print(summary)
+        summary_path = os.path.join(output_path, edesig_backfill.SUMMARY_FILENAME.format(
+            StartTime.strftime("%Y%m%d%H%M%S")))
+        edesig_backfill.write_summary(summary_path, results)
+        print("Backfill summary written to {}".format(summary_path))
+
+        EndTime = datetime.datetime.now().replace(microsecond=0)
+        print("Script runtime: {}".format(EndTime - StartTime))
+        log.write(str(StartTime) + "\t" + str(EndTime) + "\t" + str(EndTime - StartTime) + "\n")
+        log.write(summary + "\n")
+        log.close()
+
+    except:
+        print("error")
+        tb = sys.exc_info()[2]
+        tbinfo = traceback.format_tb(tb)[0]
+
+        pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+        msgs = ""
+        if 'backend' in globals():
+            msgs = backend.label + " ERRORS:\n" + backend.messages() + "\n"
+
+        print(pymsg)
+        print(msgs)
+
+        if 'log' in globals():
+            log.write("" + pymsg + "\n")
+            log.write("" + msgs + "")
+            log.write("\n")
+            log.close()
@@ -1,19 +1,45 @@
 '''
-This script must be run using the Python version associated with ArcGIS Pro (Python 3.6, 64-bit)
-
-It is also important to note that unless files are deleted from the temporary C: directory (tempEDesig), they will be
-re-used in the generation of E-Designations. In order to avoid using old datasets one should ALWAYS delete the temporary
-directory on C: unless you are troubleshooting the script or are confident that the most recent exports already exist in
-temp dir.
-
-Script run-time is approximately 1 hour with no temporary files in GDB and approximately 20 minutes when
-the most recent temporary files are already copied to the GDB. If the script is run from the user's C: drive the
-associated run-times are 20 minutes with no temporary files and approximately 5 minutes with most recent temp files
-already in the GDB.
+This script must be run using the Python version associated with ArcGIS Pro (Python 3.6, 64-bit) unless Backend = open
+
+MapPLUTO and TAXLOT_POLYGON are pulled through a base-layer cache kept outside the temporary C: directory
+(Cache_Path in the ini file). Each SDE source is fingerprinted on every run (row count, latest edit, extent and schema)
+and is only pulled again when its fingerprint changes, so the temporary directory can be deleted freely without
+forcing a re-import, and a changed base layer is never silently re-used from an old copy.
+
+The centroid of every lot is computed once per pair of base-layer versions into a memory-mapped BBL to point index,
+also kept in the base-layer cache, so a release is resolved by BBL lookups alone and no lot geometry is read.
+
+The export is validated before any base-layer work (see edesig_validate). Its lines are checked for types, ranges,
+dates, duplicate keys and HAZMAT/AIR/NOISE flags that agree with their dates, a rejection file and summary are written
+to the temporary directory, and the run stops if more lines are rejected than Max_Rejected_Rows allows.
+
+The generation steps run as named stages (pull_mappluto, pull_taxlot, point_index, join_points, export_fc, qa_points,
+export_shp and, when Output_Formats is set, export_formats). The qa_points stage checks that every output point falls
+inside a lot with its own BBL and writes any failing points to nyedes_{date}_qa_issues.csv in the temporary directory.
+Each stage records a checkpoint holding a fingerprint of its inputs (source layer versions, the release's content
+hash, settings) in edesig_checkpoints.json in the temporary directory. A rerun after a crash resumes from the first
+stage whose checkpoint is missing or no longer matches, and outputs left by a different release are never re-used.
+
+The export is copied from the network archive to local scratch storage (Staging_Path) in checksummed chunks (see
+edesig_staging) and every step reads the local copy. Together with the base-layer cache, generation reads nothing from
+a network share once a release has been staged.
+
+GIS access goes through the geoprocessing backend named by Backend in the ini file (see edesig_backend). The default,
+arcpy, reads the base layers from SDE and writes nyedes_{date} to EDES_GDB.gdb. With Backend = open, the base layers
+are read from the GeoPackages named by MapPLUTO_GeoPackage and TaxLot_GeoPackage and the release is written to
+EDES_GPKG/nyedes_{date}.gpkg, so the script runs with any Python 3 that has NumPy and pandas, on Linux as well.
+
+Script run-time is approximately 1 hour when the base layers have to be pulled from a network path and approximately
+20 minutes when they are cached. If the script is run from the user's C: drive the associated run-times are 20 minutes
+with no cached base layers and approximately 5 minutes with cached base layers.
 '''
 
 
-import arcpy, os, datetime, pandas as pd, sys, traceback, configparser
+import os, datetime, glob, numpy as np, sys, traceback, configparser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_backend, edesig_cache, edesig_ingest, edesig_join, edesig_manifest, edesig_pointindex, edesig_qa
+import edesig_schema, edesig_shapefile, edesig_staging, edesig_stages, edesig_telemetry, edesig_validate, edesig_writers
 
 try:
     StartTime = datetime.datetime.now().replace(microsecond = 0)
@@ -24,6 +50,13 @@ try:
     config.read(r'edesig_config_template.ini')
     temp_path = config.get('GENERATION_PATHS', 'Temp_Path')
 
+    # Geoprocessing backend: arcpy (SDE base layers, file geodatabase output) or open (GeoPackage base layers and
+    # output, no ArcGIS needed). See edesig_backend.
+
+    backend = edesig_backend.get_backend(config.get('GENERATION_PATHS', 'Backend',
+                                                    fallback=edesig_backend.DEFAULT_BACKEND))
+    print("Using the {} geoprocessing backend".format(backend.name))
+
     # Create temporary directory - C:\tempEDesig
 
     print("Checking Temp directory")
@@ -37,17 +70,15 @@ try:
     log_path = config.get('GENERATION_PATHS', 'Log_Path')
     log = open(os.path.join(log_path, "log_generate_edesignations.txt"), "a")
 
-    # Check that temporary gdb exists
+    # Record wall/CPU time, rows and bytes of every stage as JSON lines for run-to-run comparison
 
-    print("Checking Temp FGDB")
-    if arcpy.Exists(os.path.join(temp_path, "EDES_GDB.gdb")):
-        print("Temp FGDB already exists")
-    else:
-        arcpy.CreateFileGDB_management(temp_path, 'EDES_GDB', "CURRENT")
+    telemetry_path = config.get('GENERATION_PATHS', 'Telemetry_Path',
+                                fallback=os.path.join(log_path, edesig_telemetry.TELEMETRY_FILENAME))
+    telemetry = edesig_telemetry.Telemetry(telemetry_path, 'generate')
 
-    # Create Geodatabase path variable
+    # Check that the temporary workspace exists: EDES_GDB.gdb with the arcpy backend, EDES_GPKG with the open one
 
-    gdb_path = os.path.join(temp_path, 'EDES_GDB.gdb')
+    workspace_path = backend.create_workspace(temp_path)
 
     # Create directories for outputs
 
@@ -61,6 +92,13 @@ try:
         print("Creating shapefile directory in temporary directory")
         os.makedirs(os.path.join(temp_path, "shp"))
 
+    # Create temporary directory for the optional additional output formats in C:\tempEDesig\
+
+    output_formats = edesig_writers.parse_formats(config.get('GENERATION_PATHS', 'Output_Formats', fallback=''))
+    if output_formats and not os.path.isdir(os.path.join(temp_path, "formats")):
+        print("Creating additional formats directory in temporary directory")
+        os.makedirs(os.path.join(temp_path, "formats"))
+
     # Create temporary metadata directory in C:\tempEDesig\
 
     if os.path.isdir(os.path.join(temp_path, "meta")):
@@ -69,372 +107,258 @@ try:
         print("Creating metadata directory in temporary directory")
         os.makedirs(os.path.join(temp_path, "meta"))
 
-    # Create list of all existing E-Designation files
-
-    print("Parsing EDes files for most recent")
-    edesig_file_names = []
-    edesig_file_dates = []
-
     # Declare path to directory holding E-Designation text files
 
     edesig_path = config.get('GENERATION_PATHS', 'EDesig_Path')
 
-    # Assign lists for all E-Designation text file exports
-
-    for filename in os.listdir(edesig_path):
-        if filename.endswith('.txt'):
-            filename_date = datetime.datetime.strptime(filename.split("_")[2][:-4], "%Y%m%d")
-            edesig_file_dates.append(filename_date)
-            edesig_file_names.append(filename.split(".")[0])
+    # Look up the most recent E-Designation file in the archive manifest rather than re-listing the archive
 
-    # Assign most recent E-Designation file to variable
+    print("Checking EDes archive manifest for most recent file")
+    with telemetry.stage('load_manifest') as record:
+        archive_manifest = edesig_manifest.load_manifest(edesig_path)
+        record.rows_out = len(archive_manifest.files)
+    latest_edesig_entry = archive_manifest.latest()
 
-    latest_edesig_txt = max(edesig_file_dates)
-    latest_edesig_name = max(edesig_file_names)
+    latest_edesig_txt = latest_edesig_entry.date
+    latest_edesig_name = latest_edesig_entry.name
     print(latest_edesig_name)
     print("Latest EDes file available is {}".format(str(latest_edesig_txt)))
 
-    # Generate BBLs from values expressed in most recent E-Designation file.
-
-    print("Generating BBL values from constituent fields")
-
-    for filename in os.listdir(edesig_path):
-        if filename.endswith('.txt'):
-            filename_date = datetime.datetime.strptime(filename.split("_")[2][:-4], "%Y%m%d")
-            if filename_date == latest_edesig_txt:
-
-                # Convert most recent E-Desgination TXT file into Pandas DataFrame.
-
-                latest_edesig_csv = pd.read_csv(os.path.join(edesig_path, filename),
-                                                sep=",",
-                                                names = ["ENUMBER", "E_DATE", "BOROCODE", "TAXBLOCK","TAXLOT", "HAZMAT",
-                                                         "AIR", "NOISE","HAZMAT_D", "AIR_DATE", "NOISE_D", "CEQR_NUM",
-                                                         "ULURP_NUM", "BBL"])
-
-                str_filename_date = filename_date.strftime("%Y%m%d")
-
-                # Modify DataFrame to generate BBL values from available fields.
-
-                latest_edesig_csv['BBL'] = latest_edesig_csv.apply(lambda row: row.BOROCODE*1000000000 + row.TAXBLOCK*10000 + row.TAXLOT, axis=1)
-                print("Converting file type from txt to csv")
-
-                # Convert most recent E-Designation Pandas DataFrame into CSV file.
-
-                latest_edesig_csv.to_csv(os.path.join(temp_path, filename.replace("txt", "csv")))
-
-    # Convert csv to DBASE table and import into temporary FGDB.
-
-    print("Connecting to Temp File Geodatabase")
-    arcpy.env.workspace = temp_path
-
-    for csv in arcpy.ListTables():
-        print('Tables currently available in temporary Geodatabase: '.format(csv))
-        arcpy.env.workspace = gdb_path
-        if arcpy.Exists(csv.replace('.csv', '')) is False:
-            print("Converting file type from csv to dbf")
-            arcpy.TableToDBASE_conversion(os.path.join(temp_path, csv), gdb_path)
-            print("Deleting unnecessary field")
-            arcpy.DeleteField_management(os.path.join(gdb_path, csv.replace('.csv', '.dbf')), 'Field1')
-        else:
-            print("Required base DBF exists. Skipping import")
-
-    # List feature classes currently in temporary GDB
-
-    arcpy.env.workspace = gdb_path
-
-    fc_list = arcpy.ListFeatureClasses()
-    print("The following feature classes are currently available within the GDB: {}".format(fc_list))
-
-    # Import MapPLUTO spatial files to temporary GDB
-
-    mappluto_path = config.get('GENERATION_PATHS', 'PROD_Path')
-
-    if "MapPLUTO_UNCLIPPED" in fc_list and "TAXLOT_POLYGON" in fc_list:
-        print("Required base FCs exist. Skipping import")
-    if "MapPLUTO_UNCLIPPED" not in fc_list:
-        print("MapPLUTO spatial file required. Importing MapPLUTO")
-        fms = arcpy.FieldMappings()
-
-        fm = arcpy.FieldMap()
-        fm.addInputField(os.path.join(mappluto_path, 'GISPROD.SDE.MapPLUTO_UNCLIPPED'), "BBL")
-        fms.addFieldMap(fm)
-
-        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(mappluto_path, 'GISPROD.SDE.MapPLUTO_UNCLIPPED'),
-                                                    gdb_path, "MapPLUTO_UNCLIPPED", "", fms)
-
-    # Import Tax Lot Polygon spatial files to temporary GDB
-
-    taxlot_path = config.get('GENERATION_PATHS', 'Cadastral_Path')
-
-    if "TAXLOT_POLYGON" not in fc_list:
-        print("TaxLot Polygon spatial file required. Importing TaxLot Polygon")
-        fms = arcpy.FieldMappings()
-
-        fm = arcpy.FieldMap()
-        fm.addInputField(os.path.join(taxlot_path, "GISPROD.SDE.Tax_Lot_Polygon"),
-                         "BBL")
-        fms.addFieldMap(fm)
-        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(taxlot_path, 'GISPROD.SDE.Tax_Lot_Polygon'),
-                                                    gdb_path, "TAXLOT_POLYGON", "", fms)
-
-    # Add Double Field to TaxLot Polygon for future join
-
-    print("Checking Tax Lot Polygon FC for Double BBL field")
-    field_list = [field.name for field in arcpy.ListFields(os.path.join(gdb_path, "TAXLOT_POLYGON"))]
-
-    if "DBBL" in field_list:
-        print("DBBL is already present in the Tax Lot Feature Class")
-    else:
-        print("DBBL is not present in Tax Lot FC. Creating now")
-        arcpy.AddField_management(os.path.join(gdb_path, "TAXLOT_POLYGON"), "DBBL", "DOUBLE")
-        print("Populating DBBL field.")
-        arcpy.CalculateField_management(os.path.join(gdb_path, "TAXLOT_POLYGON"), 'DBBL', '!BBL!')
-
-    # Create in-memory feature layers and table views for join.
-
-    arcpy.env.workspace = gdb_path
-    gdb_files = arcpy.ListTables()
-
-    arcpy.env.workspace = "in_memory"
-
-    for f in gdb_files:
-        print("EDes table available: {}".format(f))
-
-        # Check that table view for join doesn't already exist within workspace
-
-        if 'GIS' in f and arcpy.Exists('EDES_TableView') is False:
-            print("Creating Table View for EDes file")
-            arcpy.MakeTableView_management(os.path.join(gdb_path, f), "EDES_TableView")
-            print(arcpy.Exists("EDES_TableView"))
-        else:
-            print("EDes_TableView already exists. Deleting and re-creating.")
-            arcpy.Delete_management("EDES_TableView")
-            arcpy.MakeTableView_management(os.path.join(gdb_path, f), "EDES_TableView")
-
-    # Create temporary feature layers for MapPLUTO and TaxLot Polygon spatial files
-
-    print("Creating Feature Layers for MapPLUTO and TaxLot")
-    arcpy.MakeFeatureLayer_management(os.path.join(gdb_path, "MapPLUTO_UNCLIPPED"), "MapPLUTO_FeatLayer")
-    arcpy.MakeFeatureLayer_management(os.path.join(gdb_path, "TAXLOT_POLYGON"), "TaxLot_FeatLayer")
-
-    print(arcpy.Exists("MapPLUTO_FeatLayer"))
-    print(arcpy.Exists("TaxLot_FeatLayer"))
-
-    # Join EDes to MapPLUTO and retain matching records.
-
-    print("Joining MapPLUTO and EDes for matching records")
-    arcpy.env.workspace = gdb_path
-    fc_list = arcpy.ListFeatureClasses()
-    arcpy.AddJoin_management("MapPLUTO_FeatLayer", "BBL", "EDES_TableView", "BBL", "KEEP_ALL")
-
-    print("Getting first join field")
-    for field in arcpy.ListFields("MapPLUTO_FeatLayer"):
-        if 'BBL' in field.name.upper() and 'E_GIS' in field.name.upper():
-            bbl_join_field = field.name
-            print("join field set: {}".format(bbl_join_field))
-
-    print("Creating MapPLUTO Match Feature Class")
-    if 'MapPLUTO_MatchBBL' in fc_list:
-        print("MapPLUTO Match FC already exists. Skipping.")
-    else:
-        print("Copying MapPLUTO Match Feature Class to Geodatabase")
-        arcpy.CopyFeatures_management("MapPLUTO_FeatLayer", "MapPLUTO_MatchBBL")
-        print("Copy of MapPLUTO Match Feature Class Complete")
-
-    print("Creating MapPLUTO Match Selection Feature Class")
-    sql_1 = "{0} IS NOT NULL".format(arcpy.AddFieldDelimiters(latest_edesig_name, bbl_join_field.replace(".", "_")))
-    print(sql_1)
-
-    if 'MapPLUTO_MatchBBL_Selection' in fc_list:
-        print("MapPLUTO Match Selection FC already exists. Skipping")
-    else:
-        print("Selecting unique MapPLUTO matches")
-        arcpy.Select_analysis("MapPLUTO_MatchBBL", "MapPLUTO_MatchBBL_Selection", where_clause=sql_1)
-        print("MapPLUTO Match Selection Created")
-
-    # Delete in-memory table and layer in preparation for re-join
-
-    print("Deleting old in_memory table and layer")
-    arcpy.Delete_management("MapPLUTO_FeatLayer")
-    arcpy.Delete_management("EDES_TableView")
-
-    # Re-creating in-memory table and layer
-
-    print("Re-creating in_memory table and layer")
-    for f in gdb_files:
-        print("EDes table available: {}".format(f))
-        if 'GIS' in f and arcpy.Exists('EDES_TableView') is False:
-            print("Creating Table View for {}".format(f))
-            arcpy.MakeQueryTable_management(os.path.join(gdb_path, f), "EDES_TableView", 'ADD_VIRTUAL_KEY_FIELD')
-            print(arcpy.Exists("EDES_TableView"))
-        else:
-            print("EDes_TableView already exists. Deleting and re-creating.")
-            arcpy.Delete_management("EDES_TableView")
-            arcpy.MakeQueryTable_management(os.path.join(gdb_path, f), "EDES_TableView", 'ADD_VIRTUAL_KEY_FIELD')
-
-    arcpy.MakeFeatureLayer_management(os.path.join(gdb_path, "MapPLUTO_UNCLIPPED"), "MapPLUTO_FeatLayer")
-    print(arcpy.Exists("MapPLUTO_FeatLayer"))
-
-    # Join EDes to MapPLUTO and retain non-matching records.
-
-    print("Joining EDES and MapPLUTO for non-matching records")
-    arcpy.env.workspace = gdb_path
-    arcpy.AddJoin_management("EDES_TableView", "BBL", "MapPLUTO_FeatLayer", "BBL", "KEEP_ALL")
-
-    # Check that join worked correctly. Not typically used, but left for special cases
-
-    fields = arcpy.ListFields("EDES_TableView")
-    fields = [field.name for field in fields]
-    print(fields)
-
-    with arcpy.da.SearchCursor("EDES_TableView", fields) as cursor:
-            for row in cursor:
-                print("{0}, {1}".format(row[14], row[16]))
-
-    arcpy.env.workspace = gdb_path
-    tbl_list = arcpy.ListTables()
-
-    if 'EDES_NoMatchBBL' in tbl_list:
-        print("Edes No Match Table already exists. Skipping")
-    else:
-        print("Creating Edes No Match Table")
-        arcpy.TableToTable_conversion("EDES_TableView", gdb_path, 'EDES_NoMatchBBL')
-        print("Edes No Match table created")
-
-    # sql_2 = '{} IS NULL'.format(arcpy.AddFieldDelimiters("EDES_NoMatchBBL", "BBL_1"))
-    sql_2 = '{} IS NULL'.format(arcpy.AddFieldDelimiters("EDES_NoMatchBBL", "BBL"))
-
-    if 'EDES_NoMatchBBL_Selection' in tbl_list:
-        print("Edes non-matching table already exists. Skipping")
-    else:
-        print("Creating Edes No Match Selection table")
-        arcpy.TableSelect_analysis("EDES_NoMatchBBL", "EDES_NoMatchBBL_Selection", sql_2)
-        print("EDes No Match Selection Created")
-
-    print("Creating Table View for EDes non-BBL Match records")
-    arcpy.MakeTableView_management(os.path.join(gdb_path, "EDES_NoMatchBBL_Selection.dbf"), "EDES_NoMatchBBL_TableView")
-
-    # Join EDes to TaxLot and retain matching records.
-
-    print("Joining TaxLot and EDes for matching records")
-    arcpy.AddJoin_management("TAXLOT_FeatLayer", "DBBL", "EDES_NoMatchBBL_TableView", "BBL", "KEEP_COMMON")
-
-    arcpy.env.workspace = gdb_path
-    fc_list = arcpy.ListFeatureClasses()
-
-    print("Creating TaxLot Match Feature Class")
-    if 'TaxLot_MatchBBL' in fc_list:
-        print("TaxLot Match FC already exists. Skipping")
-    else:
-        arcpy.FeatureClassToFeatureClass_conversion("TAXLOT_FeatLayer", gdb_path, "TaxLot_MatchBBL")
-
-    # Match field names across joined mappluto FC and taxlot FC.
-
-    retain_fields_pluto = ['E_GIS_{}_ENUMBER'.format(str_filename_date), 'E_GIS_{}_CEQR_NUM'.format(str_filename_date),
-                           'E_GIS_{}_ULURP_NUM'.format(str_filename_date), 'E_GIS_{}_BOROCODE'.format(str_filename_date),
-                           'E_GIS_{}_TAXBLOCK'.format(str_filename_date), 'E_GIS_{}_TAXLOT'.format(str_filename_date),
-                           'E_GIS_{}_BBL'.format(str_filename_date)]
-
-    retain_fields_taxlot = ['OBJECTID_12', 'ENUMBER', 'CEQR_NUM', 'ULURP_NUM', 'BOROCODE', 'TAXBLOCK', 'TAXLOT', 'BBL']
-
-    req_fields = ['OBJECTID', 'Shape', 'Shape_Area', 'Shape_Length']
-
-    available_fields_pluto = arcpy.ListFields(os.path.join(gdb_path, "MapPLUTO_MatchBBL_Selection"))
-
-    if len(available_fields_pluto) == 11:
-        print("Fields have already gone through process for MapPLUTO")
-    else:
-        for field in available_fields_pluto:
-            if field.name not in retain_fields_pluto and field.name not in req_fields:
-                print("Deleting the following field from MapPLUTO: {}".format(field.name))
-                arcpy.DeleteField_management(os.path.join(gdb_path, "MapPLUTO_MatchBBL_Selection"), field.name)
-            if field.name in retain_fields_pluto and field.name not in req_fields:
-                print("Altering the following field in MapPLUTO: {}".format(field.name))
-                arcpy.AlterField_management("MapPLUTO_MatchBBL_Selection", field.name, field.name.replace(latest_edesig_name
-                                                                                                          + "_", ""))
-
-    available_fields_taxlot = arcpy.ListFields(os.path.join(gdb_path, 'TaxLot_MatchBBL'))
-
-    if len(available_fields_taxlot) == 12:
-        print("Fields have already gone through processing for TaxLot")
-    else:
-        for field in available_fields_taxlot:
-            if field.name not in retain_fields_taxlot and field.name not in req_fields:
-                print("Deleting the following field in TaxLot: {}".format(field.name))
-                arcpy.DeleteField_management(os.path.join(gdb_path, "TaxLot_MatchBBL"), field.name)
-
-    # Merge MapPLUTO and TaxLot feature layers to get comprehensive list of E-Designation records
-
-    merge_list = [os.path.join(gdb_path, "MapPLUTO_MatchBBL_Selection"), os.path.join(gdb_path, "TaxLot_MatchBBL")]
-    print("Merging TaxLot and MapPLUTO Match FCs.")
-
-    if arcpy.Exists(os.path.join(gdb_path, "EDesignations_FinalPoly")):
-        print("EDesignation_FinalPoly already exists. Skipping")
-    else:
-        arcpy.Merge_management(merge_list, os.path.join(gdb_path, "EDesignations_FinalPoly"))
-
-    # Convert polygons to centroid points
-
-    print("Converting Feature polygons to centroid points.")
-
-    if arcpy.Exists(os.path.join(gdb_path, 'EDesignations_FinalPoint')):
-        print("EDesignation_FinalPoint already exists. Skipping")
-    else:
-        arcpy.FeatureToPoint_management("EDesignations_FinalPoly", "EDesignations_FinalPoint")
-
-    # Re-ordering fields with field map to match previous releases
-
-    print("Re-ordering fields with field mapping")
-
-    fms = arcpy.FieldMappings()
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), "ENUMBER")
-    fms.addFieldMap(fm)
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), 'CEQR_NUM')
-    fms.addFieldMap(fm)
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), 'ULURP_NUM')
-    fms.addFieldMap(fm)
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), 'BOROCODE')
-    fms.addFieldMap(fm)
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), 'TAXBLOCK')
-    fms.addFieldMap(fm)
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), 'TAXLOT')
-    fms.addFieldMap(fm)
-
-    fm = arcpy.FieldMap()
-    fm.addInputField(os.path.join(gdb_path, "EDesignations_FinalPoint"), 'BBL')
-    fms.addFieldMap(fm)
-
-    print("Re-ordering fields complete.")
-    print("Exporting final result to point feature class")
-
-    # Begin exporting final product to temporary geodatabase location
-
-    if arcpy.Exists(os.path.join(gdb_path, 'nyedes_{}'.format(current_date))):
-        print("EARD_EDesignations already exists. Skipping")
-    else:
-        arcpy.FeatureClassToFeatureClass_conversion(os.path.join(gdb_path, "EDesignations_FinalPoint"),
-                                                    gdb_path, "nyedes_{}".format(current_date), "", fms)
-
-    # Begin exporting final product to temporary shapefile folder
-
-    if arcpy.Exists(os.path.join(temp_path, "shp", "nyedes_{}".format(current_date))):
-        print("EDes shapefile already exists. Skipping")
-    else:
-        print("Exporting EARD_EDesignations shapefile to shapefile folder")
-        arcpy.FeatureClassToShapefile_conversion(os.path.join(gdb_path, "nyedes_{}".format(current_date)),
-                                                 os.path.join(temp_path, "shp"))
+    # Stage the export on local disk, checked against the SHA-256 recorded in the archive manifest. Validation and the
+    # ingest read the local copy rather than the network archive.
+
+    staging_path = config.get('GENERATION_PATHS', 'Staging_Path', fallback=os.path.join(temp_path, 'staging'))
+    transfer_workers = config.getint('GENERATION_PATHS', 'Transfer_Workers', fallback=edesig_staging.DEFAULT_WORKERS)
+    with telemetry.stage('stage_inputs') as record:
+        latest_edesig_path, = edesig_staging.stage_files(
+            [(archive_manifest.path(latest_edesig_entry), latest_edesig_entry.sha256)], staging_path,
+            workers=transfer_workers)
+        record.bytes_written = edesig_telemetry.file_size(latest_edesig_path)
+
+    # Validate every column of the export before any base-layer work starts. Lines that would be dropped or could not
+    # be placed on a lot are rejected; the rejection file and summary are written to the temporary directory and the
+    # run stops here if more lines are rejected than Max_Rejected_Rows allows.
+
+    print("Validating {}".format(latest_edesig_entry.filename))
+    with telemetry.stage('validate_export') as record:
+        validation_report = edesig_validate.validate_export(latest_edesig_path)
+        record.rows_in = validation_report.rows_read
+        record.rows_out = validation_report.rows_read - len(validation_report.rejected_lines)
+    print(validation_report.summary())
+    validation_report.write_summary(os.path.join(temp_path, edesig_validate.SUMMARY_FILENAME.format(
+        latest_edesig_name)))
+    if len(validation_report.issues):
+        rejection_path = os.path.join(temp_path, edesig_validate.REJECTION_FILENAME.format(latest_edesig_name))
+        print("Writing rejected and flagged E-Designation lines to {}".format(rejection_path))
+        validation_report.write(rejection_path)
+    max_rejected_rows = config.getint('GENERATION_PATHS', 'Max_Rejected_Rows', fallback=0)
+    if not validation_report.passed(max_rejected_rows):
+        raise ValueError("{0} lines of {1} failed validation ({2} allowed by Max_Rejected_Rows). See {3}".format(
+            len(validation_report.rejected_lines), latest_edesig_entry.filename, max_rejected_rows, rejection_path))
+
+    # The generation steps below run as named pipeline stages. Each stage records a checkpoint with a fingerprint of
+    # its inputs in the temporary directory, so a rerun skips every stage whose checkpoint is still valid and resumes
+    # from the first stage whose inputs, release or outputs have changed. Independent stages run concurrently, up to
+    # Max_Stage_Workers at a time, when the backend is thread-safe. arcpy is not, so with the arcpy backend the stages
+    # always run one at a time.
+
+    max_stage_workers = config.getint('GENERATION_PATHS', 'Max_Stage_Workers', fallback=1)
+    if not backend.thread_safe and max_stage_workers > 1:
+        print("Max_Stage_Workers = {0} ignored: the {1} backend runs one stage at a time".format(max_stage_workers,
+                                                                                                 backend.name))
+        max_stage_workers = 1
+    pipeline = edesig_stages.Pipeline(os.path.join(temp_path, "edesig_checkpoints.json"), exists=backend.exists,
+                                      remove=backend.remove, max_workers=max_stage_workers, telemetry=telemetry)
+
+    # Pull MapPLUTO and TaxLot Polygon through the base-layer cache, which lives outside the temporary directory.
+    # Each source is fingerprinted on every run and is only pulled from SDE (or its GeoPackage) again when its
+    # fingerprint has changed.
+
+    base_layer_cache = edesig_cache.BaseLayerCache(config.get('GENERATION_PATHS', 'Cache_Path'),
+                                                   int(config.getfloat('GENERATION_PATHS', 'Cache_Max_GB') * 1024 ** 3))
+    base_layer_sources = backend.base_layer_sources(config)
+
+    layer_fingerprints = {}
+    for stage_name, source_code, out_name, source_fc in base_layer_sources:
+        print("Fingerprinting {}".format(source_fc))
+        layer_fingerprint = backend.source_fingerprint(source_fc)
+        layer_fingerprints[stage_name] = layer_fingerprint
+        pipeline.add(stage_name,
+                     lambda pipeline, source_code=source_code, source_fc=source_fc, out_name=out_name,
+                     layer_fingerprint=layer_fingerprint:
+                     backend.pull_base_layer(base_layer_cache, source_code, source_fc, out_name, layer_fingerprint,
+                                             telemetry.current()),
+                     outputs=[backend.cached_base_layer(base_layer_cache, out_name, layer_fingerprint)],
+                     params={'source': source_fc, 'fingerprint': layer_fingerprint,
+                             'bbl_column': edesig_schema.BASE_LAYER_BBL_COLUMNS[source_code]}, keep_outputs=True)
+
+    # Resolve every E-Designation record against MapPLUTO first and TaxLot second through the point index, so no
+    # joined copy of either base layer is written to the FGDB. The release fields, their order and the export columns
+    # they come from are declared in edesig_schema.
+
+    schema_fingerprint = edesig_schema.fingerprint()
+
+    # Optionally guarantee that each point falls within its lot, like FeatureToPoint with the INSIDE option
+
+    centroid_inside = config.getboolean('GENERATION_PATHS', 'Centroid_Inside', fallback=False)
+
+    # The BBL to centroid point index is built once per pair of base-layer versions and kept in the base-layer cache,
+    # along with the lots themselves for the QA stage. Releases are resolved against its memory-mapped arrays without
+    # reading any lot geometry.
+
+    point_index_fingerprint = edesig_pointindex.index_fingerprint(
+        [layer_fingerprints[stage_name] for stage_name, source_code, out_name, source_fc in base_layer_sources],
+        centroid_inside)
+
+    def point_index(pipeline):
+        return edesig_backend.point_index(
+            backend, base_layer_cache, [(source_code, pipeline.results[stage_name])
+                               for stage_name, source_code, out_name, source_fc in base_layer_sources],
+            point_index_fingerprint, centroid_inside, telemetry.current())
+
+    pipeline.add("point_index", point_index,
+                 outputs=[base_layer_cache.entry_path(edesig_pointindex.CACHE_LAYER, point_index_fingerprint)],
+                 after=["pull_mappluto", "pull_taxlot"],
+                 params={'fingerprint': point_index_fingerprint}, keep_outputs=True)
+
+    def join_points(pipeline):
+        index = edesig_pointindex.PointIndex.load(pipeline.results["point_index"])
+        print("Point index of {} BBLs opened".format(len(index)))
+
+        # Stream the most recent E-Designation file as typed batches straight into the point index lookup. BBL values
+        # are generated from their constituent fields as each batch is read, so no interim CSV, DBF or table is
+        # written, and each matched record takes the centroid of its MapPLUTO lot, or failing that its TaxLot lot.
+
+        print("Locating EDes records in the MapPLUTO and TaxLot point index")
+        ingest_report = edesig_ingest.IngestReport()
+        edesig_matched, edesig_unmatched = edesig_pointindex.locate_chunks(
+            edesig_ingest.read_edesig_chunks(latest_edesig_path, ingest_report), index,
+            columns=edesig_schema.source_columns())
+
+        print(ingest_report.summary())
+        record = telemetry.current()
+        record.rows_in = ingest_report.rows_read
+        record.bytes_read = edesig_telemetry.file_size(latest_edesig_path)
+        if ingest_report.issues:
+            print("Writing malformed E-Designation lines to temporary directory")
+            ingest_report.write(os.path.join(temp_path, "{}_ingest_issues.csv".format(latest_edesig_name)))
+
+        if len(edesig_unmatched):
+            print("{} EDes records matched neither MapPLUTO nor TaxLot. Writing EDES_NoMatchBBL.csv to temporary "
+                  "directory".format(len(edesig_unmatched)))
+            edesig_unmatched.to_csv(os.path.join(temp_path, "EDES_NoMatchBBL.csv"))
+
+        if not len(edesig_matched):
+            raise ValueError("No E-Designation record in {} matched a lot".format(latest_edesig_entry.filename))
+
+        for stage_name, source_code, out_name, source_fc in base_layer_sources:
+            print("{0} EDes records matched {1}".format(int((edesig_matched["SOURCE"] == source_code).sum()),
+                                                        edesig_join.SOURCE_NAMES[source_code]))
+
+        point_x = edesig_matched["POINT_X"].values
+        point_y = edesig_matched["POINT_Y"].values
+
+        has_point = np.isfinite(point_x) & np.isfinite(point_y)
+        if not has_point.all():
+            print("{} matched lots have no geometry and will be left out".format(int((~has_point).sum())))
+
+        # Keep the joined records and their centroids as a point array in release field order. The feature class and
+        # the shapefile are both written from it, so no intermediate table is written and then trimmed.
+
+        print("Creating EDesignations_FinalPoint from centroid points")
+        point_array = edesig_schema.project_points(edesig_matched[has_point], point_x[has_point], point_y[has_point],
+                                                   extra_fields=[("SOURCE", np.int16)])
+        np.save(os.path.join(temp_path, "EDesignations_FinalPoint.npy"), point_array)
+        record.rows_out = len(point_array)
+        return {"points": len(point_array), "unmatched": len(edesig_unmatched)}
+
+    pipeline.add("join_points", join_points, inputs=[latest_edesig_path],
+                 outputs=[os.path.join(temp_path, "EDesignations_FinalPoint.npy")], after=["point_index"],
+                 params={'release': latest_edesig_entry.filename, 'sha256': latest_edesig_entry.sha256,
+                         'centroid_inside': centroid_inside, 'schema': schema_fingerprint})
+
+    release_dataset_path = backend.dataset_path(workspace_path, "nyedes_{}".format(current_date))
+
+    def export_fc(pipeline):
+        # Write the final product to the temporary workspace (a feature class, or a GeoPackage with the open backend)
+        # straight from the point array, holding only the release fields in the order of previous releases.
+
+        print("Exporting final result to point feature class")
+        point_array = edesig_schema.release_array(np.load(os.path.join(temp_path, "EDesignations_FinalPoint.npy")))
+        backend.write_points(release_dataset_path, point_array,
+                             backend.spatial_reference(pipeline.results["pull_mappluto"]))
+        telemetry.current().rows_out = len(point_array)
+        return release_dataset_path
+
+    pipeline.add("export_fc", export_fc, outputs=[release_dataset_path],
+                 after=["join_points"], params={'date': current_date, 'schema': schema_fingerprint})
+
+    def qa_points(pipeline):
+        # Check that every output point falls inside a lot with its own BBL. The lots saved with the point index are
+        # searched through an STR tree per base layer, so no spatial join geoprocessing run is needed.
+
+        print("Checking that every point falls inside its lot")
+        index = edesig_pointindex.PointIndex.load(pipeline.results["point_index"])
+        lot_layers = [edesig_qa.LotLayer(edesig_join.SOURCE_NAMES[source_code], lot_bbl, lot_polygons)
+                      for source_code, lot_bbl, lot_polygons in index.load_lots()]
+        points = backend.read_points(pipeline.results["export_fc"])
+        qa_report = edesig_qa.check_points(points["POINT_X"], points["POINT_Y"], points["BBL"], lot_layers)
+        print(qa_report.summary())
+
+        record = telemetry.current()
+        record.rows_in = qa_report.point_count
+        record.rows_out = len(qa_report.issues)
+        if not qa_report.passed:
+            qa_path = os.path.join(temp_path, "nyedes_{}_qa_issues.csv".format(current_date))
+            print("Writing failing points to {}".format(qa_path))
+            qa_report.write(qa_path)
+        return dict(qa_report.counts(), points=qa_report.point_count)
+
+    pipeline.add("qa_points", qa_points, after=["point_index", "export_fc"], params={'date': current_date})
+
+    def export_shp(pipeline):
+        # Write the final product to the temporary shapefile folder straight from the point array, in release field
+        # order. The shapefile writer takes several destinations if more copies are ever needed.
+
+        print("Writing EARD_EDesignations shapefile to shapefile folder")
+        point_array = np.load(os.path.join(temp_path, "EDesignations_FinalPoint.npy"))
+        output_sr = backend.spatial_reference(pipeline.results["pull_mappluto"])
+        shp_base = os.path.join(temp_path, "shp", "nyedes_{}".format(current_date))
+        edesig_shapefile.write_points([shp_base], point_array["POINT_X"], point_array["POINT_Y"], point_array,
+                                      edesig_schema.dbf_fields(), prj=edesig_backend.esri_wkt(output_sr))
+        record = telemetry.current()
+        record.rows_out = len(point_array)
+        record.bytes_written = edesig_telemetry.file_size(*glob.glob(shp_base + ".*"))
+        return shp_base + ".shp"
+
+    pipeline.add("export_shp", export_shp,
+                 outputs=[os.path.join(temp_path, "shp", "nyedes_{}.shp".format(current_date))],
+                 after=["join_points"], params={'date': current_date, 'schema': schema_fingerprint})
+
+    def export_formats(pipeline):
+        # Write each additional output format (GeoParquet, GeoPackage, GeoJSON, CSV) from the same point array as the
+        # feature class and shapefile
+
+        point_array = np.load(os.path.join(temp_path, "EDesignations_FinalPoint.npy"))
+        output_sr = backend.spatial_reference(pipeline.results["pull_mappluto"])
+        paths = edesig_writers.write_outputs(
+            output_formats, os.path.join(temp_path, "formats", "nyedes_{}".format(current_date)), point_array,
+            edesig_writers.SpatialReference(edesig_backend.esri_wkt(output_sr), output_sr.epsg))
+        record = telemetry.current()
+        record.rows_out = len(point_array)
+        record.bytes_written = edesig_telemetry.file_size(*paths.values())
+        return list(paths.values())
+
+    if output_formats:
+        pipeline.add("export_formats", export_formats,
+                     outputs=[os.path.join(temp_path, "formats", "nyedes_{0}{1}".format(
+                         current_date, edesig_writers.WRITERS[name].extension)) for name in output_formats],
+                     after=["join_points"],
+                     params={'date': current_date, 'schema': schema_fingerprint, 'formats': output_formats})
+
+    pipeline.run()
+    print("Stage status: {}".format(", ".join("{0} {1}".format(stage.name, pipeline.status[stage.name])
+                                                for stage in pipeline.stages)))
 
     EndTime = datetime.datetime.now().replace(microsecond=0)
     print("Script runtime: {}".format(EndTime - StartTime))
@@ -447,7 +371,9 @@ except:
     tbinfo = traceback.format_tb(tb)[0]
 
     pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
-    msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages() + "\n"
+    msgs = ""
+    if 'backend' in globals():
+        msgs = backend.label + " ERRORS:\n" + backend.messages() + "\n"
 
     print(pymsg)
     print(msgs)
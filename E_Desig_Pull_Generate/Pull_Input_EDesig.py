@@ -1,5 +1,8 @@
 import win32com.client, datetime, os, subprocess, shutil, configparser, sys, traceback
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_diff, edesig_mailbox, edesig_manifest, edesig_telemetry
+
 '''
 Must use 32-bit version of arcpy that comes with the default installation of ArcGIS Desktop.
 Python installation must also include the win32com.client package 
@@ -17,6 +20,11 @@ try:
     log_path = config.get('INPUT_PULL_PATHS', 'Log_Path')
     log = open(os.path.join(log_path, 'log_input_pull_edesignations.txt'), "a")
 
+    # Record wall/CPU time, rows and bytes of every stage as JSON lines for run-to-run comparison
+    telemetry_path = config.get('INPUT_PULL_PATHS', 'Telemetry_Path',
+                                fallback=os.path.join(log_path, edesig_telemetry.TELEMETRY_FILENAME))
+    telemetry = edesig_telemetry.Telemetry(telemetry_path, 'pull')
+
     # Assign remaining paths from read ini file
     temp_path = config.get("INPUT_PULL_PATHS", "Temp_Path")
     python3_path = config.get("INPUT_PULL_PATHS", "Python3_Path")
@@ -28,101 +36,169 @@ try:
     # Assign today date variable for comparison in E-Designation archive
     today = datetime.datetime.now()
 
-    # Assign E-Designation archive path
+    # Assign E-Designation archive path and load its manifest
     edes_archive_path = config.get("INPUT_PULL_PATHS", "EDes_Path")
-
-    # Assign outlook object
-    outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
-
-    # Assign outlook inbox object
-    inbox = outlook.GetDefaultFolder(6)
-
-    # Assign object to hold all inbox emails
-    messages = inbox.Items
+    with telemetry.stage('load_manifest') as record:
+        archive_manifest = edesig_manifest.load_manifest(edes_archive_path)
+        record.rows_out = len(archive_manifest.files)
+
+    def run_generation():
+        # Run the generation script, recording its wall time and the CPU time of the child process
+        with telemetry.stage('generation') as record:
+            record.extra['returncode'] = subprocess.call([python3_path, gen_script_path])
+
+    # Assign mailbox object and the watermark holding the SentOn time of the newest E-Designation email already handled
+    mailbox = edesig_mailbox.OutlookMailbox()
+    watermark = edesig_mailbox.Watermark(config.get("INPUT_PULL_PATHS", "Mailbox_Watermark_Path",
+                                                    fallback=os.path.join(log_path, "edesig_mailbox_watermark.json")))
+    last_seen = watermark.load()
+    newest_sent_on = last_seen
+    if last_seen is not None:
+        print("Checking for E-Designation emails sent after {}".format(last_seen))
 
     # Create dictionary for holding E-Designation text file creation date (key) and associated attachment (value)
     e_des_dict = {}
 
-    # Loop through all inbox messages.
-    for message in messages:
-        try:
-            # Assign email properties
-            body_content = message.body
-            subject_content = message.Subject
-            sender_email = message.SenderEmailAddress
-            message_author = message.Sender
-            message_date_str = str(message.SentOn)
-            message_date = datetime.datetime.strptime(message_date_str, "%m/%d/%y %H:%M:%S")
+    # Loop through the new inbox messages that have "Latest" in the subject line and were sent by the E-Designation
+    # data owner. The subject, sender and date filter is applied by the mail store rather than message by message.
+    with telemetry.stage('mailbox_scan') as record:
+        message_count = 0
+        for message in mailbox.messages(subject="Latest", sender="SUSAN WONG", since=last_seen):
+            message_count += 1
+            newest_sent_on = max(newest_sent_on or message.sent_on, message.sent_on)
 
             # Check that "Latest E-Designation data file as of" exists within email subject line
-            if "Latest" in subject_content and "SUSAN WONG" in sender_email:
-                date_index = subject_content.find("as of") + 6
-                e_des_date = subject_content[date_index:].strip()
-                e_des_dt = datetime.datetime.strptime(e_des_date, "%m/%d/%Y")
-                print("E-Designation email found - {}".format(subject_content))
-                print("Adding email date: {} to E-Des dictionary".format(e_des_date))
-                attachments = message.Attachments
-
-                # Check that the particular email has an attachment otherwise continue the loop
-                if len(attachments) > 0:
-                    attachment = attachments.Item(1)
-                    e_des_dict[e_des_dt] = attachment
-                else:
-                    continue
-        # Handle errors in which particular email properties are Unknown
-        except AttributeError as error:
-            print("This particular email returned an Unknown sender. Skipping")
-            continue
-        # Handle errors in which particular email properties contain invalid/unreadable characters
-        except UnicodeEncodeError as error:
-            print("This particular email returned a sender value with an invalid character. Skipping")
-            continue
-
-    # Get the most recent E-Designation email and convert it to both datetime and formatted string objects
-    latest_edes = max(e_des_dict.keys())
-    latest_edes_str = latest_edes.strftime("%Y%m%d")
-    print("Latest E-Designation text file found - {}".format(latest_edes_str))
-
-    # Build email to send to GIS Team if a new E-Designation file was detected
-
-    outlook = win32com.client.Dispatch("Outlook.Application")
-    email_msg = outlook.CreateItem(0x0)
-    email_msg.To = email_recipient
-    email_msg.Subject = "E-Designation GIS Team Confirmation - {}".format(e_des_date)
-    email_msg.Body = "Greetings, \n\n" \
-               "This email is to notify GIS Team that an E-Designation text file was sent on {}. \n\n" \
-               "Please check the E-Designation archive directory to ensure that the file was correctly added. \n\n" \
-               "Also check the E-Designation script logs to confirm the generation script ran successfully. \n\n" \
-               "If the E-Designation file was archived correctly and the script log/temp directory indicates " \
-               "successful generation all that is left to do is run the E-Designation Distribution script to migrate " \
-               "the updated data set to the SDE and layer files. \n\n" \
-               "Thank you very much!".format(e_des_date)
-
-    # Check the E-Designation archive for the existence of the most recent E-Designation email attachment
-    if os.path.exists(os.path.join(edes_archive_path, "{}_{}.txt".format(str(e_des_dict[latest_edes])[:5], latest_edes_str))):
-        # If the most recent E-Designation email attachment already exists in archive, log result and end script
-        print("The latest E-Des text file has already been added to the appropriate path")
-        print("Aborting script. "
-              "If you are sure that the E-Des text file currently in archive is out-of-date. "
-              "Please compare email attachment and latest E-Des archive file")
+            date_index = message.subject.find("as of") + 6
+            try:
+                e_des_dt = datetime.datetime.strptime(message.subject[date_index:].strip(), "%m/%d/%Y")
+            except ValueError:
+                print("This particular email has no E-Designation date in its subject line. Skipping")
+                continue
+            print("E-Designation email found - {}".format(message.subject))
+            print("Adding email date: {} to E-Des dictionary".format(e_des_dt.strftime("%m/%d/%Y")))
+
+            # Check that the particular email has an attachment otherwise continue the loop
+            if len(message.attachments) > 0:
+                e_des_dict[e_des_dt] = message.attachments[0]
+            else:
+                continue
+        record.rows_in = message_count
+        record.rows_out = len(e_des_dict)
+
+    if not e_des_dict:
+        print("No new E-Designation emails found")
         log_new_date = ''
     else:
-        # If the most recent E-Designation email attachment does not exist, save to archive, delete previous output directory, and kick off EDes Generation script
-        e_des_dict[latest_edes].SaveAsFile(os.path.join(edes_archive_path, "{}_{}.txt".format(str(e_des_dict[latest_edes])[:5], latest_edes_str)))
-        if os.path.exists(temp_path):
-            print("Previous temp dir detected. Removing prev directory with old outputs")
-            shutil.rmtree(temp_path)
-            print("Beginning to run E-Designation generation script. Outputs will print below:")
-            subprocess.call([python3_path, gen_script_path])
-            print("Generation script complete. Sending notification email to GIS Team DL")
-            email_msg.Send()
-            log_new_date = e_des_date
+        # Get the most recent E-Designation email and convert it to both datetime and formatted string objects
+        latest_edes = max(e_des_dict.keys())
+        latest_edes_str = latest_edes.strftime("%Y%m%d")
+        e_des_date = latest_edes.strftime("%m/%d/%Y")
+        print("Latest E-Designation text file found - {}".format(latest_edes_str))
+
+        # Build email to send to GIS Team if a new E-Designation file was detected
+
+        outlook = win32com.client.Dispatch("Outlook.Application")
+        email_msg = outlook.CreateItem(0x0)
+        email_msg.To = email_recipient
+        email_msg.Subject = "E-Designation GIS Team Confirmation - {}".format(e_des_date)
+        email_body = "Greetings, \n\n" \
+                   "This email is to notify GIS Team that an E-Designation text file was sent on {}. \n\n" \
+                   "Please check the E-Designation archive directory to ensure that the file was correctly " \
+                   "added. \n\n" \
+                   "Also check the E-Designation script logs to confirm the generation script ran successfully. \n\n" \
+                   "If the E-Designation file was archived correctly and the script log/temp directory indicates " \
+                   "successful generation all that is left to do is run the E-Designation Distribution script to " \
+                   "migrate the updated data set to the SDE and layer files. \n\n".format(e_des_date)
+        email_msg.Body = email_body + "Thank you very much!"
+
+        # Read the most recent E-Designation email attachment into memory and hash it, both byte for byte and with its
+        # lines sorted and stripped of padding, so it can be looked up in the archive manifest before it is saved
+        latest_edes_filename = "{}_{}.txt".format(str(e_des_dict[latest_edes])[:5], latest_edes_str)
+        with telemetry.stage('hash_attachment') as record:
+            attachment_content = edesig_mailbox.attachment_content(e_des_dict[latest_edes])
+            attachment_sha256, attachment_normalized_sha256 = edesig_manifest.hash_content(attachment_content)
+            duplicate_entry, duplicate_match = archive_manifest.duplicate_of(attachment_sha256,
+                                                                             attachment_normalized_sha256)
+            record.bytes_read = len(attachment_content)
+            record.extra['match'] = duplicate_match
+
+        # Check the E-Designation archive manifest for the most recent E-Designation email attachment
+        if archive_manifest.get(latest_edes_filename) is not None:
+            # If the most recent E-Designation email attachment already exists in archive, log result and end script
+            print("The latest E-Des text file has already been added to the appropriate path")
+            print("Aborting script. "
+                  "If you are sure that the E-Des text file currently in archive is out-of-date. "
+                  "Please compare email attachment and latest E-Des archive file")
+            log_new_date = ''
+        elif duplicate_entry is not None and duplicate_entry == archive_manifest.latest():
+            # A resent export holding the same records as the latest release (the one the current outputs were
+            # generated from) is recorded as an alias of that release and nothing is regenerated
+            archive_manifest.add_alias(latest_edes_filename, duplicate_entry, duplicate_match, attachment_sha256,
+                                       attachment_normalized_sha256)
+            print("The latest E-Des text file is {0} to the latest archived release {1}. Recording {2} as an alias "
+                  "without regenerating".format(
+                      "byte for byte identical" if duplicate_match == edesig_manifest.MATCH_IDENTICAL
+                      else "identical apart from line order and whitespace", duplicate_entry.filename,
+                      latest_edes_filename))
+            log_new_date = ''
         else:
-            print("Beginning to run E-Designation generation script. Outputs will print below:")
-            subprocess.call([python3_path, gen_script_path])
-            print("Generation script complete. Sending notification email to GIS Team DL")
-            email_msg.Send()
-            log_new_date = e_des_date
+            # If the most recent E-Designation email attachment does not exist, save to archive, delete previous output
+            # directory, and kick off EDes Generation script. The attachment is written from memory under a temporary
+            # name that the archive watcher ignores, then renamed into place.
+            if duplicate_entry is not None:
+                print("The latest E-Des text file matches the earlier release {}. Archiving it as a new release".format(
+                    duplicate_entry.filename))
+            with telemetry.stage('archive_attachment') as record:
+                temp_archive_path = os.path.join(edes_archive_path, latest_edes_filename + '.part')
+                with open(temp_archive_path, 'wb') as archive_file:
+                    archive_file.write(attachment_content)
+                edesig_manifest.replace_file(temp_archive_path, os.path.join(edes_archive_path, latest_edes_filename))
+                archive_manifest.add(latest_edes_filename)
+                record.bytes_written = archive_manifest.get(latest_edes_filename).size
+
+            # Compare the new export with the previous release and add the change summary to the notification email.
+            # The change report and changeset are kept in Diff_Path, outside the temp directory.
+            previous_entry = archive_manifest.previous(latest_edes_filename)
+            if previous_entry is not None:
+                try:
+                    with telemetry.stage('release_diff') as record:
+                        release_diff = edesig_diff.compare_files(archive_manifest.path(previous_entry),
+                                                                 os.path.join(edes_archive_path, latest_edes_filename))
+                        record.rows_in = len(release_diff.old) + len(release_diff.new)
+                        record.rows_out = sum(release_diff.counts().values())
+                        diff_path = config.get("INPUT_PULL_PATHS", "Diff_Path",
+                                               fallback=os.path.join(log_path, "changes"))
+                        report_path, changeset_path = edesig_diff.write_diff(
+                            release_diff, diff_path, previous_entry.release_date, latest_edes_str)
+                    print(release_diff.summary())
+                    email_msg.Body = email_body + release_diff.summary() + "\n\n" \
+                        "The full list of changes is in {}. \n\n" \
+                        "Thank you very much!".format(changeset_path)
+                except Exception as error:
+                    # A failed comparison must not hold up generation; the email is sent without the summary
+                    print("Unable to compare with the previous release {0}: {1}".format(previous_entry.filename, error))
+            if not config.getboolean("INPUT_PULL_PATHS", "Run_Generation", fallback=True):
+                # Generation is started by Watch_EDesig_Archive.py as soon as the file lands in the archive
+                print("E-Des text file archived. Leaving generation to the archive watcher")
+                log_new_date = e_des_date
+            elif os.path.exists(temp_path):
+                print("Previous temp dir detected. Removing prev directory with old outputs")
+                shutil.rmtree(temp_path)
+                print("Beginning to run E-Designation generation script. Outputs will print below:")
+                run_generation()
+                print("Generation script complete. Sending notification email to GIS Team DL")
+                email_msg.Send()
+                log_new_date = e_des_date
+            else:
+                print("Beginning to run E-Designation generation script. Outputs will print below:")
+                run_generation()
+                print("Generation script complete. Sending notification email to GIS Team DL")
+                email_msg.Send()
+                log_new_date = e_des_date
+
+    # Advance the watermark only once the new emails have been handled, so a failed run scans them again
+    if newest_sent_on is not None and newest_sent_on != last_seen:
+        watermark.save(newest_sent_on)
 
     # Log total script run-time
     EndTime = datetime.datetime.now().replace(microsecond=0)
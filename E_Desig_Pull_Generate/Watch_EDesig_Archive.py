@@ -0,0 +1,108 @@
+import win32com.client, datetime, os, configparser, sys, traceback
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'E_Desig_Common'))
+import edesig_diff, edesig_manifest, edesig_watcher
+
+'''
+Long-running watcher for the E-Designation archive directory. Must be run using the same Python 3 installation as
+Pull_Input_EDesig.py (win32com.client is required for the notification email).
+
+As soon as a new E-Designation export is completely written to the archive (its size and modification time have
+settled), the generation script is started in the background and the archive keeps being watched. A notification
+email is sent to the GIS Team when each generation run finishes, with a summary of the changes in the newest release
+against the one before it.
+'''
+
+try:
+    # Assign and read initialization file for required path information
+    config = configparser.ConfigParser()
+    config.read(r"edesig_config_template.ini")
+
+    # Assign log object for outputting run-time details
+    log_path = config.get('INPUT_PULL_PATHS', 'Log_Path')
+    log = open(os.path.join(log_path, 'log_watch_edesignations.txt'), "a")
+
+    # Assign remaining paths from read ini file
+    edes_archive_path = config.get("INPUT_PULL_PATHS", "EDes_Path")
+    python3_path = config.get("INPUT_PULL_PATHS", "Python3_Path")
+    gen_script_path = config.get("INPUT_PULL_PATHS", "Generation_Script_Path")
+    email_recipient = config.get("INPUT_PULL_PATHS", "Email_Recipient")
+    poll_seconds = config.getfloat("INPUT_PULL_PATHS", "Watch_Poll_Seconds",
+                                   fallback=edesig_watcher.DEFAULT_POLL_SECONDS)
+    settle_seconds = config.getfloat("INPUT_PULL_PATHS", "Watch_Settle_Seconds",
+                                     fallback=edesig_watcher.DEFAULT_SETTLE_SECONDS)
+    diff_path = config.get("INPUT_PULL_PATHS", "Diff_Path", fallback=os.path.join(log_path, "changes"))
+
+    # Files already in the archive when the watcher starts are recorded in the manifest and are not generated again
+    archive_manifest = edesig_manifest.load_manifest(edes_archive_path)
+    watcher = edesig_watcher.ArchiveWatcher(archive_manifest, settle_seconds)
+
+    # The generation script reads its ini file from its own directory
+    runner = edesig_watcher.GenerationRunner([python3_path, gen_script_path],
+                                             cwd=os.path.dirname(os.path.abspath(gen_script_path)))
+
+    def change_summary(filename):
+        # Compare the release with the one before it, keeping the change report and changeset in Diff_Path as the
+        # Pull script does. A failed comparison leaves the summary out of the email rather than stopping the watcher
+        latest_entry = archive_manifest.get(filename)
+        previous_entry = archive_manifest.previous(filename) if latest_entry is not None else None
+        if previous_entry is None:
+            return ""
+        try:
+            release_diff = edesig_diff.compare_files(archive_manifest.path(previous_entry),
+                                                     archive_manifest.path(latest_entry))
+            report_path, changeset_path = edesig_diff.write_diff(release_diff, diff_path, previous_entry.release_date,
+                                                                 latest_entry.release_date)
+        except Exception as error:
+            print("Unable to compare {0} with the previous release {1}: {2}".format(filename, previous_entry.filename,
+                                                                                   error))
+            return ""
+        print(release_diff.summary())
+        return release_diff.summary() + "\n\n" \
+            "The full list of changes is in {}. \n\n".format(changeset_path)
+
+    def generation_finished(job):
+        # Log the generation run and notify GIS Team that the new data set is ready for distribution
+        started = datetime.datetime.fromtimestamp(job.started).replace(microsecond=0)
+        finished = datetime.datetime.fromtimestamp(job.finished).replace(microsecond=0)
+        releases = ", ".join(job.releases)
+        print("Generation for {0} finished with exit code {1}".format(releases, job.returncode))
+        log.write(str(started) + "\t" + str(finished) + "\t" + str(finished - started) + "\t" + releases + "\t" +
+                  str(job.returncode) + "\n")
+        log.flush()
+
+        outlook = win32com.client.Dispatch("Outlook.Application")
+        email_msg = outlook.CreateItem(0x0)
+        email_msg.To = email_recipient
+        email_msg.Subject = "E-Designation GIS Team Confirmation - {}".format(releases)
+        email_msg.Body = "Greetings, \n\n" \
+                         "This email is to notify GIS Team that a new E-Designation text file ({0}) was added to " \
+                         "the archive and the generation script {1}. \n\n" \
+                         "Please check the E-Designation script logs to confirm the generation script ran " \
+                         "successfully. If it did, all that is left to do is run the E-Designation Distribution " \
+                         "script to migrate the updated data set to the SDE and layer files. \n\n".format(
+                             releases, "finished" if job.returncode == 0 else
+                             "exited with code {}".format(job.returncode)) + \
+                         change_summary(max(job.releases, key=edesig_manifest.release_date_from_filename)) + \
+                         "Thank you very much!"
+        email_msg.Send()
+
+    print("Watching {} for new E-Designation files".format(edes_archive_path))
+    edesig_watcher.watch(watcher, runner, poll_seconds, generation_finished)
+
+except KeyboardInterrupt:
+    print("Watcher stopped")
+    log.close()
+
+except:
+    print("error")
+    tb = sys.exc_info()[2]
+    tbinfo = traceback.format_tb(tb)[0]
+    # Log any Python errors that were encountered during script run-time
+    pymsg = "PYTHON ERRORS:\nTraceback Info:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+
+    print(pymsg)
+
+    log.write("" + pymsg + "\n")
+    log.write("\n")
+    log.close()